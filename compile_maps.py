@@ -0,0 +1,11 @@
+# Converts Tiled maps (.tmx or .tmj) to the binary map format that IsometricMap.load_binary memory maps.
+#
+# Usage: python compile_maps.py assets/test_map.tmx assets/test_map2.tmx
+
+import sys
+
+import isometric_maps
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        print("{} -> {}".format(filename, isometric_maps.compile_map(filename)))
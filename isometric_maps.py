@@ -10,15 +10,25 @@ Tilesets = kengi.tmx.data.Tilesets
 
 import json
 
-from zlib import decompress
+from zlib import compress, decompress
 from base64 import b64decode
 
 from xml.etree import ElementTree
 
 import struct
+import array
+import sys
 import os
 
 import collections
+import bisect
+import weakref
+import mmap
+import hashlib
+import concurrent.futures
+import time
+
+import numpy
 
 SCROLL_STEP = 8
 
@@ -28,40 +38,99 @@ FLIPPED_DIAGONALLY_FLAG = 0x20000000
 ROTATED_HEXAGONAL_120_FLAG = 0x10000000
 
 NOT_ALL_FLAGS = 0x0FFFFFFF
+# The flags that change how a tile gets drawn. The hexagonal rotation flag doesn't mean anything on isometric maps.
+TILE_TRANSFORM_FLAGS = FLIPPED_HORIZONTALLY_FLAG | FLIPPED_VERTICALLY_FLAG | FLIPPED_DIAGONALLY_FLAG
+
+# The flipped copies of tiles get made when they're first drawn and kept until they take up more than this many bytes.
+TILE_VARIANT_BUDGET = 32 * 1024 * 1024
+
+# The composited stacks of tiles drawn by baked layers are kept until they take up more than this many bytes.
+TILE_STACK_BUDGET = 32 * 1024 * 1024
+
+# The ways an IsometricLayer can store its cells. A list costs a pointer plus an int object per cell; the other two
+# cost four bytes per cell. The speed test showed little difference between them for single cell access.
+LAYER_STORAGE_LIST = "list"
+LAYER_STORAGE_ARRAY = "array"
+LAYER_STORAGE_NUMPY = "numpy"
+LAYER_STORAGE_MEMORYVIEW = "memoryview"
+DEFAULT_LAYER_STORAGE = LAYER_STORAGE_ARRAY
+
+BINARY_MAP_MAGIC = b"ISOMAP\x00\x01"
+BINARY_MAP_EXTENSION = ".isomap"
+
+# IsometricMap.load keeps a binary copy of every map it parses in this directory, next to the map file.
+MAP_CACHE_DIR = "__mapcache__"
+
+# Each layer of an infinite map keeps at most this many bytes of decoded chunks. Past that, the least recently used
+# chunks get dropped; the ones that were changed get compressed again first.
+CHUNK_MEMORY_BUDGET = 16 * 1024 * 1024
+
+# With sparse_layers turned on, the viewer gives a sparse index to every layer with no more than this fraction of
+# its cells in use.
+SPARSE_LAYER_DENSITY = 0.25
+
+# The zoom levels IsometricMapViewer.zoom_in and zoom_out step through, and the number of zoom levels whose scaled
+# tiles each map keeps around.
+ZOOM_LEVELS = (0.25, 0.5, 0.75, 1.0, 1.5, 2.0)
+ZOOM_CACHE_LEVELS = 3
+
+
+def make_cells(storage, data=None, size=0):
+    # Returns a new cell container of the requested storage type. If data is given, it holds the cells as
+    # little-endian unsigned 32 bit ints (which is how Tiled stores them); otherwise, the container holds size zeroes.
+    if storage == LAYER_STORAGE_LIST:
+        if data is None:
+            return [0, ] * size
+        return list(struct.unpack('<%dI' % (len(data) // 4,), data))
+    elif storage == LAYER_STORAGE_ARRAY:
+        if data is None:
+            return array.array('I', bytes(4 * size))
+        cells = array.array('I', data)
+        if sys.byteorder == "big":
+            cells.byteswap()
+        return cells
+    elif storage == LAYER_STORAGE_NUMPY:
+        if data is None:
+            return numpy.zeros(size, dtype=numpy.uint32)
+        return numpy.frombuffer(data, dtype='<u4').astype(numpy.uint32)
+    elif storage == LAYER_STORAGE_MEMORYVIEW:
+        # Mostly here for binary maps, which hand out views of the map file. See IsometricMap.load_binary.
+        if data is None:
+            return memoryview(bytearray(4 * size)).cast('I')
+        cells = array.array('I', data)
+        if sys.byteorder == "big":
+            cells.byteswap()
+        return memoryview(bytearray(cells.tobytes())).cast('I')
+    else:
+        raise ValueError("Unknown layer storage {}".format(storage))
+
+
+def map_cell_stacks(layers, fun, dtype):
+    # Returns a numpy array holding fun(gids) for every cell of layers in row order, where gids is the list of gids
+    # in that cell, one per layer. Maps repeat the same few stacks of gids over and over, so fun only gets called
+    # once for each distinct stack instead of once per cell.
+    stacks = numpy.stack([layer._get_cell_view() for layer in layers], axis=1)
+    unique_stacks, inverse = numpy.unique(stacks, axis=0, return_inverse=True)
+    results = numpy.array([fun(stack.tolist()) for stack in unique_stacks], dtype=dtype)
+    return results[inverse.reshape(-1)]
 
 
 class IsometricTile():
-    def __init__(self, id, tile_surface, hflip, vflip):
+    def __init__(self, id, tile_surface):
         self.id = id
         self.tile_surface = tile_surface
-        if hflip:
-            self.hflip_surface = pygame.transform.flip(tile_surface, True, False).convert_alpha()
-            self.hflip_surface.set_colorkey(tile_surface.get_colorkey(), tile_surface.get_flags())
-        else:
-            self.hflip_surface = None
 
-        if vflip:
-            self.vflip_surface = pygame.transform.flip(tile_surface, False, True).convert_alpha()
-            self.vflip_surface.set_colorkey(tile_surface.get_colorkey(), tile_surface.get_flags())
-        else:
-            self.vflip_surface = None
-
-        if hflip and vflip:
-            self.hvflip_surface = pygame.transform.flip(tile_surface, True, True).convert_alpha()
-            self.hvflip_surface.set_colorkey(tile_surface.get_colorkey(), tile_surface.get_flags())
-        else:
-            self.hvflip_surface = None
+    def get_surface(self, hflip=False, vflip=False, dflip=False):
+        """Return the surface to draw for the requested flip combination."""
+        if hflip or vflip or dflip:
+            flags = ((hflip and FLIPPED_HORIZONTALLY_FLAG) | (vflip and FLIPPED_VERTICALLY_FLAG) |
+                     (dflip and FLIPPED_DIAGONALLY_FLAG))
+            return TILE_VARIANT_CACHE.get_surface(self, flags)
+        return self.tile_surface
 
-    def __call__(self, dest_surface, x, y, hflip=False, vflip=False):
+    def __call__(self, dest_surface, x, y, hflip=False, vflip=False, dflip=False):
         """Draw this tile on the dest_surface at the provided x,y coordinates."""
-        if hflip and vflip:
-            surf = self.hvflip_surface
-        elif hflip:
-            surf = self.hflip_surface
-        elif vflip:
-            surf = self.vflip_surface
-        else:
-            surf = self.tile_surface
+        surf = self.get_surface(hflip, vflip, dflip)
         mydest = surf.get_rect(midbottom=(x, y))
         dest_surface.blit(surf, mydest)
 
@@ -69,6 +138,130 @@ class IsometricTile():
         return '<Tile {}>'.format(self.id)
 
 
+class TileVariantCache(object):
+    """Makes the transformed copies of tiles the first time they're asked for, and keeps the most recently used ones
+       until they go over a memory budget."""
+
+    def __init__(self, max_bytes=TILE_VARIANT_BUDGET):
+        self.max_bytes = max_bytes
+        # The keys are (tile, transform); so far transform is just the TILE_TRANSFORM_FLAGS of a gid, but anything
+        # hashable that _make_surface knows how to apply would do.
+        self._surfaces = collections.OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _make_surface(tile, transform):
+        surf = tile.tile_surface
+        if transform & FLIPPED_DIAGONALLY_FLAG:
+            # Tiled applies the diagonal flip first; it swaps the x and y axes.
+            surf = pygame.transform.flip(pygame.transform.rotate(surf, -90), True, False)
+        if transform & (FLIPPED_HORIZONTALLY_FLAG | FLIPPED_VERTICALLY_FLAG):
+            surf = pygame.transform.flip(surf, bool(transform & FLIPPED_HORIZONTALLY_FLAG),
+                                         bool(transform & FLIPPED_VERTICALLY_FLAG))
+        surf = surf.convert_alpha()
+        surf.set_colorkey(tile.tile_surface.get_colorkey(), tile.tile_surface.get_flags())
+        return surf
+
+    @staticmethod
+    def _get_surface_bytes(surf):
+        return surf.get_bytesize() * surf.get_width() * surf.get_height()
+
+    def get_surface(self, tile, transform):
+        """Return tile's surface with transform applied."""
+        key = (tile, transform)
+        surf = self._surfaces.get(key)
+        if surf is not None:
+            self._surfaces.move_to_end(key)
+            self.hits += 1
+            return surf
+
+        self.misses += 1
+        surf = self._make_surface(tile, transform)
+        self._surfaces[key] = surf
+        self.num_bytes += self._get_surface_bytes(surf)
+        while self.num_bytes > self.max_bytes and len(self._surfaces) > 1:
+            old_key, old_surf = self._surfaces.popitem(last=False)
+            self.num_bytes -= self._get_surface_bytes(old_surf)
+            self.evictions += 1
+        return surf
+
+    def forget(self, tiles):
+        """Drop the transformed copies of the given tiles."""
+        tiles = set(tiles)
+        for key in [k for k in self._surfaces if k[0] in tiles]:
+            self.num_bytes -= self._get_surface_bytes(self._surfaces.pop(key))
+
+    def clear(self):
+        self._surfaces.clear()
+        self.num_bytes = 0
+
+    def get_stats(self):
+        """Return a dict with the number of surfaces and bytes held and the hit, miss and eviction counts."""
+        return {
+            "surfaces": len(self._surfaces), "bytes": self.num_bytes, "max_bytes": self.max_bytes,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+TILE_VARIANT_CACHE = TileVariantCache()
+
+
+class TileRegistry(object):
+    """Keeps the tiles cut from every spritesheet in use, so that tilesets loaded by different maps can share them.
+       Each entry counts the tilesets using it, and gets dropped when the last of them is released."""
+
+    def __init__(self):
+        # key: [tiles, number of users]
+        self._entries = dict()
+
+    @staticmethod
+    def get_key(source, tile_width, tile_height, num_tiles):
+        # Tiles can only be shared if they were cut from the same image in the same way.
+        return os.path.normpath(os.path.join("assets", source)), tile_width, tile_height, num_tiles
+
+    def acquire(self, key, make_tiles):
+        """Return the tiles for key, calling make_tiles() to create them if nobody is using them yet."""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = [make_tiles(), 0]
+            self._entries[key] = entry
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._entries[key]
+                TILE_VARIANT_CACHE.forget(entry[0])
+
+    def get_refcount(self, key):
+        entry = self._entries.get(key)
+        return entry[1] if entry else 0
+
+    def get_refcounts(self):
+        """Return a dict of key: number of tilesets using those tiles."""
+        return {key: entry[1] for key, entry in self._entries.items()}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+TILE_REGISTRY = TileRegistry()
+
+
 class IsometricTileset:
     """
     Based on the Tileset class from katagames_engine/_sm_shelf/tmx/data.py, but modified for the needs of isometric
@@ -81,35 +274,104 @@ class IsometricTileset:
         self.tile_height = tile_height
         self.firstgid = firstgid
 
+        # The flips that Tiled allows for this tileset. Flipped tiles get made on demand by the TILE_VARIANT_CACHE,
+        # so these are only kept for the record.
         self.hflip = False
         self.vflip = False
 
+        # The spritesheet and the files this tileset was read from, relative to the working directory. These are
+        # recorded so that the tileset can be written out again without its surfaces.
+        self.image = None
+        self.num_tiles = 0
+        self.sources = list()
+        self._image_future = None
+        # Once the tiles have been cut, this releases them from the TILE_REGISTRY. It gets called automatically when
+        # the tileset is garbage collected.
+        self._release_tiles = None
+
         self.tiles = []
         self.properties = {}
 
     def get_tile(self, gid):
         return self.tiles[gid - self.firstgid]
 
-    def _add_image(self, source, num_tiles):
+    def _get_image_key(self, source, num_tiles):
+        return TILE_REGISTRY.get_key(source, self.tile_width, self.tile_height, num_tiles)
+
+    def _make_tiles(self, source, num_tiles, mysurf=None):
         # TODO: Make this bit compatible with Kenji.
-        mysurf = pygame.image.load(os.path.join("assets", source)).convert_alpha()
+        if mysurf is None:
+            mysurf = pygame.image.load(os.path.join("assets", source))
+        mysurf = mysurf.convert_alpha()
         mysurf.set_colorkey((255, 0, 255))
         myrect = pygame.Rect(0, 0, self.tile_width, self.tile_height)
         frames_per_row = mysurf.get_width() // self.tile_width
 
+        mytiles = list()
         for frame in range(num_tiles):
             myrect.x = (frame % frames_per_row) * self.tile_width
             myrect.y = (frame // frames_per_row) * self.tile_height
-            self.tiles.append(IsometricTile(frame + 1, mysurf.subsurface(myrect), self.hflip, self.vflip))
+            mytiles.append(IsometricTile(frame + 1, mysurf.subsurface(myrect)))
+        return mytiles
+
+    def _add_image(self, source, num_tiles, mysurf=None):
+        # The tiles come from the TILE_REGISTRY and may be shared with other maps, so self.tiles must not be changed.
+        key = self._get_image_key(source, num_tiles)
+        self.tiles = TILE_REGISTRY.acquire(key, lambda: self._make_tiles(source, num_tiles, mysurf))
+        self._release_tiles = weakref.finalize(self, TILE_REGISTRY.release, key)
+
+    def release(self):
+        """Stop using the shared tiles. The tileset has no tiles afterwards."""
+        if self._release_tiles:
+            self._release_tiles()
+            self._release_tiles = None
+        self.tiles = []
+
+    def _set_image(self, source, num_tiles, load_images=True, executor=None):
+        # If an executor is provided, the image file gets read in the background and finish_loading must be called
+        # before the tileset is used. There's no need to read it at all if another map already has these tiles.
+        self.image = source
+        self.num_tiles = num_tiles
+        if load_images and executor and self._get_image_key(source, num_tiles) not in TILE_REGISTRY:
+            self._image_future = executor.submit(pygame.image.load, os.path.join("assets", source))
+        elif load_images:
+            self._add_image(source, num_tiles)
+
+    def finish_loading(self):
+        # Converting surfaces needs the display, so that part happens here in the main thread.
+        if self._image_future:
+            self._add_image(self.image, self.num_tiles, self._image_future.result())
+            self._image_future = None
+
+    def get_info(self):
+        """Return a dict describing this tileset, from which frominfo can rebuild it."""
+        return {
+            "name": self.name, "tile_width": self.tile_width, "tile_height": self.tile_height,
+            "firstgid": self.firstgid, "hflip": self.hflip, "vflip": self.vflip, "image": self.image,
+            "num_tiles": self.num_tiles, "sources": list(self.sources), "properties": dict(self.properties)
+        }
 
     @classmethod
-    def fromxml(cls, tag, firstgid=None):
+    def frominfo(cls, info, load_images=True):
+        tileset = cls(info["name"], info["tile_width"], info["tile_height"], info["firstgid"])
+        tileset.hflip = info["hflip"]
+        tileset.vflip = info["vflip"]
+        tileset.sources = list(info["sources"])
+        tileset.properties.update(info.get("properties", {}))
+        if info["image"]:
+            tileset._set_image(info["image"], info["num_tiles"], load_images)
+        return tileset
+
+    @classmethod
+    def fromxml(cls, tag, firstgid=None, load_images=True, executor=None):
         print('fromxml (isometrically)')
+        sources = list()
         if 'source' in tag.attrib:
             # Instead of a tileset proper, we have been handed an external tileset tag from inside a map file.
             # Load the external tileset and continue on as if nothing had happened.
             firstgid = int(tag.attrib['firstgid'])
             srcc = tag.attrib['source']
+            sources.append(os.path.join("assets", srcc))
 
             # TODO: Another direct disk access here.
             if srcc.endswith(("tsx", "xml")):
@@ -119,7 +381,9 @@ class IsometricTileset:
             elif srcc.endswith(("tsj", "json")):
                 with open(os.path.join("assets", srcc)) as f:
                     jdict = json.load(f)
-                return cls.fromjson(jdict, firstgid)
+                tileset = cls.fromjson(jdict, firstgid, load_images, executor)
+                tileset.sources = sources + tileset.sources
+                return tileset
 
         name = tag.attrib['name']
         if firstgid is None:
@@ -129,6 +393,7 @@ class IsometricTileset:
         num_tiles = int(tag.attrib['tilecount'])
 
         tileset = cls(name, tile_width, tile_height, firstgid)
+        tileset.sources = sources
 
         # TODO: The transformations must be registered before any of the tiles. Is there a better way to do this
         # than iterating through the list twice? I know this is a minor thing but it bothers me.
@@ -144,23 +409,27 @@ class IsometricTileset:
             if c.tag == "image":
                 # create a tileset
                 arg_sheet = c.attrib['source']
-                tileset._add_image(arg_sheet, num_tiles)
+                tileset._set_image(arg_sheet, num_tiles, load_images, executor)
 
         return tileset
 
     @classmethod
-    def fromjson(cls, jdict, firstgid=None):
+    def fromjson(cls, jdict, firstgid=None, load_images=True, executor=None):
         print('fromjson (isometrically)')
+        sources = list()
         if 'source' in jdict:
             firstgid = int(jdict['firstgid'])
             srcc = jdict['source']
+            sources.append(os.path.join("assets", srcc))
 
             # TODO: Another direct disk access here.
             if srcc.endswith(("tsx", "xml")):
                 with open(os.path.join("assets", srcc)) as f:
                     print('opened ', srcc)
                     tag = ElementTree.fromstring(f.read())
-                    return cls.fromxml(tag, firstgid)
+                    tileset = cls.fromxml(tag, firstgid, load_images, executor)
+                    tileset.sources = sources + tileset.sources
+                    return tileset
             elif srcc.endswith(("tsj", "json")):
                 with open(os.path.join("assets", srcc)) as f:
                     jdict = json.load(f)
@@ -173,6 +442,7 @@ class IsometricTileset:
         num_tiles = int(jdict['tilecount'])
 
         tileset = cls(name, tile_width, tile_height, firstgid)
+        tileset.sources = sources
 
         if "transformations" in jdict:
             c = jdict["transformations"]
@@ -184,11 +454,213 @@ class IsometricTileset:
 
         # create a tileset
         arg_sheet = jdict['image']
-        tileset._add_image(arg_sheet, num_tiles)
+        tileset._set_image(arg_sheet, num_tiles, load_images, executor)
 
         return tileset
 
 
+class TileLookup(dict):
+    """Maps raw gids, flip flags and all, to (surface, dx, dy): the surface to draw and the offset of its top left
+       corner from the bottom middle point of the cell. None means there's nothing to draw.
+
+       Only unflipped gids get stored. Flipped gids go to the TILE_VARIANT_CACHE every time they're looked up, so
+       that its budget and counts cover every flipped tile drawn."""
+
+    def __init__(self, tilesets, tileset_list=()):
+        super().__init__()
+        self.tilesets = tilesets
+        self[0] = None
+        # The unflipped tiles get added now; any other gid gets added the first time it's looked up.
+        for ts in tileset_list:
+            for tile_id in range(ts.firstgid, ts.firstgid + len(ts.tiles)):
+                self[tile_id]
+
+    def __missing__(self, gid):
+        tile_id = gid & NOT_ALL_FLAGS
+        if tile_id > 0:
+            surf = self.tilesets[tile_id].get_surface(gid & FLIPPED_HORIZONTALLY_FLAG, gid & FLIPPED_VERTICALLY_FLAG,
+                                                      gid & FLIPPED_DIAGONALLY_FLAG)
+            entry = (surf, -(surf.get_width() // 2), -surf.get_height())
+        else:
+            entry = None
+        if not gid & TILE_TRANSFORM_FLAGS:
+            self[gid] = entry
+        return entry
+
+
+class TileStacks(dict):
+    """Maps stack ids to (surface, dx, dy), like TileLookup, for the stacks of tiles drawn by StackedLayers.
+
+    Each distinct stack of tiles gets composited into one surface the first time it turns up and is shared by every
+    cell that uses it. Stack surfaces hold premultiplied alpha, so they must be blitted with BLEND_PREMULTIPLIED.
+    Stack 0 is the empty stack.
+
+    Stack ids stay valid for as long as the TileStacks lives, but the surfaces only get kept until they take up more
+    than max_bytes; then the ones composited longest ago get dropped, and composited again if they get looked up.
+    Looking up a stack doesn't count as using it, so that drawing can stay a plain dict lookup.
+    """
+
+    def __init__(self, tile_lookup, max_bytes=TILE_STACK_BUDGET):
+        super().__init__()
+        self.tile_lookup = tile_lookup
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        # tuple of the gids that draw something, bottom first: stack id
+        self.ids = {(): 0}
+        # stack id: tuple of gids, for compositing dropped stacks again
+        self.stacks = [()]
+        self[0] = None
+
+    @staticmethod
+    def _get_entry_bytes(entry):
+        surf = entry[0]
+        return surf.get_bytesize() * surf.get_width() * surf.get_height()
+
+    def __missing__(self, stack_id):
+        entry = self._composite(self.stacks[stack_id])
+        self[stack_id] = entry
+        self.num_bytes += self._get_entry_bytes(entry)
+        # The empty stack comes first and the new one last; neither gets dropped.
+        while self.num_bytes > self.max_bytes and len(self) > 2:
+            old_id = next(k for k in self if k)
+            self.num_bytes -= self._get_entry_bytes(self.pop(old_id))
+        return entry
+
+    def get_id(self, gids):
+        """Return the id of the stack made from gids, one per layer from the bottom up."""
+        key = tuple(gid for gid in gids if self.tile_lookup[gid])
+        stack_id = self.ids.get(key)
+        if stack_id is None:
+            stack_id = len(self.ids)
+            self.ids[key] = stack_id
+            self.stacks.append(key)
+            self.__missing__(stack_id)
+        return stack_id
+
+    def _composite(self, gids):
+        entries = [self.tile_lookup[gid] for gid in gids]
+        myrects = [pygame.Rect(dx, dy, surf.get_width(), surf.get_height()) for surf, dx, dy in entries]
+        myrect = myrects[0].unionall(myrects)
+        mysurf = pygame.Surface(myrect.size, pygame.SRCALPHA)
+        mysurf.blits([(surf, (dx - myrect.x, dy - myrect.y)) for surf, dx, dy in entries], doreturn=False)
+        return mysurf, myrect.x, myrect.y
+
+
+class TileColors(dict):
+    """Maps gids to the average (r, g, b) color of the visible pixels of their tiles, or None for gids that draw
+       nothing. Flipped tiles have the same color as the unflipped ones."""
+
+    def __init__(self, tilesets, tileset_list=()):
+        super().__init__()
+        self.tilesets = tilesets
+        self[0] = None
+        for ts in tileset_list:
+            for tile_id in range(ts.firstgid, ts.firstgid + len(ts.tiles)):
+                self[tile_id]
+
+    def __missing__(self, gid):
+        tile_id = gid & NOT_ALL_FLAGS
+        if tile_id != gid:
+            color = self[tile_id]
+        elif tile_id > 0:
+            surf = self.tilesets[tile_id].tile_surface
+            # Colorkeyed pixels count as transparent.
+            weights = numpy.minimum(pygame.surfarray.array_alpha(surf), pygame.surfarray.array_colorkey(surf))
+            total = int(weights.sum(dtype=numpy.int64))
+            if total:
+                rgb = pygame.surfarray.array3d(surf).reshape(-1, 3)
+                color = tuple(int(c) for c in weights.reshape(-1) @ rgb.astype(numpy.int64) // total)
+            else:
+                color = None
+        else:
+            color = None
+        self[gid] = color
+        return color
+
+
+def get_visible_mask(surf):
+    # Returns a mask of the pixels of surf that show up when it gets drawn: neither the colorkey nor fully
+    # transparent.
+    alpha_surf = surf.copy()
+    alpha_surf.set_colorkey(None)
+    return pygame.mask.from_surface(surf).overlap_mask(pygame.mask.from_surface(alpha_surf, 0), (0, 0))
+
+
+def get_zoomed_size(size, zoom):
+    # Returns a size, offset or coordinate in pixels scaled by zoom. Everything that gets drawn zoomed goes through
+    # here, so that tiles, offsets and the viewer's coordinate transforms all round the same way.
+    return int(round(size * zoom))
+
+
+def scale_surface(surf, zoom, smooth=False):
+    # Returns a copy of surf scaled by zoom. If smooth is True, shrinking gets smoothed unless the surface has a
+    # colorkey, which smoothing would bleed into the edges. Tiles never get smoothed, since that would leave
+    # half-transparent seams between them.
+    mysize = (max(get_zoomed_size(surf.get_width(), zoom), 1), max(get_zoomed_size(surf.get_height(), zoom), 1))
+    if surf.get_colorkey() is not None:
+        if surf.get_flags() & pygame.SRCALPHA:
+            # A scaled copy of a per-pixel alpha surface keeps the colorkey but ignores it when blitted. Copying
+            # turns the colorkeyed pixels transparent instead.
+            surf = surf.copy()
+        return pygame.transform.scale(surf, mysize)
+    elif smooth and zoom < 1 and surf.get_bitsize() >= 24:
+        return pygame.transform.smoothscale(surf, mysize)
+    return pygame.transform.scale(surf, mysize)
+
+
+class SurfaceCopies(weakref.WeakKeyDictionary):
+    """Private copies of source surfaces, for blitting on another thread.
+
+    SDL keeps the state of a blit in progress on the source surface, so two threads must never blit from the same
+    surface at once. A thread drawing in the background blits from copies instead. The copies have to be made on the
+    thread that blits the originals. They last as long as the originals do, or until clear is called, so they won't
+    follow any change made to an original after it got copied.
+    """
+
+    def get_copy(self, surf):
+        mycopy = self.get(surf)
+        if mycopy is None:
+            mycopy = surf.copy()
+            if surf.get_colorkey() is not None:
+                mycopy.set_colorkey(surf.get_colorkey())
+            self[surf] = mycopy
+        return mycopy
+
+
+class ZoomedTileLookup(dict):
+    """Maps the same keys as a TileLookup or TileStacks to (surface, dx, dy), with the surfaces and offsets scaled by
+       zoom. Each surface gets scaled the first time it's looked up, not every time it's drawn. See
+       IsometricMap.get_zoomed_lookup.
+
+       Like the TileLookup, flipped gids don't get stored. Their scaled surfaces are kept for as long as the
+       TILE_VARIANT_CACHE keeps the flipped surfaces they were scaled from."""
+
+    def __init__(self, lookup, zoom):
+        super().__init__()
+        self.lookup = lookup
+        self.zoom = zoom
+        self._scaled_variants = weakref.WeakKeyDictionary()
+
+    def __missing__(self, key):
+        entry = self.lookup[key]
+        if entry:
+            surf, dx, dy = entry
+            if key & TILE_TRANSFORM_FLAGS:
+                mysurf = self._scaled_variants.get(surf)
+                if mysurf is None:
+                    mysurf = scale_surface(surf, self.zoom)
+                    self._scaled_variants[surf] = mysurf
+                return mysurf, get_zoomed_size(dx, self.zoom), get_zoomed_size(dy, self.zoom)
+            entry = (scale_surface(surf, self.zoom), get_zoomed_size(dx, self.zoom), get_zoomed_size(dy, self.zoom))
+        self[key] = entry
+        return entry
+
+
+def map_tile(x, y):
+    # Returns the map cell that the float map position x,y belongs to.
+    return int(x + 0.99), int(y + 0.99)
+
+
 class IsometricMapObject():
     """A thing that can be placed on the map."""
 
@@ -203,14 +675,65 @@ class IsometricMapObject():
         self.visible = 1
         super().__init__(**keywords)
 
+    # The ObjectGroups this object belongs to keep a spatial index of their contents, so they need to hear about it
+    # whenever the object moves.
+    def _get_x(self):
+        return self._x
+
+    def _set_x(self, value):
+        groups = self.__dict__.get("_groups")
+        if groups:
+            old_tile = self.get_tile()
+            self._x = value
+            for g in groups:
+                g._object_moved(self, old_tile)
+        else:
+            self._x = value
+
+    x = property(_get_x, _set_x)
+
+    def _get_y(self):
+        return self._y
+
+    def _set_y(self, value):
+        groups = self.__dict__.get("_groups")
+        if groups:
+            old_tile = self.get_tile()
+            self._y = value
+            for g in groups:
+                g._object_moved(self, old_tile)
+        else:
+            self._y = value
+
+    y = property(_get_y, _set_y)
+
+    def __getstate__(self):
+        # A copy doesn't belong to the groups of the original. Groups that get copied along with it add it back.
+        state = self.__dict__.copy()
+        state.pop("_groups", None)
+        return state
+
+    def get_tile(self):
+        """Return the map cell this object is standing in."""
+        return map_tile(self._x, self._y)
+
     def __call__(self, dest_surface, sx, sy, mymap):
         """Draw this object at the requested surface coordinates on the provided surface."""
-        if self.gid:
-            tile_id = self.gid & NOT_ALL_FLAGS
-            if tile_id > 0:
-                my_tile = mymap.tilesets[tile_id]
-                my_tile(dest_surface, sx, sy, self.gid & FLIPPED_HORIZONTALLY_FLAG,
-                        self.gid & FLIPPED_VERTICALLY_FLAG)
+        myblits = self.get_blits(sx, sy, mymap)
+        if myblits:
+            dest_surface.blits(myblits, doreturn=False)
+
+    def get_blits(self, sx, sy, mymap):
+        """Return a list of (surface, dest) pairs that draw this object at the requested surface coordinates, or
+           None if the object has to be drawn by calling it. The viewer batches these with the terrain tiles."""
+        if type(self).__call__ is not IsometricMapObject.__call__:
+            # A subclass that draws itself some other way.
+            return None
+        entry = mymap.get_tile_lookup()[self.gid] if self.gid else None
+        if entry:
+            surf, dx, dy = entry
+            return [(surf, (sx + dx, sy + dy))]
+        return []
 
     @staticmethod
     def _deweirdify_coordinates(tx, ty, givenlayer):
@@ -254,9 +777,23 @@ class IsometricMapObject():
         myob.visible = jdict.get("visible")
         return myob
 
+    def get_info(self):
+        """Return a dict describing this object, from which frominfo can rebuild it."""
+        return {
+            "name": self.name, "type": self.type, "x": self.x, "y": self.y, "width": self.width,
+            "height": self.height, "gid": self.gid, "visible": self.visible
+        }
+
+    @classmethod
+    def frominfo(cls, info):
+        myob = cls()
+        for k, v in info.items():
+            setattr(myob, k, v)
+        return myob
+
 
 class IsometricLayer:
-    def __init__(self, name, visible, map, offsetx=0, offsety=0):
+    def __init__(self, name, visible, map, offsetx=0, offsety=0, storage=None):
         self.name = name
         self.visible = visible
 
@@ -270,23 +807,49 @@ class IsometricLayer:
         self.offsety = offsety
 
         self.properties = {}
-        self.cells = list()
+        self.storage = storage or getattr(map, "layer_storage", DEFAULT_LAYER_STORAGE)
+        self.cells = make_cells(self.storage)
+        self._cells_future = None
+
+        # Anything that caches the contents of this layer (such as the viewer's TerrainChunkCache) can add itself
+        # here; its cell_changed(layer, x, y) method gets called whenever a cell is set, and its layer_changed(layer)
+        # method gets called after a bulk operation that may have changed any number of cells.
+        self.observers = weakref.WeakSet()
+
+        # If not None, a dict of x + y: sorted list of the x coordinates of the non-empty cells on that diagonal. See
+        # build_sparse_index.
+        self.sparse_index = None
 
     def __repr__(self):
         return '<Layer "%s" at 0x%x>' % (self.name, id(self))
 
+    def __getstate__(self):
+        # The observers are caches belonging to whoever draws the layer, and a WeakSet can't be pickled anyway, so
+        # copies start out without any. Memoryviews can't be pickled either, so those cells get saved as bytes.
+        state = self.__dict__.copy()
+        del state["observers"]
+        if isinstance(self.cells, memoryview):
+            state["cells"] = self.tobytes()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.cells, bytes):
+            self.cells = make_cells(self.storage, self.cells)
+        self.observers = weakref.WeakSet()
+
     @classmethod
     def emptylayer(cls, name, givenmap):
         layer = cls(
             name, 0, givenmap, 0, 0
         )
 
-        layer.cells = [0, ] * givenmap.height * givenmap.width
+        layer.cells = make_cells(layer.storage, size=givenmap.height * givenmap.width)
 
         return layer
 
     @classmethod
-    def fromxml(cls, tag, givenmap):
+    def fromxml(cls, tag, givenmap, executor=None):
         layer = cls(
             tag.attrib['name'], int(tag.attrib.get('visible', 1)), givenmap,
             int(tag.attrib.get('offsetx', 0)), int(tag.attrib.get('offsety', 0))
@@ -296,23 +859,12 @@ class IsometricLayer:
         if data is None:
             raise ValueError('layer %s does not contain <data>' % layer.name)
 
-        data = data.text.strip()
-        data = data.encode()  # Convert to bytes
-        # Decode from base 64 and decompress via zlib
-        data = decompress(b64decode(data))
-
-        # I ran a test today and there's a slight speed advantage in leaving the cells as a list. It's not a big
-        # advantage, but it's just as easy for now to leave the data as it is.
-        #
-        # I'm changing to a list from a tuple in case destructible terrain or modifiable terrain (such as doors) are
-        # wanted in the future.
-        layer.cells = list(struct.unpack('<%di' % (len(data) / 4,), data))
-        assert len(layer.cells) == layer.width * layer.height
+        layer._set_data(data.text, executor)
 
         return layer
 
     @classmethod
-    def fromjson(cls, jdict, givenmap):
+    def fromjson(cls, jdict, givenmap, executor=None):
         layer = cls(
             jdict['name'], jdict.get('visible', True), givenmap,
             jdict.get('offsetx', 0), jdict.get('offsety', 0)
@@ -322,20 +874,36 @@ class IsometricLayer:
         if data is None:
             raise ValueError('layer %s does not contain <data>' % layer.name)
 
+        layer._set_data(data, executor)
+
+        return layer
+
+    @staticmethod
+    def decode_data(data, storage):
+        # Decode the base 64, zlib compressed cell data from a Tiled layer.
         data = data.strip()
         data = data.encode()  # Convert to bytes
         # Decode from base 64 and decompress via zlib
         data = decompress(b64decode(data))
 
-        # I ran a test today and there's a slight speed advantage in leaving the cells as a list. It's not a big
-        # advantage, but it's just as easy for now to leave the data as it is.
-        #
-        # I'm changing to a list from a tuple in case destructible terrain or modifiable terrain (such as doors) are
-        # wanted in the future.
-        layer.cells = list(struct.unpack('<%di' % (len(data) / 4,), data))
-        assert len(layer.cells) == layer.width * layer.height
+        # The cells are mutable in case destructible terrain or modifiable terrain (such as doors) are wanted in the
+        # future. See make_cells for the storage types.
+        return make_cells(storage, data)
 
-        return layer
+    def _set_data(self, data, executor=None):
+        # If an executor is provided, the data gets decoded in the background and finish_loading must be called
+        # before the layer is used.
+        if executor:
+            self._cells_future = executor.submit(self.decode_data, data, self.storage)
+        else:
+            self.cells = self.decode_data(data, self.storage)
+            assert len(self.cells) == self.width * self.height
+
+    def finish_loading(self):
+        if self._cells_future:
+            self.cells = self._cells_future.result()
+            self._cells_future = None
+            assert len(self.cells) == self.width * self.height
 
     def __len__(self):
         return self.height * self.width
@@ -347,13 +915,447 @@ class IsometricLayer:
         x, y = key
         i = self._pos_to_index(x, y)
         if 0 <= x < self.width and 0 <= y < self.height:
-            return self.cells[i]
+            # NumPy storage hands out numpy.uint32s, which wrap around in arithmetic and can't be written to JSON.
+            return int(self.cells[i])
 
     def __setitem__(self, pos, value):
         x, y = pos
         i = self._pos_to_index(x, y)
         if 0 <= x < self.width and 0 <= y < self.height:
             self.cells[i] = value
+            if self.sparse_index is not None:
+                self._update_sparse_index(x, y, value)
+            for ob in self.observers:
+                ob.cell_changed(self, x, y)
+
+    def _notify_layer_changed(self):
+        if self.sparse_index is not None:
+            self.build_sparse_index()
+        for ob in self.observers:
+            ob.layer_changed(self)
+
+    def build_sparse_index(self):
+        """Index the non-empty cells of this layer by diagonal, which is the order the viewer walks the map in. The
+           index gets kept up to date from then on."""
+        ys, xs = numpy.nonzero(self._get_cell_view().reshape((self.height, self.width)))
+        diagonals = xs + ys
+        order = numpy.lexsort((xs, diagonals))
+        diagonals, xs = diagonals[order], xs[order]
+        starts = numpy.flatnonzero(numpy.diff(diagonals)) + 1
+        self.sparse_index = {
+            int(mydiag[0]): myxs.tolist()
+            for mydiag, myxs in zip(numpy.split(diagonals, starts), numpy.split(xs, starts)) if len(myxs)
+        }
+
+    def _update_sparse_index(self, x, y, value):
+        xs = self.sparse_index.setdefault(x + y, [])
+        i = bisect.bisect_left(xs, x)
+        present = i < len(xs) and xs[i] == x
+        if value and not present:
+            xs.insert(i, x)
+        elif not value and present:
+            del xs[i]
+
+    def _get_cell_view(self):
+        # Returns the cells as a NumPy array. For the array and numpy storage types this is a view, so writing to it
+        # changes the layer. For a list, it's a copy.
+        if self.storage == LAYER_STORAGE_LIST:
+            return numpy.array(self.cells, dtype=numpy.uint32)
+        elif self.storage == LAYER_STORAGE_NUMPY:
+            return self.cells
+        return numpy.frombuffer(self.cells, dtype=numpy.uint32)
+
+    def get_cell_array(self):
+        """Return a height x width NumPy array copy of the cells."""
+        return self._get_cell_view().reshape((self.height, self.width)).copy()
+
+    def set_cell_array(self, cells):
+        """Replace every cell with the values from a height x width array."""
+        cells = numpy.asarray(cells, dtype=numpy.uint32).reshape(self.height * self.width)
+        if self.storage == LAYER_STORAGE_LIST:
+            self.cells = cells.tolist()
+        else:
+            self._get_cell_view()[:] = cells
+        self._notify_layer_changed()
+
+    def fill(self, value):
+        """Set every cell of this layer to value."""
+        if self.storage == LAYER_STORAGE_LIST:
+            self.cells = [value, ] * len(self.cells)
+        else:
+            self._get_cell_view()[:] = value
+        self._notify_layer_changed()
+
+    def replace(self, old_value, new_value):
+        """Change every cell containing old_value to new_value. Returns the number of cells changed."""
+        if self.storage == LAYER_STORAGE_LIST:
+            n = 0
+            for i, gid in enumerate(self.cells):
+                if gid == old_value:
+                    self.cells[i] = new_value
+                    n += 1
+        else:
+            mycells = self._get_cell_view()
+            matches = mycells == old_value
+            n = int(numpy.count_nonzero(matches))
+            mycells[matches] = new_value
+        if n:
+            self._notify_layer_changed()
+        return n
+
+    def count_nonempty(self):
+        """Return the number of cells that aren't 0."""
+        return int(numpy.count_nonzero(self._get_cell_view()))
+
+    def get_gids(self):
+        """Return a sorted list of the distinct gids used in this layer, including 0 and flip flags."""
+        return numpy.unique(self._get_cell_view()).tolist()
+
+    def tobytes(self):
+        """Return the cells as little-endian unsigned 32 bit ints."""
+        return self._get_cell_view().astype('<u4').tobytes()
+
+
+class ChunkedIsometricLayer(IsometricLayer):
+    """A layer from a Tiled infinite map. The cells are kept as compressed chunks, which get decoded the first time
+       something looks at them and dropped again once the layer goes over its memory budget. Cells in chunks that
+       don't exist are empty."""
+
+    def __init__(self, name, visible, map, offsetx=0, offsety=0, storage=None):
+        super().__init__(name, visible, map, offsetx, offsety, storage)
+        self.chunk_width = 16
+        self.chunk_height = 16
+        self.memory_budget = CHUNK_MEMORY_BUDGET
+
+        # The position of map cell 0,0 in Tiled's cell coordinates, which can be negative. IsometricMap sets this
+        # once all of the layers have been loaded.
+        self.origin_x = 0
+        self.origin_y = 0
+
+        # Chunks are indexed by their Tiled cell coordinates divided by the chunk size. _payloads holds the zlib
+        # compressed cells of every chunk that isn't empty, _chunks holds the decoded ones with the least recently
+        # used first, and _dirty holds the decoded chunks whose payload is out of date.
+        self._payloads = dict()
+        self._chunks = collections.OrderedDict()
+        self._dirty = set()
+        self._last_key = None
+        self._last_cells = None
+
+    @classmethod
+    def emptylayer(cls, name, givenmap):
+        return cls(name, 0, givenmap, 0, 0)
+
+    @classmethod
+    def fromxml(cls, tag, givenmap, executor=None):
+        # The chunks only get decoded when they're needed, so there's nothing to hand to the executor.
+        layer = cls(
+            tag.attrib['name'], int(tag.attrib.get('visible', 1)), givenmap,
+            int(tag.attrib.get('offsetx', 0)), int(tag.attrib.get('offsety', 0))
+        )
+
+        data = tag.find('data')
+        if data is None:
+            raise ValueError('layer %s does not contain <data>' % layer.name)
+
+        for chunk in data.findall('chunk'):
+            layer._add_chunk(
+                int(chunk.attrib['x']), int(chunk.attrib['y']), int(chunk.attrib['width']),
+                int(chunk.attrib['height']), b64decode(chunk.text.strip().encode())
+            )
+
+        return layer
+
+    @classmethod
+    def fromjson(cls, jdict, givenmap, executor=None):
+        layer = cls(
+            jdict['name'], jdict.get('visible', True), givenmap,
+            jdict.get('offsetx', 0), jdict.get('offsety', 0)
+        )
+
+        chunks = jdict.get('chunks')
+        if chunks is None:
+            raise ValueError('layer %s does not contain chunks' % layer.name)
+
+        for chunk in chunks:
+            layer._add_chunk(
+                chunk['x'], chunk['y'], chunk['width'], chunk['height'], b64decode(chunk['data'].strip().encode())
+            )
+
+        return layer
+
+    def _add_chunk(self, x, y, width, height, payload):
+        # x,y are the Tiled cell coordinates of the chunk's corner; payload is its zlib compressed cells.
+        if not self._payloads:
+            self.chunk_width, self.chunk_height = width, height
+        if (width, height) != (self.chunk_width, self.chunk_height) or x % width or y % height:
+            raise ValueError('layer %s has chunks of different sizes' % self.name)
+        self._payloads[(x // width, y // height)] = payload
+
+    def get_chunk_bounds(self):
+        """Return the x0, y0, x1, y1 Tiled cell coordinates of the area covered by chunks, or None if there are none."""
+        keys = set(self._payloads) | set(self._chunks)
+        if keys:
+            return (
+                min(k[0] for k in keys) * self.chunk_width, min(k[1] for k in keys) * self.chunk_height,
+                (max(k[0] for k in keys) + 1) * self.chunk_width, (max(k[1] for k in keys) + 1) * self.chunk_height
+            )
+
+    def get_loaded_chunk_count(self):
+        """Return the number of chunks currently decoded."""
+        return len(self._chunks)
+
+    def _get_chunk(self, key, create=False):
+        # Returns the decoded cells of the chunk, or None if the chunk is empty. If create is True, an empty chunk
+        # gets created instead.
+        cells = self._chunks.get(key)
+        if cells is not None:
+            self._chunks.move_to_end(key)
+        elif key in self._payloads:
+            cells = make_cells(self.storage, decompress(self._payloads[key]))
+            self._chunks[key] = cells
+            self._evict_chunks()
+        elif create:
+            cells = make_cells(self.storage, size=self.chunk_width * self.chunk_height)
+            self._chunks[key] = cells
+            self._dirty.add(key)
+            self._evict_chunks()
+        self._last_key = key
+        self._last_cells = cells
+        return cells
+
+    def _evict_chunks(self):
+        max_chunks = max(self.memory_budget // (4 * self.chunk_width * self.chunk_height), 1)
+        while len(self._chunks) > max_chunks:
+            key, cells = self._chunks.popitem(last=False)
+            if key in self._dirty:
+                self._payloads[key] = compress(numpy.array(cells, dtype='<u4').tobytes())
+                self._dirty.discard(key)
+        self._last_key = None
+        self._last_cells = None
+
+    def _get_chunk_keys(self):
+        # Returns the keys of all the chunks inside the map area, whether they exist or not.
+        kx0 = self.origin_x // self.chunk_width
+        ky0 = self.origin_y // self.chunk_height
+        kx1 = (self.origin_x + self.width - 1) // self.chunk_width
+        ky1 = (self.origin_y + self.height - 1) // self.chunk_height
+        return [(kx, ky) for ky in range(ky0, ky1 + 1) for kx in range(kx0, kx1 + 1)]
+
+    def _get_chunk_arrays(self):
+        # Yields the key and a NumPy array copy of every chunk that isn't empty, without decoding them for keeps.
+        for key in set(self._payloads) | set(self._chunks):
+            if key in self._chunks:
+                yield key, numpy.array(self._chunks[key], dtype=numpy.uint32)
+            else:
+                yield key, numpy.frombuffer(decompress(self._payloads[key]), dtype='<u4').astype(numpy.uint32)
+
+    def _set_chunk_array(self, key, chunk):
+        # Replaces the cells of a chunk, leaving the chunk compressed.
+        self._chunks.pop(key, None)
+        self._dirty.discard(key)
+        if chunk.any():
+            self._payloads[key] = compress(chunk.astype('<u4').tobytes())
+        else:
+            self._payloads.pop(key, None)
+        self._last_key = None
+        self._last_cells = None
+
+    def _clear_chunks(self):
+        self._payloads.clear()
+        self._chunks.clear()
+        self._dirty.clear()
+        self._last_key = None
+        self._last_cells = None
+
+    def finish_loading(self):
+        pass
+
+    def __getitem__(self, key):
+        x, y = key
+        if 0 <= x < self.width and 0 <= y < self.height:
+            x += self.origin_x
+            y += self.origin_y
+            ckey = (x // self.chunk_width, y // self.chunk_height)
+            if ckey == self._last_key:
+                # Keep the least recently used order right, even though the lookup itself got skipped.
+                cells = self._last_cells
+                if cells is not None:
+                    self._chunks.move_to_end(ckey)
+            else:
+                cells = self._get_chunk(ckey)
+            if cells is None:
+                return 0
+            return int(cells[(y % self.chunk_height) * self.chunk_width + x % self.chunk_width])
+
+    def __setitem__(self, pos, value):
+        x, y = pos
+        if 0 <= x < self.width and 0 <= y < self.height:
+            tx = x + self.origin_x
+            ty = y + self.origin_y
+            ckey = (tx // self.chunk_width, ty // self.chunk_height)
+            cells = self._get_chunk(ckey, create=bool(value))
+            if cells is not None:
+                cells[(ty % self.chunk_height) * self.chunk_width + tx % self.chunk_width] = value
+                self._dirty.add(ckey)
+            if self.sparse_index is not None:
+                self._update_sparse_index(x, y, value)
+            for ob in self.observers:
+                ob.cell_changed(self, x, y)
+
+    def _get_cell_view(self):
+        # There's no flat array of cells to view, so this builds a copy of the whole layer. Writing to it does not
+        # change the layer.
+        mycells = numpy.zeros((self.height, self.width), dtype=numpy.uint32)
+        for (kx, ky), chunk in self._get_chunk_arrays():
+            chunk = chunk.reshape((self.chunk_height, self.chunk_width))
+            x0 = kx * self.chunk_width - self.origin_x
+            y0 = ky * self.chunk_height - self.origin_y
+            cx0, cy0 = max(-x0, 0), max(-y0, 0)
+            cx1, cy1 = min(self.width - x0, self.chunk_width), min(self.height - y0, self.chunk_height)
+            if cx0 < cx1 and cy0 < cy1:
+                mycells[y0 + cy0:y0 + cy1, x0 + cx0:x0 + cx1] = chunk[cy0:cy1, cx0:cx1]
+        return mycells.reshape(self.height * self.width)
+
+    def set_cell_array(self, cells):
+        """Replace every cell with the values from a height x width array."""
+        cells = numpy.asarray(cells, dtype=numpy.uint32).reshape((self.height, self.width))
+        self._clear_chunks()
+        for kx, ky in self._get_chunk_keys():
+            chunk = numpy.zeros((self.chunk_height, self.chunk_width), dtype=numpy.uint32)
+            x0 = kx * self.chunk_width - self.origin_x
+            y0 = ky * self.chunk_height - self.origin_y
+            cx0, cy0 = max(-x0, 0), max(-y0, 0)
+            cx1, cy1 = min(self.width - x0, self.chunk_width), min(self.height - y0, self.chunk_height)
+            chunk[cy0:cy1, cx0:cx1] = cells[y0 + cy0:y0 + cy1, x0 + cx0:x0 + cx1]
+            self._set_chunk_array((kx, ky), chunk)
+        self._notify_layer_changed()
+
+    def fill(self, value):
+        """Set every cell of this layer to value."""
+        self._clear_chunks()
+        if value:
+            # Every chunk can share the same payload.
+            payload = compress(numpy.full(self.chunk_width * self.chunk_height, value, dtype='<u4').tobytes())
+            for key in self._get_chunk_keys():
+                self._payloads[key] = payload
+        self._notify_layer_changed()
+
+    def replace(self, old_value, new_value):
+        """Change every cell containing old_value to new_value. Returns the number of cells changed."""
+        chunks = dict(self._get_chunk_arrays())
+        if not old_value:
+            # The empty chunks are full of old_value too.
+            for key in self._get_chunk_keys():
+                if key not in chunks:
+                    chunks[key] = numpy.zeros(self.chunk_width * self.chunk_height, dtype=numpy.uint32)
+        n = 0
+        for key, chunk in chunks.items():
+            matches = chunk == old_value
+            changed = int(numpy.count_nonzero(matches))
+            if changed:
+                chunk[matches] = new_value
+                self._set_chunk_array(key, chunk)
+                n += changed
+        if n:
+            self._notify_layer_changed()
+        return n
+
+    def count_nonempty(self):
+        """Return the number of cells that aren't 0."""
+        return sum(int(numpy.count_nonzero(chunk)) for key, chunk in self._get_chunk_arrays())
+
+    def get_gids(self):
+        """Return a sorted list of the distinct gids used in this layer, including 0 and flip flags."""
+        gids = set()
+        num_cells = 0
+        for key, chunk in self._get_chunk_arrays():
+            gids.update(numpy.unique(chunk).tolist())
+            num_cells += len(chunk)
+        if num_cells < len(self):
+            gids.add(0)
+        return sorted(gids)
+
+
+class StackedLayer(IsometricLayer):
+    """A run of neighbouring layers with the same offsets, merged so that each cell gets drawn with a single blit.
+
+    Every cell holds the id of its stack of tiles in the map's TileStacks. The merged layers stay in the map and
+    remain the ones to read and edit; a StackedLayer watches them and re-bakes a cell whenever one of them changes.
+    See IsometricMap.bake_layers.
+    """
+
+    def __init__(self, layers, givenmap, tile_stacks):
+        super().__init__(" + ".join(layer.name for layer in layers), layers[0].visible, givenmap,
+                         layers[0].offsetx, layers[0].offsety)
+        self.layers = list(layers)
+        self.tile_stacks = tile_stacks
+        self.rebake()
+        for layer in self.layers:
+            layer.observers.add(self)
+
+    def rebake(self):
+        ids = map_cell_stacks(self.layers, self.tile_stacks.get_id, '<u4')
+        self.cells = make_cells(self.storage, ids.tobytes())
+        self._notify_layer_changed()
+
+    def cell_changed(self, layer, x, y):
+        self[x, y] = self.tile_stacks.get_id([l[x, y] for l in self.layers])
+
+    def layer_changed(self, layer):
+        self.rebake()
+
+
+class ObjectList(list):
+    """The contents of an ObjectGroup. It's a list, but it tells the group whenever something is added or removed."""
+
+    def __init__(self, group, contents=()):
+        super().__init__(contents)
+        self.group = group
+
+    def append(self, ob):
+        super().append(ob)
+        self.group._add_to_index(ob)
+
+    def insert(self, i, ob):
+        super().insert(i, ob)
+        self.group._add_to_index(ob)
+
+    def extend(self, obs):
+        obs = list(obs)
+        super().extend(obs)
+        for ob in obs:
+            self.group._add_to_index(ob)
+
+    def remove(self, ob):
+        super().remove(ob)
+        self.group._remove_from_index(ob)
+
+    def pop(self, i=-1):
+        ob = super().pop(i)
+        self.group._remove_from_index(ob)
+        return ob
+
+    # The less common list operations just rebuild the whole index.
+    def __setitem__(self, i, value):
+        super().__setitem__(i, value)
+        self.group._rebuild_index()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.group._rebuild_index()
+
+    def __iadd__(self, obs):
+        self.extend(obs)
+        return self
+
+    def clear(self):
+        super().clear()
+        self.group._rebuild_index()
+
+    def __reduce__(self):
+        # Unpickling a list subclass appends the items before there's a group to tell. Only the group's own list
+        # keeps the index up to date anyway, so a copy is just a list; ObjectGroup rebuilds its own.
+        return list, (list(self),)
 
 
 class ObjectGroup():
@@ -363,7 +1365,126 @@ class ObjectGroup():
         self.offsetx = offsetx
         self.offsety = offsety
 
-        self.contents = list()
+        # The spatial index: map cell -> list of the objects standing in that cell. It is kept up to date by
+        # self.contents and by the objects themselves when they move.
+        self._tiles = dict()
+        self._contents = ObjectList(self)
+
+        # Anything that keeps track of where this group's objects are (such as the viewer's ObjectDrawLists) can add
+        # itself here. Its object_moved(group, ob) method gets called whenever an object is added or moves at all,
+        # object_removed(group, ob) when one is removed, and contents_changed(group) after the contents get replaced.
+        self.observers = weakref.WeakSet()
+
+    def __getstate__(self):
+        # Like layers, copies start out without observers. The spatial index and the ObjectList both point back at
+        # the group, so they get left out as well and rebuilt from a plain list of the contents.
+        state = self.__dict__.copy()
+        del state["observers"]
+        del state["_tiles"]
+        state["_contents"] = list(self._contents)
+        return state
+
+    def __setstate__(self, state):
+        obs = state.pop("_contents")
+        self.__dict__.update(state)
+        self.observers = weakref.WeakSet()
+        self._tiles = dict()
+        self._contents = ObjectList(self, obs)
+        for ob in obs:
+            self._add_to_index(ob)
+
+    def _get_contents(self):
+        return self._contents
+
+    def _set_contents(self, obs):
+        self._contents = ObjectList(self, obs)
+        self._rebuild_index()
+
+    contents = property(_get_contents, _set_contents)
+
+    def _add_to_index(self, ob):
+        groups = ob.__dict__.setdefault("_groups", list())
+        groups.append(self)
+        self._tiles.setdefault(ob.get_tile(), list()).append(ob)
+        for observer in self.observers:
+            observer.object_moved(self, ob)
+
+    def _remove_from_index(self, ob, tile=None):
+        if tile is None:
+            tile = ob.get_tile()
+        mylist = self._tiles.get(tile)
+        if mylist and ob in mylist:
+            mylist.remove(ob)
+            if not mylist:
+                del self._tiles[tile]
+        groups = ob.__dict__.get("_groups")
+        if groups and self in groups:
+            groups.remove(self)
+        for observer in self.observers:
+            observer.object_removed(self, ob)
+
+    def _rebuild_index(self):
+        for mylist in self._tiles.values():
+            for ob in mylist:
+                ob._groups.remove(self)
+        self._tiles.clear()
+        for ob in self._contents:
+            self._add_to_index(ob)
+        for observer in self.observers:
+            observer.contents_changed(self)
+
+    def _object_moved(self, ob, old_tile):
+        nu_tile = ob.get_tile()
+        if nu_tile != old_tile:
+            mylist = self._tiles[old_tile]
+            mylist.remove(ob)
+            if not mylist:
+                del self._tiles[old_tile]
+            self._tiles.setdefault(nu_tile, list()).append(ob)
+        for observer in self.observers:
+            observer.object_moved(self, ob)
+
+    def get_info(self):
+        """Return a dict describing this group and its contents, from which frominfo can rebuild it."""
+        return {
+            "name": self.name, "visible": self.visible, "offsetx": self.offsetx, "offsety": self.offsety,
+            "objects": [ob.get_info() for ob in self.contents]
+        }
+
+    @classmethod
+    def frominfo(cls, info):
+        mygroup = cls(info["name"], info["visible"], info["offsetx"], info["offsety"])
+        mygroup.contents.extend(IsometricMapObject.frominfo(t) for t in info["objects"])
+        return mygroup
+
+    def objects_at(self, x, y):
+        """Return a list of the objects standing in map cell x,y."""
+        return list(self._tiles.get((x, y), ()))
+
+    def objects_in_area(self, x0, y0, x1, y1):
+        """Return a list of the objects standing in the cells from x0,y0 to x1,y1 inclusive."""
+        mylist = list()
+        if (x1 - x0 + 1) * (y1 - y0 + 1) < len(self._tiles):
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    if (x, y) in self._tiles:
+                        mylist += self._tiles[(x, y)]
+        else:
+            for (x, y), obs in self._tiles.items():
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    mylist += obs
+        return mylist
+
+    def objects_in_radius(self, x, y, radius):
+        """Return a list of the objects within radius cells of map position x,y."""
+        mx, my = map_tile(x, y)
+        r = int(radius) + 1
+        return [ob for ob in self.objects_in_area(mx - r, my - r, mx + r, my + r)
+                if (ob.x - x) ** 2 + (ob.y - y) ** 2 <= radius ** 2]
+
+    def occupied_tiles(self):
+        """Return a list of the map cells that have at least one object in them."""
+        return list(self._tiles.keys())
 
     @classmethod
     def fromxml(cls, tag, givenlayer, object_fun=None):
@@ -396,7 +1517,7 @@ class ObjectGroup():
                 if object_fun:
                     pass
                     # mygroup.contents.append(IsometricMapObject.fromxml(t))
-                elif "gid" in t.attrib:
+                elif "gid" in t:
                     mygroup.contents.append(IsometricMapObject.fromjson(
                         t, mygroup, givenlayer
                     ))
@@ -413,88 +1534,532 @@ class IsometricMap():
         self.properties = {}
         self.layers = list()
         self.tilesets = Tilesets()
+        # Tilesets is indexed by gid; tileset_list keeps the tilesets themselves, in order.
+        self.tileset_list = list()
         self.objectgroups = dict()
+        self.layer_storage = DEFAULT_LAYER_STORAGE
+        # Infinite maps get ChunkedIsometricLayers. origin_x,origin_y is the position of cell 0,0 in Tiled's
+        # coordinates; see _fit_to_chunks.
+        self.infinite = False
+        self.origin_x = 0
+        self.origin_y = 0
+        self._tile_lookup = None
+        self._tile_colors = None
+        # If the layers have been baked, the layers to draw in place of self.layers. See bake_layers.
+        self.render_layers = None
+        self._tile_stacks = None
+        # (zoom, id of the lookup): ZoomedTileLookup, least recently used first. See get_zoomed_lookup.
+        self._zoomed_lookups = collections.OrderedDict()
+        # layer -> whether every tile in it fits inside a cell, and (gid, offsetx, offsety) -> whether that tile
+        # does. See get_cacheable_layers.
+        self._flat_layers = weakref.WeakKeyDictionary()
+        self._fitting_tiles = dict()
 
     @classmethod
-    def load_tmx(cls, filename, object_fun=None):
+    def load_tmx(cls, filename, object_fun=None, storage=DEFAULT_LAYER_STORAGE, load_images=True, workers=None):
         # object_fun is a function that can parse a dict describing an object.
         # If None, the only objects that can be loaded are terrain objects.
+        # storage is the LAYER_STORAGE_* type used for the layer cells.
+        # If load_images is False the tilesets get no tiles, which lets tools load a map without a display.
+        # If workers is more than 1, layer data and tileset images get decoded by a pool of that many threads.
         with open(filename) as f:
             tminfo_tree = ElementTree.fromstring(f.read())
 
         # get most general map informations and create a surface
         tilemap = cls()
+        tilemap.layer_storage = storage
 
         tilemap.width = int(tminfo_tree.attrib['width'])
         tilemap.height = int(tminfo_tree.attrib['height'])
         tilemap.tile_width = int(tminfo_tree.attrib['tilewidth'])
         tilemap.tile_height = int(tminfo_tree.attrib['tileheight'])
+        tilemap.infinite = bool(int(tminfo_tree.attrib.get('infinite', 0)))
+        layer_cls = tilemap.get_layer_class()
+
+        executor = get_load_executor(workers)
+        try:
+            tilesets = list()
+            for tag in tminfo_tree.findall('tileset'):
+                tilesets.append(
+                    IsometricTileset.fromxml(tag, load_images=load_images, executor=executor)
+                    # hacks work only if no more than 1 ts
+                )
+
+            for tag in tminfo_tree:
+                if tag.tag == 'layer':
+                    layer = layer_cls.fromxml(tag, tilemap, executor)
+                    tilemap.layers.append(layer)
+                elif tag.tag == "objectgroup":
+                    if not tilemap.layers:
+                        # If the first layer on the map is an objectgroup, this is gonna be a problem. Without
+                        # a frame of reference, we won't be able to know what tile the object is in, and that is
+                        # going to be important information. So, we add an empty layer with no offsets to act as this
+                        # objectgroup's frame of reference.
+                        tilemap.layers.append(layer_cls.emptylayer("The Mysterious Empty Layer", tilemap))
+                    tilemap.objectgroups[tilemap.layers[-1]] = ObjectGroup.fromxml(tag, tilemap.layers[-1],
+                                                                                   object_fun)
+
+            tilemap._finish_loading(tilesets)
+        finally:
+            if executor:
+                executor.shutdown()
 
-        for tag in tminfo_tree.findall('tileset'):
-            tilemap.tilesets.add(
-                IsometricTileset.fromxml(tag)
-                # hacks work only if no more than 1 ts
-            )
-
-        for tag in tminfo_tree:
-            if tag.tag == 'layer':
-                layer = IsometricLayer.fromxml(tag, tilemap)
-                tilemap.layers.append(layer)
-            elif tag.tag == "objectgroup":
-                if not tilemap.layers:
-                    # If the first layer on the map is an objectgroup, this is gonna be a problem. Without
-                    # a frame of reference, we won't be able to know what tile the object is in, and that is going
-                    # to be important information. So, we add an empty layer with no offsets to act as this
-                    # objectgroup's frame of reference.
-                    tilemap.layers.append(IsometricLayer.emptylayer("The Mysterious Empty Layer", tilemap))
-                tilemap.objectgroups[tilemap.layers[-1]] = ObjectGroup.fromxml(tag, tilemap.layers[-1], object_fun)
+        return tilemap
 
+    @classmethod
+    def load_tmx_streaming(cls, filename, object_fun=None, storage=DEFAULT_LAYER_STORAGE, load_images=True,
+                           workers=None, progress=None):
+        # Produces the same map as load_tmx, but instead of building the whole element tree first it handles each
+        # tileset, layer and objectgroup as soon as its closing tag has been read, then throws the element away.
+        # progress, if provided, is a function that gets called with the fraction of the file read so far.
+        # The other parameters are the same as for load_tmx.
+        tilemap = cls()
+        tilemap.layer_storage = storage
+        file_size = max(os.path.getsize(filename), 1)
+
+        executor = get_load_executor(workers)
+        try:
+            tilesets = list()
+            with open(filename, "rb") as f:
+                depth = 0
+                root = None
+                for event, elem in ElementTree.iterparse(f, events=("start", "end")):
+                    if event == "start":
+                        if depth == 0:
+                            # get most general map informations and create a surface
+                            root = elem
+                            tilemap.width = int(elem.attrib['width'])
+                            tilemap.height = int(elem.attrib['height'])
+                            tilemap.tile_width = int(elem.attrib['tilewidth'])
+                            tilemap.tile_height = int(elem.attrib['tileheight'])
+                            tilemap.infinite = bool(int(elem.attrib.get('infinite', 0)))
+                        depth += 1
+                        continue
+
+                    depth -= 1
+                    if depth != 1:
+                        continue
+
+                    if elem.tag == 'tileset':
+                        tilesets.append(IsometricTileset.fromxml(elem, load_images=load_images, executor=executor))
+                    elif elem.tag == 'layer':
+                        tilemap.layers.append(tilemap.get_layer_class().fromxml(elem, tilemap, executor))
+                    elif elem.tag == "objectgroup":
+                        if not tilemap.layers:
+                            # See load_tmx for why I'm adding an empty layer.
+                            tilemap.layers.append(
+                                tilemap.get_layer_class().emptylayer("The Mysterious Empty Layer", tilemap)
+                            )
+                        tilemap.objectgroups[tilemap.layers[-1]] = ObjectGroup.fromxml(elem, tilemap.layers[-1],
+                                                                                       object_fun)
+                    root.remove(elem)
+                    elem.clear()
+
+                    if progress:
+                        progress(min(f.tell() / file_size, 1.0))
+
+            tilemap._finish_loading(tilesets)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        if progress:
+            progress(1.0)
         return tilemap
 
     @classmethod
-    def load_json(cls, filename, object_fun=None):
+    def load_json(cls, filename, object_fun=None, storage=DEFAULT_LAYER_STORAGE, load_images=True, workers=None,
+                  progress=None):
         # object_fun is a function that can parse a dict describing an object.
         # If None, the only objects that can be loaded are terrain objects.
+        # storage is the LAYER_STORAGE_* type used for the layer cells.
+        # If load_images is False the tilesets get no tiles, which lets tools load a map without a display.
+        # If workers is more than 1, layer data and tileset images get decoded by a pool of that many threads.
+        # progress, if provided, is a function that gets called with the fraction of the layers read so far. The
+        # JSON file gets parsed all at once, so there's nothing to report before the first layer.
 
         with open(filename) as f:
             jdict = json.load(f)
 
         # get most general map informations and create a surface
         tilemap = cls()
+        tilemap.layer_storage = storage
 
         tilemap.width = jdict['width']
         tilemap.height = jdict['height']
         tilemap.tile_width = jdict['tilewidth']
         tilemap.tile_height = jdict['tileheight']
+        tilemap.infinite = jdict.get('infinite', False)
+        layer_cls = tilemap.get_layer_class()
+
+        executor = get_load_executor(workers)
+        try:
+            tilesets = list()
+            for tag in jdict['tilesets']:
+                tilesets.append(
+                    IsometricTileset.fromjson(tag, load_images=load_images, executor=executor)
+                )
+
+            for num_read, tag in enumerate(jdict["layers"]):
+                if progress:
+                    progress(num_read / len(jdict["layers"]))
+                if tag["type"] == 'tilelayer':
+                    layer = layer_cls.fromjson(tag, tilemap, executor)
+                    tilemap.layers.append(layer)
+                elif tag["type"] == "objectgroup":
+                    if not tilemap.layers:
+                        # See above comment for why I'm adding an empty layer. TLDR: the objects need a reference
+                        # frame.
+                        tilemap.layers.append(layer_cls.emptylayer("The Mysterious Empty Layer", tilemap))
+                    tilemap.objectgroups[tilemap.layers[-1]] = ObjectGroup.fromjson(tag, tilemap.layers[-1],
+                                                                                    object_fun)
+
+            tilemap._finish_loading(tilesets)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        if progress:
+            progress(1.0)
+        return tilemap
 
-        for tag in jdict['tilesets']:
-            tilemap.tilesets.add(
-                IsometricTileset.fromjson(tag)
-            )
+    def _finish_loading(self, tilesets):
+        # Collect the results of any background decoding, in document order.
+        for ts in tilesets:
+            ts.finish_loading()
+            self.add_tileset(ts)
+        for layer in self.layers:
+            layer.finish_loading()
+        if self.infinite:
+            self._fit_to_chunks()
+
+    def get_layer_class(self):
+        return ChunkedIsometricLayer if self.infinite else IsometricLayer
+
+    def _fit_to_chunks(self):
+        # The chunks of an infinite map can be anywhere, including at negative coordinates. Resize the map so that
+        # it just holds all of them, with cell 0,0 at the corner of the top left chunk, and move the objects to match.
+        bounds = [layer.get_chunk_bounds() for layer in self.layers if isinstance(layer, ChunkedIsometricLayer)]
+        bounds = [b for b in bounds if b]
+        if not bounds:
+            return
+        x0 = min(b[0] for b in bounds)
+        y0 = min(b[1] for b in bounds)
+        self.width = max(b[2] for b in bounds) - x0
+        self.height = max(b[3] for b in bounds) - y0
+        self.origin_x, self.origin_y = x0, y0
+        for layer in self.layers:
+            layer.width, layer.height = self.width, self.height
+            layer.origin_x, layer.origin_y = x0, y0
+        for group in self.objectgroups.values():
+            for ob in group.contents:
+                ob.x -= x0
+                ob.y -= y0
 
-        for tag in jdict["layers"]:
-            if tag["type"] == 'tilelayer':
-                layer = IsometricLayer.fromjson(tag, tilemap)
-                tilemap.layers.append(layer)
-            elif tag["type"] == "objectgroup":
-                if not tilemap.layers:
-                    # See above comment for why I'm adding an empty layer. TLDR: the objects need a reference frame.
-                    tilemap.layers.append(IsometricLayer.emptylayer("The Mysterious Empty Layer", tilemap))
-                tilemap.objectgroups[tilemap.layers[-1]] = ObjectGroup.fromjson(tag, tilemap.layers[-1], object_fun)
+    @classmethod
+    def load_binary(cls, filename, object_fun=None, storage=LAYER_STORAGE_MEMORYVIEW, load_images=True):
+        # Loads a map written by save_binary. The file is memory mapped; with the memoryview or numpy storage types
+        # the layer cells are views into the mapping instead of copies, so only the pages that actually get used
+        # are ever read. The mapping is copy-on-write: changing a cell does not change the file.
+        # object_fun is accepted for compatibility with the other loaders.
+        with open(filename, "rb") as f:
+            mymap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        header = read_binary_header(mymap, filename)
+        data_start = header["data_start"]
+
+        tilemap = cls()
+        tilemap.layer_storage = storage
+        tilemap.width = header["width"]
+        tilemap.height = header["height"]
+        tilemap.tile_width = header["tile_width"]
+        tilemap.tile_height = header["tile_height"]
+        tilemap.properties.update(header["properties"])
+
+        for info in header["tilesets"]:
+            tilemap.add_tileset(IsometricTileset.frominfo(info, load_images))
+
+        for info in header["layers"]:
+            layer = IsometricLayer(info["name"], info["visible"], tilemap, info["offsetx"], info["offsety"])
+            layer.properties.update(info["properties"])
+            offset = data_start + info["data_offset"]
+            size = tilemap.width * tilemap.height
+            if layer.storage == LAYER_STORAGE_MEMORYVIEW and sys.byteorder == "little":
+                layer.cells = memoryview(mymap)[offset:offset + 4 * size].cast('I')
+            elif layer.storage == LAYER_STORAGE_NUMPY:
+                layer.cells = numpy.frombuffer(mymap, dtype='<u4', count=size, offset=offset)
+            else:
+                layer.cells = make_cells(layer.storage, mymap[offset:offset + 4 * size])
+            tilemap.layers.append(layer)
+
+        for info in header["objectgroups"]:
+            mylayer = tilemap.layers[info["layer"]]
+            tilemap.objectgroups[mylayer] = ObjectGroup.frominfo(info)
 
         return tilemap
 
+    def save_binary(self, filename, dependencies=None):
+        """Write this map to filename in the binary format read by load_binary."""
+        # The file holds BINARY_MAP_MAGIC, the length of the header, a JSON header describing everything but the
+        # cells, and then the cells of each layer as little-endian unsigned 32 bit ints starting at data_start.
+        # dependencies is an optional dict of filename: hash, used by the map cache to tell if the file is stale.
+        header = {
+            "width": self.width, "height": self.height, "tile_width": self.tile_width,
+            "tile_height": self.tile_height, "properties": self.properties,
+            "tilesets": [ts.get_info() for ts in self.tileset_list],
+            "layers": list(), "objectgroups": list(), "dependencies": dependencies or {}
+        }
+        data_offset = 0
+        for layer in self.layers:
+            header["layers"].append({
+                "name": layer.name, "visible": layer.visible, "offsetx": layer.offsetx, "offsety": layer.offsety,
+                "properties": layer.properties, "data_offset": data_offset
+            })
+            data_offset += 4 * len(layer)
+        for layer, group in self.objectgroups.items():
+            info = group.get_info()
+            info["layer"] = self.layers.index(layer)
+            header["objectgroups"].append(info)
+
+        # The header has to hold the position of the cell data, which depends on the length of the header. Align
+        # the data to 16 bytes, leaving room for the data_start number itself to grow.
+        header["data_start"] = 0
+        header_length = len(json.dumps(header).encode("utf-8")) + 16
+        header["data_start"] = (len(BINARY_MAP_MAGIC) + 4 + header_length + 15) // 16 * 16
+        header_bytes = json.dumps(header).encode("utf-8")
+
+        with open(filename, "wb") as f:
+            f.write(BINARY_MAP_MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(bytes(header["data_start"] - f.tell()))
+            for layer in self.layers:
+                f.write(layer.tobytes())
+
     @classmethod
-    def load(cls, filename, object_fun=None):
+    def load_cached(cls, filename, object_fun=None, storage=DEFAULT_LAYER_STORAGE, workers=None, progress=None):
+        # Like load_tmx or load_json, but a binary copy of the parsed map gets saved in MAP_CACHE_DIR. As long as
+        # the map file and all of the tileset files it uses are unchanged, later loads read that copy instead of
+        # parsing, base64 decoding and decompressing everything again.
+        mydir, myname = os.path.split(filename)
+        map_hash = get_file_hash(filename)
+        cache_dir = os.path.join(mydir, MAP_CACHE_DIR)
+        cache_filename = os.path.join(cache_dir, "{}.{}{}".format(myname, map_hash, BINARY_MAP_EXTENSION))
+
+        if os.path.exists(cache_filename):
+            try:
+                with open(cache_filename, "rb") as f:
+                    header = read_binary_header(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), cache_filename)
+                if all(os.path.exists(dep) and get_file_hash(dep) == dep_hash
+                       for dep, dep_hash in header["dependencies"].items()):
+                    tilemap = cls.load_binary(cache_filename, object_fun, storage)
+                    if progress:
+                        progress(1.0)
+                    return tilemap
+            except (OSError, ValueError, KeyError):
+                pass
+
         if filename.endswith(("tmx", "xml")):
-            return cls.load_tmx(filename, object_fun)
+            tilemap = cls.load_tmx_streaming(filename, object_fun, storage, workers=workers, progress=progress)
+        else:
+            tilemap = cls.load_json(filename, object_fun, storage, workers=workers, progress=progress)
+
+        # Infinite maps are meant to be too big to decode all at once, which is what saving a binary copy would do.
+        if tilemap.infinite:
+            return tilemap
+
+        # A broken or read-only cache shouldn't stop the map from loading, so failures here get ignored.
+        dependencies = dict()
+        for ts in tilemap.tileset_list:
+            for dep in ts.sources:
+                dependencies[dep] = get_file_hash(dep)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_filename = "{}.{}.tmp".format(cache_filename, os.getpid())
+            tilemap.save_binary(temp_filename, dependencies)
+            os.replace(temp_filename, cache_filename)
+            # Clear out the copies of older versions of this map.
+            for fname in os.listdir(cache_dir):
+                if fname.startswith(myname + ".") and fname.endswith(BINARY_MAP_EXTENSION) and\
+                        fname != os.path.basename(cache_filename):
+                    os.remove(os.path.join(cache_dir, fname))
+        except OSError:
+            pass
+
+        return tilemap
+
+    @classmethod
+    def load(cls, filename, object_fun=None, storage=None, use_cache=True, workers=None, progress=None, bake=False):
+        # storage is the LAYER_STORAGE_* type used for the layer cells; if None, each loader uses its own default.
+        # If use_cache is True, Tiled maps go through the map cache. See load_cached.
+        # workers is the number of threads used to decode Tiled maps. See load_tmx.
+        # progress is a function that gets called with the fraction loaded so far. See load_tmx_streaming.
+        # If bake is True, runs of layers with the same offsets get merged for drawing. See bake_layers.
+        if filename.endswith(("tmx", "xml", "tmj", "json")) and use_cache:
+            tilemap = cls.load_cached(filename, object_fun, storage or DEFAULT_LAYER_STORAGE, workers, progress)
+        elif filename.endswith(("tmx", "xml")):
+            tilemap = cls.load_tmx_streaming(filename, object_fun, storage or DEFAULT_LAYER_STORAGE,
+                                             workers=workers, progress=progress)
         elif filename.endswith(("tmj", "json")):
-            return cls.load_json(filename, object_fun)
+            tilemap = cls.load_json(filename, object_fun, storage or DEFAULT_LAYER_STORAGE, workers=workers,
+                                    progress=progress)
+        elif filename.endswith(BINARY_MAP_EXTENSION):
+            tilemap = cls.load_binary(filename, object_fun, storage or LAYER_STORAGE_MEMORYVIEW)
+        else:
+            return None
+        if bake:
+            tilemap.bake_layers()
+        return tilemap
+
+    def add_tileset(self, tileset):
+        self.tilesets.add(tileset)
+        self.tileset_list.append(tileset)
+        self._tile_lookup = None
+        self._tile_colors = None
+        self._zoomed_lookups.clear()
+        self._flat_layers.clear()
+        self._fitting_tiles.clear()
+
+    def get_tile_lookup(self):
+        """Return the TileLookup for this map, which gives the surface and offset to draw for any gid."""
+        if self._tile_lookup is None:
+            self._tile_lookup = TileLookup(self.tilesets, self.tileset_list)
+        return self._tile_lookup
+
+    def get_tile_colors(self):
+        """Return the TileColors for this map, which gives the average color of any gid's tile."""
+        if self._tile_colors is None:
+            self._tile_colors = TileColors(self.tilesets, self.tileset_list)
+        return self._tile_colors
+
+    def get_zoomed_lookup(self, lookup, zoom):
+        """Return a ZoomedTileLookup for lookup, this map's TileLookup or TileStacks, scaled by zoom. The scaled tiles
+           of the last ZOOM_CACHE_LEVELS zoom levels are kept; older ones get dropped."""
+        if zoom == 1:
+            return lookup
+        key = (zoom, id(lookup))
+        mylookup = self._zoomed_lookups.get(key)
+        if mylookup is None or mylookup.lookup is not lookup:
+            mylookup = ZoomedTileLookup(lookup, zoom)
+            self._zoomed_lookups[key] = mylookup
+        self._zoomed_lookups.move_to_end(key)
+        while len({z for z, i in self._zoomed_lookups}) > ZOOM_CACHE_LEVELS:
+            self._zoomed_lookups.popitem(last=False)
+        return mylookup
+
+    def get_tile_stacks(self):
+        """Return the TileStacks shared by this map's StackedLayers."""
+        if self._tile_stacks is None:
+            self._tile_stacks = TileStacks(self.get_tile_lookup())
+        return self._tile_stacks
+
+    def bake_layers(self):
+        """Merge every run of two or more neighbouring layers that share the same offsets into a StackedLayer, which
+           draws each cell with one blit of a pre-composited stack of tiles. The merged layers stay in self.layers for
+           everything except drawing. Layers that own an objectgroup and layers of infinite maps don't get merged.
+           Returns the number of StackedLayers made."""
+        runs = list()
+        previous = None
+        for layer in self.layers:
+            mergeable = type(layer) is IsometricLayer and layer not in self.objectgroups
+            if mergeable and previous and (previous.offsetx, previous.offsety) == (layer.offsetx, layer.offsety):
+                runs[-1].append(layer)
+            else:
+                runs.append([layer])
+            previous = layer if mergeable else None
+
+        self.render_layers = list()
+        for run in runs:
+            if len(run) > 1:
+                self.render_layers.append(StackedLayer(run, self, self.get_tile_stacks()))
+            else:
+                self.render_layers.append(run[0])
+        return sum(len(run) > 1 for run in runs)
+
+    def get_render_layers(self):
+        """Return the layers to draw: the StackedLayers and the unmerged layers if the map has been baked, or else
+           just the layers."""
+        return self.render_layers or self.layers
 
     def on_the_map(self, x, y):
         # Returns true if (x,y) is on the map, false otherwise
         return (x >= 0) and (x < self.width) and (y >= 0) and (y < self.height)
 
+    def get_static_layers(self):
+        # Returns the terrain layers below the first layer that owns an objectgroup. Nothing ever gets drawn in
+        # between these layers.
+        mylist = list()
+        for layer in self.layers:
+            if layer in self.objectgroups:
+                break
+            mylist.append(layer)
+        return mylist
+
+    def _tile_fits(self, gid, layer):
+        # Returns True if every visible pixel of tile gid, drawn on layer, lands inside the diamond of its own cell.
+        entry = self.get_tile_lookup()[gid]
+        if not entry:
+            return True
+        key = (gid, layer.offsetx, layer.offsety)
+        fits = self._fitting_tiles.get(key)
+        if fits is None:
+            surf, dx, dy = entry
+            cell_surf = pygame.Surface((self.tile_width, self.tile_height), pygame.SRCALPHA)
+            pygame.draw.polygon(cell_surf, (255, 255, 255), [
+                (0, self.tile_height // 2), (self.tile_width // 2, 0), (self.tile_width, self.tile_height // 2),
+                (self.tile_width // 2, self.tile_height)
+            ])
+            visible = get_visible_mask(surf)
+            offset = (dx + layer.offsetx + self.tile_width // 2, dy + layer.offsety + self.tile_height)
+            fits = pygame.mask.from_surface(cell_surf).overlap_area(visible, offset) == visible.count()
+            self._fitting_tiles[key] = fits
+        return fits
+
+    def _is_flat_layer(self, layer):
+        flat = self._flat_layers.get(layer)
+        if flat is None:
+            flat = all(self._tile_fits(gid, layer) for gid in layer.get_gids())
+            self._flat_layers[layer] = flat
+            layer.observers.add(self)
+        return flat
+
+    def get_cacheable_layers(self):
+        """Return the layers that can be pre-rendered and drawn underneath everything else without changing what
+           shows up on screen: the static layers from the bottom up, for as long as every visible pixel of every
+           tile in them, layer offsets included, lands inside the diamond of its own cell. Then none of their tiles
+           can overlap anything drawn for another line.
+
+           Floor tiles that are taller than a cell, or layers offset from the grid, don't qualify. On the shipped
+           test maps the floor tiles stick out of their cells by a couple of pixels, so this list is empty."""
+        mylist = list()
+        for layer in self.get_static_layers():
+            if not self._is_flat_layer(layer):
+                break
+            mylist.append(layer)
+        return mylist
+
+    def cell_changed(self, layer, x, y):
+        # A layer stops being flat as soon as a tall tile goes into it. It only gets checked again when the whole
+        # layer changes.
+        if self._flat_layers.get(layer) and not self._tile_fits(layer[x, y], layer):
+            self._flat_layers[layer] = False
+
+    def layer_changed(self, layer):
+        self._flat_layers.pop(layer, None)
+
+    def release(self):
+        """Release this map's tilesets, freeing any tiles that no other map is using. The map can't be drawn
+           afterwards."""
+        for ts in self.tileset_list:
+            ts.release()
+        self.tilesets = Tilesets()
+        self._tile_lookup = None
+        self._tile_colors = None
+        self._tile_stacks = None
+        self._zoomed_lookups.clear()
+        self._flat_layers.clear()
+        self._fitting_tiles.clear()
+        self.render_layers = None
+
     def get_layer_by_name(self, layer_name):
         # The Layers type in Kengi supports indexing layers by name, but it doesn't support accessing layers by
         # negative indices. I'm not sure that it supports slicing either. Anyhow, for now, only the map cursor needs
@@ -504,9 +2069,770 @@ class IsometricMap():
                 return l
 
 
+def get_load_executor(workers):
+    # Returns a thread pool for decoding map data, or None if the map should be decoded in the calling thread.
+    # zlib and pygame's image loading release the GIL, so the threads really do work in parallel.
+    if workers and workers > 1:
+        return concurrent.futures.ThreadPoolExecutor(workers)
+
+
+def get_file_hash(filename):
+    # Returns a hex digest of the contents of filename.
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_binary_header(mybuffer, filename=""):
+    # Returns the header dict from the start of a binary map. mybuffer can be anything that can be sliced, such as
+    # bytes or an mmap.
+    if mybuffer[:len(BINARY_MAP_MAGIC)] != BINARY_MAP_MAGIC:
+        raise ValueError('{} is not a binary isometric map'.format(filename))
+    header_start = len(BINARY_MAP_MAGIC) + 4
+    header_length = struct.unpack_from('<I', mybuffer, len(BINARY_MAP_MAGIC))[0]
+    return json.loads(bytes(mybuffer[header_start:header_start + header_length]).decode("utf-8"))
+
+
+def compile_map(filename, dest_filename=None):
+    """Convert a .tmx or .tmj map to the binary format. Returns the name of the new file."""
+    if not dest_filename:
+        dest_filename = os.path.splitext(filename)[0] + BINARY_MAP_EXTENSION
+    if filename.endswith(("tmx", "xml")):
+        mymap = IsometricMap.load_tmx(filename, load_images=False)
+    else:
+        mymap = IsometricMap.load_json(filename, load_images=False)
+    mymap.save_binary(dest_filename)
+    return dest_filename
+
+
+class IsometricProjection(object):
+    """The map <-> screen coordinate transforms of IsometricMapViewer, done on whole NumPy arrays of points at once.
+
+    Map coordinates refer to the midbottom of a cell's image, as in IsometricMapViewer.screen_coords. The x_off,y_off
+    arguments are the view offset plus any layer or objectgroup offsets. Doesn't need a screen, so it can be used by
+    offline tools too.
+    """
+
+    def __init__(self, tile_width, tile_height):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.half_tile_width = tile_width // 2
+        self.half_tile_height = tile_height // 2
+
+    def relative_coords(self, xs, ys):
+        """Return arrays of the relative screen positions of map positions xs,ys, ignoring offset."""
+        xs = numpy.asarray(xs)
+        ys = numpy.asarray(ys)
+        return (xs - ys) * self.half_tile_width, (xs + ys) * self.half_tile_height
+
+    def screen_coords(self, xs, ys, x_off=0, y_off=0):
+        """Return arrays of the screen positions of map positions xs,ys."""
+        rx, ry = self.relative_coords(numpy.asarray(xs) - 1, numpy.asarray(ys) - 1)
+        return rx + x_off, ry + y_off
+
+    def map_coords(self, sxs, sys_, x_off=0, y_off=0, return_int=True):
+        """Return arrays of the map positions of screen positions sxs,sys_. Matches IsometricMapViewer.map_x/map_y."""
+        rx = numpy.asarray(sxs, dtype=float) - x_off
+        ry = numpy.asarray(sys_, dtype=float) - y_off
+
+        # See IsometricMapViewer.static_map_x and static_map_y for the derivation.
+        ox = -ry * self.half_tile_width / self.half_tile_height - self.tile_width
+        oy = rx * self.half_tile_height / self.half_tile_width - self.tile_height
+        if return_int:
+            ox = numpy.where(rx - ox < 0, ox + self.tile_width, ox)
+            oy = numpy.where(ry - oy < 0, oy + self.tile_height, oy)
+            return (numpy.trunc((rx - ox) / self.tile_width).astype(int) + 1,
+                    numpy.trunc((ry - oy) / self.tile_height).astype(int) + 1)
+        else:
+            return (rx - ox) / self.tile_width + 1, (ry - oy) / self.tile_height + 1
+
+    def rect_to_map_bounds(self, area, x_off=0, y_off=0):
+        """Return x0,y0,x1,y1, the range of map cells covered by the corners of screen rect area."""
+        mxs, mys = self.map_coords((area.left, area.right, area.left, area.right),
+                                   (area.top, area.top, area.bottom, area.bottom), x_off, y_off)
+        return int(mxs.min()), int(mys.min()), int(mxs.max()), int(mys.max())
+
+
+def get_line_lags(layers):
+    # The viewer draws the map one horizontal line at a time. Every time a layer is higher up (has a smaller y offset)
+    # than the layers before it, that layer and the ones above it get drawn one line behind. Returns the number of
+    # lines each layer lags behind the current line.
+    lags = list()
+    lag = 0
+    current_y_offset = layers[0].offsety if layers else 0
+    for layer in layers:
+        lags.append(lag)
+        if layer.offsety < current_y_offset:
+            lag += 1
+            current_y_offset = layer.offsety
+    return lags
+
+
+def get_terrain_blits(isometric_map, layers, x0, y0, x1, y1, x_off=0, y_off=0, line_lags=None, zoom=1):
+    # Returns a list of (surface, dest) for every tile of the given layers in cells x0,y0 to x1,y1 inclusive, in the
+    # order that the viewer would draw them. x_off,y_off is the view offset.
+    if line_lags is None:
+        line_lags = get_line_lags(layers)
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, isometric_map.width - 1), min(y1, isometric_map.height - 1)
+    half_tile_width = get_zoomed_size(isometric_map.tile_width, zoom) // 2
+    half_tile_height = get_zoomed_size(isometric_map.tile_height, zoom) // 2
+    tile_lookup = isometric_map.get_zoomed_lookup(isometric_map.get_tile_lookup(), zoom)
+    myblits = list()
+    for line in range(x0 + y0, x1 + y1 + max(line_lags, default=0) + 1):
+        for layer, lag in zip(layers, line_lags):
+            offsety = get_zoomed_size(layer.offsety, zoom)
+            for x in range(max(x0, line - lag - y1), min(x1, line - lag - y0) + 1):
+                y = line - lag - x
+                entry = tile_lookup[layer[x, y]]
+                if entry:
+                    surf, dx, dy = entry
+                    sx = (x - y) * half_tile_width + x_off
+                    sy = (x + y - 2) * half_tile_height + offsety + y_off
+                    myblits.append((surf, (sx + dx, sy + dy)))
+    return myblits
+
+
+class TerrainChunkCache(object):
+    """Pre-rendered static terrain, baked into one surface per chunk_size x chunk_size block of cells.
+
+    Chunks are baked the first time they come into view and dropped when one of their cells gets changed. Chunk
+    surfaces hold premultiplied alpha, so they must be blitted with BLEND_PREMULTIPLIED.
+
+    The cached layers get drawn underneath everything else. By default those are the map's cacheable layers, which
+    look the same either way as long as the tiles on the layers above stay out of the cells in front of their own;
+    see IsometricMap.get_cacheable_layers. Any other layers have to be the first layers of the map, and where one of
+    their tiles used to overlap a wall on the line behind it the wall will now win.
+    """
+
+    def __init__(self, isometric_map, layers=None, chunk_size=16, max_chunks=256):
+        self.isometric_map = isometric_map
+        if layers is None:
+            layers = isometric_map.get_cacheable_layers()
+        self.layers = list(layers)
+        self.line_lags = get_line_lags(self.layers)
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+
+        self.half_tile_width = isometric_map.tile_width // 2
+        self.half_tile_height = isometric_map.tile_height // 2
+
+        # (cx, cy) -> (surface, rect relative to the map origin), or None if the chunk has no tiles at all.
+        self.chunks = collections.OrderedDict()
+
+        for layer in self.layers:
+            layer.observers.add(self)
+
+        # Goes up every time a chunk gets dropped, so that chunks baked elsewhere from older cells can be told apart.
+        self.generation = 0
+        self.clear_count = 0
+
+    def cell_changed(self, layer, x, y):
+        self.chunks.pop((x // self.chunk_size, y // self.chunk_size), None)
+        self.generation += 1
+
+    def layer_changed(self, layer):
+        self.clear()
+
+    def clear(self):
+        self.chunks.clear()
+        self.generation += 1
+        self.clear_count += 1
+
+    def _get_chunk_tiles(self, cx, cy):
+        # Returns a list of (surface, rect) for every tile in this chunk in the order that the viewer would draw them.
+        # Rects are relative to the map origin, as if the view offset were 0,0.
+        x0 = cx * self.chunk_size
+        y0 = cy * self.chunk_size
+        return [(surf, pygame.Rect(dest, surf.get_size())) for surf, dest in get_terrain_blits(
+            self.isometric_map, self.layers, x0, y0, x0 + self.chunk_size - 1, y0 + self.chunk_size - 1,
+            line_lags=self.line_lags
+        )]
+
+    @staticmethod
+    def bake_tiles(mytiles):
+        # Composites a list of tiles from _get_chunk_tiles into one chunk. This only touches the tile surfaces, so it
+        # can run on another thread.
+        if not mytiles:
+            return None
+        myrect = mytiles[0][1].unionall([r for s, r in mytiles])
+        mysurf = pygame.Surface(myrect.size, pygame.SRCALPHA)
+        mysurf.blits([(surf, dest.move(-myrect.x, -myrect.y)) for surf, dest in mytiles], doreturn=False)
+        return mysurf, myrect
+
+    def _bake(self, cx, cy):
+        return self.bake_tiles(self._get_chunk_tiles(cx, cy))
+
+    def add_chunk(self, key, mychunk):
+        self.chunks[key] = mychunk
+        self.chunks.move_to_end(key)
+        while len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+
+    def get_chunk(self, cx, cy):
+        key = (cx, cy)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        mychunk = self._bake(cx, cy)
+        self.add_chunk(key, mychunk)
+        return mychunk
+
+    def get_chunk_range(self, view, area):
+        """Return cx0, cy0, cx1, cy1, the range of chunks that may draw inside area using the view's current offsets."""
+        mymap = self.isometric_map
+        x0, y0, x1, y1 = view.projection.rect_to_map_bounds(area, view.x_off, view.y_off)
+        cx0 = max(x0 // self.chunk_size - 1, 0)
+        cy0 = max(y0 // self.chunk_size - 1, 0)
+        cx1 = min(x1 // self.chunk_size + 1, (mymap.width - 1) // self.chunk_size)
+        cy1 = min(y1 // self.chunk_size + 1, (mymap.height - 1) // self.chunk_size)
+        return cx0, cy0, cx1, cy1
+
+    def draw(self, view, dest_surface, area):
+        """Blit every chunk that intersects area (in screen coordinates) using the view's current offsets."""
+        cx0, cy0, cx1, cy1 = self.get_chunk_range(view, area)
+
+        # Chunks further down the screen get drawn later, just like tiles.
+        for line in range(cx0 + cy0, cx1 + cy1 + 1):
+            for cx in range(max(cx0, line - cy1), min(cx1, line - cy0) + 1):
+                mychunk = self.get_chunk(cx, line - cx)
+                if mychunk:
+                    surf, myrect = mychunk
+                    mydest = myrect.move(view.x_off, view.y_off)
+                    if mydest.colliderect(area):
+                        dest_surface.blit(surf, mydest, special_flags=pygame.BLEND_PREMULTIPLIED)
+
+
+class TerrainPrefetcher(object):
+    """Bakes the chunks of a TerrainChunkCache that the camera is heading toward before they scroll into view.
+
+    Every frame, the area the screen is going to cover lookahead frames from now at the camera's current velocity
+    gets checked for chunks that haven't been baked yet. Working out which tiles go in a chunk touches the map and the
+    tile lookups, so that happens on the calling thread, for at most frame_budget seconds per frame. Compositing the
+    tiles happens on a worker thread, from SurfaceCopies of the tiles. pygame 2.6 holds the GIL while blitting, so the
+    worker takes turns with the main thread instead of running alongside it; what it buys is that the baking gets
+    spread over the frames before a chunk is needed instead of landing on the frame that needs it. At most max_pending
+    chunks are in flight at once, and at most max_ahead chunks outside the screen get baked ahead, which keeps the
+    prefetched chunks from pushing the ones on screen out of the cache.
+
+    Clearing the terrain cache, which is what to do after changing tile images in place, drops the copies too.
+    """
+
+    def __init__(self, terrain_cache, lookahead=20, frame_budget=0.002, max_pending=4, max_ahead=None):
+        self.terrain_cache = terrain_cache
+        self.lookahead = lookahead
+        self.frame_budget = frame_budget
+        self.max_pending = max_pending
+        if max_ahead is None:
+            max_ahead = terrain_cache.max_chunks // 4
+        self.max_ahead = max_ahead
+
+        # (cx, cy) -> (cache generation when the tiles were gathered, future)
+        self._pending = dict()
+        self._executor = None
+        self._surfaces = SurfaceCopies()
+        self._clear_count = terrain_cache.clear_count
+
+    def _get_executor(self):
+        if not self._executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        return self._executor
+
+    def shutdown(self):
+        """Stop the worker thread. Chunks still in flight get thrown away."""
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._pending.clear()
+
+    def collect(self):
+        """Move the chunks that the worker has finished into the terrain cache."""
+        mycache = self.terrain_cache
+        for key, (generation, future) in list(self._pending.items()):
+            if future.done():
+                del self._pending[key]
+                # If a cell changed since the tiles were gathered, the chunk may be out of date.
+                if generation == mycache.generation and key not in mycache.chunks:
+                    mycache.add_chunk(key, future.result())
+
+    def get_wanted_chunks(self, view, area, velocity):
+        """Return the keys of the chunks that the camera will reach within lookahead frames and that haven't been
+        baked, nearest first. velocity is the change in the view offsets per frame."""
+        mycache = self.terrain_cache
+        dx, dy = int(velocity[0] * self.lookahead), int(velocity[1] * self.lookahead)
+        if not (dx or dy):
+            return []
+        # The view offsets going up means the map moves right and down, so the screen is heading left and up.
+        cx0, cy0, cx1, cy1 = mycache.get_chunk_range(view, area.union(area.move(-dx, -dy)))
+        vx0, vy0, vx1, vy1 = mycache.get_chunk_range(view, area)
+        mid_x, mid_y = area.center
+        half_size = mycache.chunk_size / 2
+        mykeys = list()
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                if vx0 <= cx <= vx1 and vy0 <= cy <= vy1:
+                    continue
+                sx, sy = view.screen_coords(cx * mycache.chunk_size + half_size, cy * mycache.chunk_size + half_size)
+                mykeys.append(((sx - mid_x) ** 2 + (sy - mid_y) ** 2, (cx, cy)))
+        mykeys.sort()
+        return [key for d, key in mykeys[:self.max_ahead] if key not in mycache.chunks and key not in self._pending]
+
+    def update(self, view, area, velocity):
+        """Collect the finished chunks and send the next ones the camera is heading toward to the worker."""
+        self.collect()
+        if len(self._pending) >= self.max_pending:
+            return
+        mycache = self.terrain_cache
+        if self._clear_count != mycache.clear_count:
+            self._surfaces.clear()
+            self._clear_count = mycache.clear_count
+        t0 = time.perf_counter()
+        for key in self.get_wanted_chunks(view, area, velocity):
+            mytiles = [(self._surfaces.get_copy(surf), dest) for surf, dest in mycache._get_chunk_tiles(*key)]
+            if mytiles:
+                self._pending[key] = (mycache.generation, self._get_executor().submit(mycache.bake_tiles, mytiles))
+            else:
+                mycache.add_chunk(key, None)
+            if len(self._pending) >= self.max_pending or time.perf_counter() - t0 >= self.frame_budget:
+                break
+
+
+class OcclusionIndex(object):
+    """Records, for every cell of a map, the first layer whose tile there can be seen.
+
+    A tile is hidden when a tile on a later layer of the same cell is fully opaque everywhere the lower tile has
+    visible pixels, taking the layer offsets into account. The later tile always gets drawn over the lower one, so
+    skipping the lower tile changes nothing on the screen. For each cell, the index holds the highest layer whose
+    tile hides every tile below it; the viewer skips the layers under that one.
+    """
+
+    def __init__(self, isometric_map):
+        self.isometric_map = isometric_map
+        self.layers = list(isometric_map.layers)
+        self.width = isometric_map.width
+        self.height = isometric_map.height
+        self.tile_lookup = isometric_map.get_tile_lookup()
+
+        # gid: (mask of visible pixels, mask of fully opaque pixels, dx, dy)
+        self._masks = dict()
+        # (lower gid, upper gid, x offset, y offset): whether the upper tile hides the lower one
+        self._covers = dict()
+
+        self.first_visible = array.array('H', bytes(2 * self.width * self.height))
+        self.rebuild()
+
+        for layer in self.layers:
+            layer.observers.add(self)
+
+    def _get_masks(self, gid):
+        masks = self._masks.get(gid)
+        if masks is None:
+            surf, dx, dy = self.tile_lookup[gid]
+            colorkey_mask = pygame.mask.from_surface(surf)
+            alpha_surf = surf.copy()
+            alpha_surf.set_colorkey(None)
+            visible = colorkey_mask.overlap_mask(pygame.mask.from_surface(alpha_surf, 0), (0, 0))
+            opaque = colorkey_mask.overlap_mask(pygame.mask.from_surface(alpha_surf, 254), (0, 0))
+            masks = (visible, opaque, dx, dy)
+            self._masks[gid] = masks
+        return masks
+
+    def covers(self, lower_gid, upper_gid, offsetx=0, offsety=0):
+        """Return True if the tile upper_gid, drawn offsetx,offsety from lower_gid, hides it completely."""
+        key = (lower_gid, upper_gid, offsetx, offsety)
+        result = self._covers.get(key)
+        if result is None:
+            if not self.tile_lookup[upper_gid]:
+                result = False
+            elif not self.tile_lookup[lower_gid]:
+                result = True
+            else:
+                lower, dummy, ldx, ldy = self._get_masks(lower_gid)
+                dummy, upper, udx, udy = self._get_masks(upper_gid)
+                result = lower.overlap_area(upper, (udx + offsetx - ldx, udy + offsety - ldy)) == lower.count()
+            self._covers[key] = result
+        return result
+
+    def _get_first_visible(self, gids):
+        # gids is the list of gids in one cell, one per layer.
+        for upper in range(len(gids) - 1, 0, -1):
+            if self.tile_lookup[gids[upper]]:
+                upper_layer = self.layers[upper]
+                if all(self.covers(gids[lower], gids[upper], upper_layer.offsetx - self.layers[lower].offsetx,
+                                   upper_layer.offsety - self.layers[lower].offsety) for lower in range(upper)):
+                    return upper
+        return 0
+
+    def rebuild(self):
+        if not self.layers:
+            return
+        results = map_cell_stacks(self.layers, self._get_first_visible, numpy.uint16)
+        self.first_visible = array.array('H', results.tobytes())
+
+    def cell_changed(self, layer, x, y):
+        self.first_visible[y * self.width + x] = self._get_first_visible([l[x, y] for l in self.layers])
+
+    def layer_changed(self, layer):
+        self.rebuild()
+
+    def get_first_visible_layer(self, x, y):
+        """Return the index of the lowest layer that can be seen in cell x,y."""
+        return self.first_visible[y * self.width + x]
+
+
+class ObjectDrawList(object):
+    """The objects of an ObjectGroup in the order the viewer draws them, kept up to date as they move.
+
+    The viewer draws objects a line at a time, after the terrain of the cell their midbottom lands in, and by depth
+    within a cell. The list is sorted on (line, x, depth), so the objects for any stretch of a line are a slice of it.
+    Objects that move, arrive or leave get re-inserted by bisection the next time update is called, so keeping the
+    list sorted costs in proportion to the number of objects that changed rather than the size of the group.
+    """
+
+    def __init__(self, group, layer, projection, zoom=1):
+        self.group = group
+        self.projection = projection
+        self.extra_x = get_zoomed_size(layer.offsetx + group.offsetx, zoom)
+        self.extra_y = get_zoomed_size(layer.offsety + group.offsety, zoom)
+
+        # Parallel lists, sorted on keys. Each key is (line, x, depth, serial number) and each entry is (object,
+        # relative x, relative y), where the relative coordinates are the object's screen coordinates without the
+        # view or group offsets.
+        self.keys = list()
+        self.entries = list()
+        self._keys_by_object = dict()
+        self._next_serial = 0
+
+        self._pending = set()
+        self._rebuild_needed = True
+        group.observers.add(self)
+
+    def object_moved(self, group, ob):
+        self._pending.add(ob)
+
+    def object_removed(self, group, ob):
+        self._pending.add(ob)
+
+    def contents_changed(self, group):
+        self._rebuild_needed = True
+
+    def _get_serial(self, ob):
+        key = self._keys_by_object.get(ob)
+        if key:
+            return key[3]
+        self._next_serial += 1
+        return self._next_serial
+
+    def _make_entries(self, obs):
+        # Returns a list of (key, entry) for each of obs.
+        if not obs:
+            return []
+        half_tile_width = self.projection.half_tile_width
+        half_tile_height = self.projection.half_tile_height
+        # These match IsometricMapViewer.screen_coords and _model_depth exactly, so objects land on the same pixels.
+        rxs = [(ob.x - 1) * half_tile_width - (ob.y - 1) * half_tile_width for ob in obs]
+        rys = [(ob.y - 1) * half_tile_height + (ob.x - 1) * half_tile_height for ob in obs]
+        depths = [ob.y * half_tile_height + ob.x * half_tile_height for ob in obs]
+        mxs, mys = self.projection.map_coords(numpy.array(rxs) + self.extra_x, numpy.array(rys) + self.extra_y)
+        return [((mx + my, mx, depth, self._get_serial(ob)), (ob, rx, ry))
+                for ob, rx, ry, depth, mx, my in zip(obs, rxs, rys, depths, mxs.tolist(), mys.tolist())]
+
+    def _remove(self, ob):
+        key = self._keys_by_object.pop(ob, None)
+        if key:
+            i = bisect.bisect_left(self.keys, key)
+            del self.keys[i]
+            del self.entries[i]
+
+    def update(self):
+        """Bring the list up to date with the objects that have changed since the last update."""
+        if self._rebuild_needed:
+            mylist = sorted(self._make_entries(list(self.group.contents)))
+            self.keys = [key for key, entry in mylist]
+            self.entries = [entry for key, entry in mylist]
+            self._keys_by_object = {entry[0]: key for key, entry in mylist}
+            self._rebuild_needed = False
+        elif self._pending:
+            # Objects that have been removed from the group get dropped; the rest go back in at their new places.
+            obs = [ob for ob in self._pending if self.group in ob.__dict__.get("_groups", ())]
+            mykeys = self._make_entries(obs)
+            for ob in self._pending:
+                self._remove(ob)
+            for key, entry in mykeys:
+                i = bisect.bisect_left(self.keys, key)
+                self.keys.insert(i, key)
+                self.entries.insert(i, entry)
+                self._keys_by_object[entry[0]] = key
+        self._pending.clear()
+
+    def get_line(self, line, x0, x1):
+        """Return the (object, relative x, relative y) entries for the cells of line from x0 to x1 inclusive, in
+           drawing order."""
+        return self.entries[bisect.bisect_left(self.keys, (line, x0)):bisect.bisect_left(self.keys, (line, x1 + 1))]
+
+
+class TileOverlay(object):
+    """Surfaces drawn over the cells of one layer, such as movement range highlights or path previews.
+
+    Each cell holds one surface, drawn with its midbottom on the bottom point of the cell plus the layer offsets, just
+    like a tile. The viewer draws an overlay one line at a time, right after the layer's tiles on that line, and only
+    looks at the cells the overlay occupies on that line. Add overlays to the view with IsometricMapViewer.add_overlay;
+    an overlay only gets drawn while the view shows the map its layer belongs to.
+    """
+
+    def __init__(self, layer, visible=True):
+        self.layer = layer
+        self.visible = visible
+        # (x, y) -> surface
+        self.cells = dict()
+        # x + y -> sorted list of the x of every cell in that line
+        self._lines = dict()
+        # Anything with an overlay_changed(overlay, cells) method, where cells is a list of (x, y, surface) for the
+        # surfaces that were added or removed.
+        self.observers = weakref.WeakSet()
+
+    def __getstate__(self):
+        # Like layers, copies start out without observers.
+        state = self.__dict__.copy()
+        del state["observers"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.observers = weakref.WeakSet()
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, pos):
+        return pos in self.cells
+
+    def __getitem__(self, pos):
+        return self.cells[pos]
+
+    def __setitem__(self, pos, surf):
+        self.set_cells([pos], surf)
+
+    def __delitem__(self, pos):
+        self.remove_cells([pos])
+
+    def _notify(self, changes):
+        if changes:
+            for observer in self.observers:
+                observer.overlay_changed(self, changes)
+
+    def set_cells(self, cells, surf):
+        """Put surf on every x,y in cells."""
+        changes = list()
+        for x, y in cells:
+            old_surf = self.cells.get((x, y))
+            if old_surf is surf:
+                continue
+            if old_surf is None:
+                bisect.insort(self._lines.setdefault(x + y, list()), x)
+            else:
+                changes.append((x, y, old_surf))
+            self.cells[(x, y)] = surf
+            changes.append((x, y, surf))
+        self._notify(changes)
+
+    def remove_cells(self, cells):
+        """Remove the surfaces from every x,y in cells that has one."""
+        changes = list()
+        for x, y in cells:
+            old_surf = self.cells.pop((x, y), None)
+            if old_surf is not None:
+                xs = self._lines[x + y]
+                del xs[bisect.bisect_left(xs, x)]
+                if not xs:
+                    del self._lines[x + y]
+                changes.append((x, y, old_surf))
+        self._notify(changes)
+
+    def clear(self):
+        self.remove_cells(list(self.cells))
+
+    def get_line(self, line, x0, x1):
+        """Return a list of (x, y, surface) for the cells with x + y == line and x0 <= x <= x1."""
+        xs = self._lines.get(line)
+        if not xs:
+            return []
+        return [(x, line - x, self.cells[(x, line - x)])
+                for x in xs[bisect.bisect_left(xs, x0):bisect.bisect_right(xs, x1)]]
+
+
+class RenderStats(object):
+    """Timings and counters for the frames drawn by an IsometricMapViewer, kept for a rolling window of frames.
+
+    Timings are in milliseconds. Tile blits are batched, so the time spent blitting shows up under terrain.
+    """
+    TIMINGS = ("frame", "bucketing", "terrain", "objects", "cursor", "prefetch", "postfx")
+    COUNTERS = ("tiles_visited", "tiles_drawn", "cells_skipped", "objects_drawn")
+
+    def __init__(self, window=300):
+        self.window = window
+        self.history = {name: collections.deque(maxlen=window) for name in self.TIMINGS + self.COUNTERS}
+        self.current = dict.fromkeys(self.TIMINGS + self.COUNTERS, 0)
+        self._font = None
+
+    def start_frame(self):
+        for name in self.current:
+            self.current[name] = 0
+
+    def end_frame(self):
+        for name, value in self.current.items():
+            self.history[name].append(value)
+
+    def add(self, name, value):
+        self.current[name] += value
+
+    def add_time(self, name, t0):
+        # Adds the time since t0, a time.perf_counter() value.
+        self.current[name] += (time.perf_counter() - t0) * 1000.0
+
+    def get_summary(self, name):
+        """Return a dict with the last, min, mean, p95 and p99 values of name over the window."""
+        values = numpy.array(self.history[name], dtype=float)
+        if not len(values):
+            return dict(last=0.0, min=0.0, mean=0.0, p95=0.0, p99=0.0)
+        return dict(
+            last=float(values[-1]), min=float(values.min()), mean=float(values.mean()),
+            p95=float(numpy.percentile(values, 95)), p99=float(numpy.percentile(values, 99))
+        )
+
+    def get_report(self):
+        """Return a dict of name: summary for every timing and counter."""
+        return {name: self.get_summary(name) for name in self.TIMINGS + self.COUNTERS}
+
+    def draw(self, dest_surface, x=4, y=4):
+        """Draw the report as a table in the top left corner of dest_surface. Returns the rect drawn in."""
+        if not self._font:
+            self._font = pygame.font.Font(None, 16)
+        rows = [("", "mean", "min", "p95", "p99")]
+        for name, summary in self.get_report().items():
+            rows.append((name,) + tuple("{:.1f}".format(summary[k]) for k in ("mean", "min", "p95", "p99")))
+        # The name column is left aligned, the number columns right aligned.
+        line_height = self._font.get_linesize()
+        myrect = pygame.Rect(x, y, 110 + 4 * 50 + 8, len(rows) * line_height + 8)
+        dest_surface.fill((0, 0, 0), myrect)
+        myblits = list()
+        for i, row in enumerate(rows):
+            row_y = y + 4 + i * line_height
+            for j, text in enumerate(row):
+                img = self._font.render(text, True, (255, 255, 255))
+                if j == 0:
+                    myblits.append((img, (x + 4, row_y)))
+                else:
+                    myblits.append((img, (x + 4 + 110 + j * 50 - img.get_width(), row_y)))
+        dest_surface.blits(myblits, doreturn=False)
+        return myrect
+
+
+class Minimap(object):
+    """A picture of a whole map, small enough to draw in a corner of the screen.
+
+    Every cell is a cell_width x cell_height brick, colored like the topmost tile in it (see
+    IsometricMap.get_tile_colors). Each line of cells is offset by half a brick from the one before, so the picture
+    has the same diamond shape as the map on the screen. The picture gets built once and then patched a cell at a
+    time as the layers change, so drawing it costs one blit plus a dot for each object.
+    """
+
+    def __init__(self, isometric_map, cell_width=4, cell_height=1, dot_color=(255, 255, 255), dot_size=3):
+        self.isometric_map = isometric_map
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        # Objects can have a minimap_color attribute to be drawn in some other color.
+        self.dot_color = dot_color
+        self.dot_size = dot_size
+        self.tile_colors = isometric_map.get_tile_colors()
+        self.surface = pygame.Surface(((isometric_map.width + isometric_map.height) * cell_width // 2,
+                                       (isometric_map.width + isometric_map.height - 1) * cell_height),
+                                      pygame.SRCALPHA)
+        self.rebuild()
+        for layer in isometric_map.layers:
+            layer.observers.add(self)
+
+    def _get_color(self, gids):
+        # gids is the list of gids in one cell, one per layer.
+        for gid in reversed(gids):
+            color = self.tile_colors[gid]
+            if color:
+                return color
+
+    def _get_rgba(self, gids):
+        color = self._get_color(gids)
+        return color + (255,) if color else (0, 0, 0, 0)
+
+    def get_cell_rect(self, x, y):
+        """Return the rect of cell x,y on the minimap."""
+        return pygame.Rect((x - y + self.isometric_map.height - 1) * self.cell_width // 2, (x + y) * self.cell_height,
+                           self.cell_width, self.cell_height)
+
+    def get_minimap_pos(self, x, y):
+        """Return the position on the minimap of map position x,y, which can be floats."""
+        return ((x - y + self.isometric_map.height) * self.cell_width / 2,
+                (x + y + 1.5) * self.cell_height)
+
+    def get_map_pos(self, px, py):
+        """Return the map position of point px,py on the minimap. The inverse of get_minimap_pos."""
+        a = 2 * px / self.cell_width - self.isometric_map.height
+        b = py / self.cell_height - 1.5
+        return (a + b) / 2, (b - a) / 2
+
+    def rebuild(self):
+        mymap = self.isometric_map
+        if not mymap.layers:
+            return
+        cell_rgba = map_cell_stacks(mymap.layers, self._get_rgba, numpy.uint8)
+
+        ys, xs = numpy.divmod(numpy.arange(mymap.width * mymap.height), mymap.width)
+        pxs = (xs - ys + mymap.height - 1) * self.cell_width // 2
+        pys = (xs + ys) * self.cell_height
+        mypixels = numpy.zeros(self.surface.get_size() + (4,), dtype=numpy.uint8)
+        for dx in range(self.cell_width):
+            for dy in range(self.cell_height):
+                mypixels[pxs + dx, pys + dy] = cell_rgba
+        pixels = pygame.surfarray.pixels3d(self.surface)
+        pixels[...] = mypixels[..., :3]
+        del pixels
+        alpha = pygame.surfarray.pixels_alpha(self.surface)
+        alpha[...] = mypixels[..., 3]
+        del alpha
+
+    def cell_changed(self, layer, x, y):
+        color = self._get_color([l[x, y] for l in self.isometric_map.layers])
+        self.surface.fill(color or (0, 0, 0, 0), self.get_cell_rect(x, y))
+
+    def layer_changed(self, layer):
+        self.rebuild()
+
+    def draw(self, dest_surface, x=0, y=0, view=None):
+        """Draw the minimap with its top left corner at x,y on dest_surface, with a dot for every object. If view is
+           given, the part of the map it shows gets outlined. Returns the rect drawn in."""
+        myrect = dest_surface.blit(self.surface, (x, y))
+        dot_offset = self.dot_size // 2
+        for group in self.isometric_map.objectgroups.values():
+            for ob in group.contents:
+                px, py = self.get_minimap_pos(ob.x, ob.y)
+                dest_surface.fill(getattr(ob, "minimap_color", self.dot_color),
+                                  (x + int(px) - dot_offset, y + int(py) - dot_offset, self.dot_size, self.dot_size))
+        if view:
+            # map_x,map_y give the position one cell past the one whose midbottom is at the screen point.
+            screen_rect = view.screen.get_rect()
+            points = list()
+            for sx, sy in (screen_rect.topleft, screen_rect.topright, screen_rect.bottomright, screen_rect.bottomleft):
+                px, py = self.get_minimap_pos(view.map_x(sx, sy, return_int=False) - 1,
+                                              view.map_y(sx, sy, return_int=False) - 1)
+                points.append((x + px, y + py))
+            pygame.draw.polygon(dest_surface, self.dot_color, points, 1)
+        return myrect
+
+
 class IsometricMapViewer(object):
     def __init__(self, isometric_map, screen, postfx=None, cursor=None,
-                 left_scroll_key=None, right_scroll_key=None, up_scroll_key=None, down_scroll_key=None):
+                 left_scroll_key=None, right_scroll_key=None, up_scroll_key=None, down_scroll_key=None,
+                 terrain_cache=False, chunk_size=16, scroll_buffer=False, dirty_rects=False, stats=False,
+                 occlusion_culling=False, sparse_layers=False, zoom=1.0, zoom_in_key=None, zoom_out_key=None,
+                 prefetch=False, cached_layers=None):
 
         self.isometric_map = isometric_map
         self.screen = screen
@@ -514,10 +2840,12 @@ class IsometricMapViewer(object):
         self.y_off = -200
         self.phase = 0
 
-        self.tile_width = isometric_map.tile_width
-        self.tile_height = isometric_map.tile_height
-        self.half_tile_width = isometric_map.tile_width // 2
-        self.half_tile_height = isometric_map.tile_height // 2
+        # The tile sizes and the coordinate transforms are all in screen pixels, so they get scaled by the zoom. Tiles
+        # get drawn from scaled copies kept by the map; see IsometricMap.get_zoomed_lookup. Objects that draw
+        # themselves instead of having a get_blits method can't be scaled, and terrain_cache is skipped when zoomed.
+        self.zoom = zoom
+        self._zoomed_surfaces = weakref.WeakKeyDictionary()
+        self._set_tile_size()
 
         # _mouse_tile contains the actual tile the mouse is hovering over. However, in most cases what we really want
         # is the location of the mouse cursor. Time to make a property!
@@ -531,6 +2859,8 @@ class IsometricMapViewer(object):
         self.right_scroll_key = right_scroll_key
         self.up_scroll_key = up_scroll_key
         self.down_scroll_key = down_scroll_key
+        self.zoom_in_key = zoom_in_key
+        self.zoom_out_key = zoom_out_key
 
         self.camera_updated_this_frame = False
 
@@ -538,6 +2868,73 @@ class IsometricMapViewer(object):
         self._focused_object_x0 = 0
         self._focused_object_y0 = 0
 
+        # If terrain_cache is True, the bottom layers of each map get pre-rendered in chunks instead of being drawn
+        # tile by tile every frame. See TerrainChunkCache. Unless cached_layers names the layers to pre-render, those
+        # are the layers that look no different when drawn underneath everything else: the bottom layers whose
+        # tiles all stay inside their cells. See IsometricMap.get_cacheable_layers. Maps with floor tiles taller
+        # than a cell, or floor layers with an offset, have none of those, so caching does nothing for them unless
+        # cached_layers names the floor layers. Then where a floor tile used to be drawn over the edge of a wall on
+        # the line behind it, the wall wins instead. On the shipped test map, caching the bottom layer that way
+        # changes at most a few hundred pixels a frame and draws a tenth of the tiles.
+        self.terrain_cache = terrain_cache
+        self.cached_layers = cached_layers
+        self.chunk_size = chunk_size
+        self._terrain_caches = weakref.WeakKeyDictionary()
+
+        # If prefetch is True as well, the chunks the camera is heading toward get baked on a worker thread before
+        # they come into view. See TerrainPrefetcher. camera_velocity is the smoothed change in the view offsets per
+        # frame, however the camera got moved.
+        self.prefetch = prefetch
+        self._prefetchers = weakref.WeakKeyDictionary()
+        self.camera_velocity = (0.0, 0.0)
+        self._last_camera_offset = None
+
+        # If occlusion_culling is True, tiles that are completely hidden by a tile on a later layer of the same cell
+        # get skipped. See OcclusionIndex.
+        self.occlusion_culling = occlusion_culling
+        self._occlusion_indices = weakref.WeakKeyDictionary()
+
+        # If sparse_layers is True, layers that are mostly empty get a sparse index (see
+        # IsometricLayer.build_sparse_index) and the viewer only visits their non-empty cells.
+        self.sparse_layers = sparse_layers
+        self._sparse_checked = weakref.WeakKeyDictionary()
+
+        # If scroll_buffer is True, the cached layers get drawn into an offscreen buffer which is kept between
+        # frames. When the camera moves, the buffer gets scrolled and only the strips that come into view are drawn.
+        # Like the terrain cache, this only saves any time when there are cached layers; see get_cached_layers.
+        self.scroll_buffer = scroll_buffer
+        self._terrain_buffer = None
+        self._terrain_buffer_offset = None
+        self._terrain_buffer_layers = None
+
+        # If dirty_rects is True and the camera hasn't moved, only the parts of the screen where objects, the cursor
+        # or map cells have changed get redrawn. The screen has to be kept between frames for this to work. Objects
+        # without a get_blits method, cursors without a get_rect method and postfx all force a full redraw, since
+        # there's no telling what they'll draw. Anything else can call mark_dirty.
+        self.dirty_rects = dirty_rects
+        self._last_frame = None
+        self._object_blits = dict()
+        self._cursor_rect = None
+        self._pending_rects = list()
+        # The height of the tallest object seen since the map or the zoom last changed, or None if it has to be
+        # measured again. See get_max_object_height.
+        self._max_object_height = None
+
+        # If stats is True, every frame gets timed and counted in a RenderStats. If show_stats is also True, the
+        # report gets drawn over the map.
+        self.stats = RenderStats() if stats else None
+        self.show_stats = False
+
+        # The TileOverlays to draw, in order. See add_overlay.
+        self.overlays = list()
+
+        # The ObjectDrawList of each objectgroup that has been drawn.
+        self._draw_lists = weakref.WeakKeyDictionary()
+
+        # The (surface, dest) pairs waiting to be drawn. Anything that draws on the screen directly has to call
+        # _flush_blits first, so that the painter's order is kept.
+        self._blit_buffer = list()
+
         #self.debug_sprite = image.Image("assets/floor-tile.png")
 
     def set_focused_object(self, fo):
@@ -550,12 +2947,441 @@ class IsometricMapViewer(object):
 
     def switch_map(self, isometric_map):
         self.isometric_map = isometric_map
-        self.tile_width = isometric_map.tile_width
-        self.tile_height = isometric_map.tile_height
-        self.half_tile_width = isometric_map.tile_width // 2
-        self.half_tile_height = isometric_map.tile_height // 2
+        self._set_tile_size()
+        self._terrain_buffer_offset = None
+        self._last_camera_offset = None
+        self._max_object_height = None
         self._check_origin()
 
+    def _set_tile_size(self):
+        self.tile_width = get_zoomed_size(self.isometric_map.tile_width, self.zoom)
+        self.tile_height = get_zoomed_size(self.isometric_map.tile_height, self.zoom)
+        self.half_tile_width = self.tile_width // 2
+        self.half_tile_height = self.tile_height // 2
+        self.projection = IsometricProjection(self.tile_width, self.tile_height)
+
+    def set_zoom(self, zoom):
+        """Change the zoom level, keeping the map position in the middle of the screen where it is."""
+        if zoom == self.zoom:
+            return
+        # Relative coordinates are proportional to the tile size, so scaling the middle of the screen's relative
+        # position keeps it on the same map position.
+        sx, sy = self.screen.get_width() // 2, self.screen.get_height() // 2
+        rx, ry = sx - self.x_off, sy - self.y_off
+        old_half_tile_width, old_half_tile_height = self.half_tile_width, self.half_tile_height
+        self.zoom = zoom
+        self._set_tile_size()
+        self.x_off = sx - rx * self.half_tile_width // old_half_tile_width
+        self.y_off = sy - ry * self.half_tile_height // old_half_tile_height
+        self._terrain_buffer_offset = None
+        self._last_camera_offset = None
+        self._max_object_height = None
+        self.mark_dirty()
+
+    def zoom_in(self):
+        """Step up to the next of ZOOM_LEVELS."""
+        self.set_zoom(min([z for z in ZOOM_LEVELS if z > self.zoom], default=self.zoom))
+
+    def zoom_out(self):
+        """Step down to the next of ZOOM_LEVELS."""
+        self.set_zoom(max([z for z in ZOOM_LEVELS if z < self.zoom], default=self.zoom))
+
+    def zoomed(self, size):
+        """Return a size, offset or distance in unzoomed pixels, such as a layer offset, scaled to the zoom level."""
+        return get_zoomed_size(size, self.zoom)
+
+    def get_zoomed_surface(self, surf):
+        """Return surf scaled to the zoom level. The scaled copy is kept for as long as surf is."""
+        if self.zoom == 1:
+            return surf
+        myzoom, mysurf = self._zoomed_surfaces.get(surf, (None, None))
+        if myzoom != self.zoom:
+            mysurf = scale_surface(surf, self.zoom, smooth=True)
+            self._zoomed_surfaces[surf] = (self.zoom, mysurf)
+        return mysurf
+
+    def _get_object_blits(self, ob, sx, sy):
+        # Returns the (surface, dest) pairs for drawing ob with its midbottom at sx,sy, scaled around that point to the
+        # zoom level, or None if ob draws itself.
+        get_blits = getattr(ob, "get_blits", None)
+        obblits = get_blits and get_blits(sx, sy, self.isometric_map)
+        if obblits is None or self.zoom == 1:
+            return obblits
+        myblits = list()
+        for surf, dest, *rest in obblits:
+            mydest = (sx + self.zoomed(dest[0] - sx), sy + self.zoomed(dest[1] - sy))
+            if rest and rest[0]:
+                area = pygame.Rect(rest[0])
+                rest[0] = pygame.Rect([self.zoomed(n) for n in area])
+            myblits.append((self.get_zoomed_surface(surf), mydest, *rest))
+        return myblits
+
+    def _note_object_blits(self, obblits):
+        # Returns the screen rect covered by an object's blits, or None if there are none, and keeps track of the
+        # tallest object so far.
+        obrects = [pygame.Rect(dest[0], dest[1], *surf.get_size()) for surf, dest, *rest in obblits]
+        obrect = obrects[0].unionall(obrects) if obrects else None
+        if obrect and obrect.h > self._max_object_height:
+            self._max_object_height = obrect.h
+        return obrect
+
+    def get_max_object_height(self):
+        """Return the height of the tallest object on the map, as far as the viewer knows. Objects get drawn from
+           their midbottom, so this is how far below an area the viewer has to look for objects that reach into it.
+           Every object gets measured after the map or the zoom changes; after that, objects only get measured when
+           they get drawn or come near the screen."""
+        if self._max_object_height is None:
+            self._max_object_height = 0
+            for k, v in self.isometric_map.objectgroups.items():
+                ox, oy = self.zoomed(k.offsetx + v.offsetx), self.zoomed(k.offsety + v.offsety)
+                for ob in v.contents:
+                    obblits = self._get_object_blits(ob, *self.screen_coords(ob.x, ob.y, ox, oy))
+                    if obblits:
+                        self._note_object_blits(obblits)
+        return self._max_object_height
+
+    def get_cached_layers(self):
+        """Return the layers of the current map that the terrain cache and the scroll buffer draw underneath
+           everything else: the first layers of the map that are in cached_layers, or if that's None, the map's
+           cacheable layers."""
+        mymap = self.isometric_map
+        if self.cached_layers is None:
+            mylist = mymap.get_cacheable_layers()
+        else:
+            mylist = list()
+            for layer in mymap.layers:
+                if layer not in self.cached_layers:
+                    break
+                mylist.append(layer)
+        # A baked stack of layers gets drawn whole or not at all, so the cached layers can't end in the middle of one.
+        for first_layer_num, last_layer_num in self._get_layer_spans(mymap.get_render_layers()):
+            if first_layer_num < len(mylist) <= last_layer_num:
+                del mylist[first_layer_num:]
+                break
+        return mylist
+
+    def get_terrain_cache(self):
+        # Returns the TerrainChunkCache for the current map, or None if terrain caching is off. The cache only holds
+        # unzoomed chunks.
+        if not self.terrain_cache or self.zoom != 1:
+            return None
+        mycache = self._terrain_caches.get(self.isometric_map)
+        cached_layers = self.get_cached_layers()
+        if not mycache or mycache.layers != cached_layers:
+            mycache = TerrainChunkCache(self.isometric_map, cached_layers, chunk_size=self.chunk_size)
+            self._terrain_caches[self.isometric_map] = mycache
+        return mycache
+
+    def get_prefetcher(self):
+        # Returns the TerrainPrefetcher for the current terrain cache, or None if prefetching is off. With no cached
+        # layers there's nothing to prefetch, so no prefetcher (and no worker thread) gets started.
+        mycache = self.get_terrain_cache() if self.prefetch else None
+        if not (mycache and mycache.layers):
+            return None
+        myprefetcher = self._prefetchers.get(mycache)
+        if not myprefetcher:
+            myprefetcher = TerrainPrefetcher(mycache)
+            self._prefetchers[mycache] = myprefetcher
+        return myprefetcher
+
+    def _update_camera_velocity(self):
+        # A jump, like switching maps, shouldn't count as motion, so those reset _last_camera_offset.
+        if self._last_camera_offset:
+            dx = self.x_off - self._last_camera_offset[0]
+            dy = self.y_off - self._last_camera_offset[1]
+            vx, vy = self.camera_velocity
+            self.camera_velocity = ((vx + dx) / 2, (vy + dy) / 2)
+        else:
+            self.camera_velocity = (0.0, 0.0)
+        self._last_camera_offset = (self.x_off, self.y_off)
+
+    def _get_sparse_indices(self):
+        # Returns a list with the sparse index of each layer to draw, or None for the layers that get walked cell by
+        # cell.
+        mymap = self.isometric_map
+        if not self.sparse_layers:
+            return [None] * len(mymap.get_render_layers())
+        if mymap not in self._sparse_checked:
+            # Infinite maps are left alone, since counting their cells would mean decoding all of them.
+            for layer in mymap.get_render_layers():
+                if layer.sparse_index is None and not isinstance(layer, ChunkedIsometricLayer) and\
+                        layer.count_nonempty() <= SPARSE_LAYER_DENSITY * len(layer):
+                    layer.build_sparse_index()
+            self._sparse_checked[mymap] = True
+        return [layer.sparse_index for layer in mymap.get_render_layers()]
+
+    def _get_sparse_line(self, sparse_index, line):
+        # Returns the cells of line that aren't empty in the layer.
+        x0, y0 = line[0]
+        x1 = line[-1][0]
+        diagonal = x0 + y0
+        xs = sparse_index.get(diagonal, ())
+        return [(x, diagonal - x) for x in xs[bisect.bisect_left(xs, x0):bisect.bisect_right(xs, x1)]]
+
+    def add_overlay(self, overlay):
+        """Draw overlay, a TileOverlay, over the map. Overlays added later get drawn on top."""
+        if overlay not in self.overlays:
+            self.overlays.append(overlay)
+            overlay.observers.add(self)
+            self.overlay_changed(overlay, [(x, y, surf) for (x, y), surf in overlay.cells.items()])
+
+    def remove_overlay(self, overlay):
+        if overlay in self.overlays:
+            self.overlays.remove(overlay)
+            overlay.observers.discard(self)
+            self.overlay_changed(overlay, [(x, y, surf) for (x, y), surf in overlay.cells.items()])
+
+    def overlay_changed(self, overlay, cells):
+        # Past a few dozen cells, merging the dirty rects would cost more than redrawing the screen.
+        if overlay.layer not in self.isometric_map.layers:
+            return
+        if len(cells) > 32:
+            self.mark_dirty()
+        else:
+            for x, y, surf in cells:
+                self.mark_dirty(pygame.Rect(self._get_overlay_blit(overlay, x, y, surf)[1]))
+
+    def _get_overlay_blit(self, overlay, x, y, surf):
+        # Returns the (surface, dest rect) for drawing surf on cell x,y of overlay.
+        sx, sy = self.screen_coords(x, y, self.zoomed(overlay.layer.offsetx), self.zoomed(overlay.layer.offsety))
+        mysurf = self.get_zoomed_surface(surf)
+        return mysurf, mysurf.get_rect(midbottom=(sx, sy))
+
+    def _get_layer_overlays(self, render_layers):
+        # Returns a list for each of render_layers of (split, overlay) for the overlays to draw on it, ordered by
+        # split, then with the cursor after the rest. split is the number of layers in the cell that go under the
+        # overlay: for a StackedLayer, the layers up to and including the overlay's own.
+        slots = dict()
+        for layer_num, layer in enumerate(render_layers):
+            members = layer.layers if isinstance(layer, StackedLayer) else [layer]
+            for n, member in enumerate(members):
+                slots[member] = (layer_num, n + 1)
+        layer_overlays = [list() for layer in render_layers]
+        myoverlays = [overlay for overlay in self.overlays if overlay.visible and overlay.cells]
+        if self.cursor:
+            myoverlays.append(self.cursor)
+        for overlay in myoverlays:
+            slot = slots.get(self._get_cursor_layer() if overlay is self.cursor else overlay.layer)
+            if slot:
+                layer_overlays[slot[0]].append((slot[1], overlay))
+        for mylist in layer_overlays:
+            mylist.sort(key=lambda item: item[0])
+        return layer_overlays
+
+    def _get_cursor_layer(self):
+        # Cursors with a get_layer method find their layer on each map themselves; older ones only have a layer_name.
+        get_layer = getattr(self.cursor, "get_layer", None)
+        if get_layer:
+            return get_layer(self.isometric_map)
+        return self.isometric_map.get_layer_by_name(self.cursor.layer_name)
+
+    def _get_line_overlays(self, overlays, line):
+        # Returns a dict of x,y -> list of (split, overlay, surface) for the overlay cells on line, in the order they
+        # get drawn. The cursor's surface is None, since it draws itself.
+        x0, y0 = line[0]
+        x1 = line[-1][0]
+        diagonal = x0 + y0
+        mycells = dict()
+        for split, overlay in overlays:
+            if overlay is self.cursor:
+                if overlay.x + overlay.y == diagonal and x0 <= overlay.x <= x1:
+                    mycells.setdefault((overlay.x, overlay.y), list()).append((split, overlay, None))
+            else:
+                for x, y, surf in overlay.get_line(diagonal, x0, x1):
+                    mycells.setdefault((x, y), list()).append((split, overlay, surf))
+        return mycells
+
+    def _get_layer_spans(self, render_layers):
+        # Returns the index in the map's layers of the first and last layer behind each of render_layers.
+        myspans = list()
+        n = 0
+        for layer in render_layers:
+            num_layers = len(layer.layers) if isinstance(layer, StackedLayer) else 1
+            myspans.append((n, n + num_layers - 1))
+            n += num_layers
+        return myspans
+
+    def _get_cell_blits(self, layers, x, y):
+        # Returns the (surface, dest) pairs for the tiles of cell x,y on layers.
+        mymap = self.isometric_map
+        tile_lookup = mymap.get_zoomed_lookup(mymap.get_tile_lookup(), self.zoom)
+        sx, sy = self.screen_coords(x, y)
+        myblits = list()
+        for layer in layers:
+            entry = tile_lookup[layer[x, y]]
+            if entry:
+                surf, dx, dy = entry
+                myblits.append((surf, (sx + dx, sy + self.zoomed(layer.offsety) + dy)))
+        return myblits
+
+    def get_draw_list(self, layer):
+        # Returns the ObjectDrawList for the objectgroup of layer, brought up to date.
+        group = self.isometric_map.objectgroups[layer]
+        mylist = self._draw_lists.get(group)
+        if not mylist or mylist.projection is not self.projection:
+            mylist = ObjectDrawList(group, layer, self.projection, self.zoom)
+            self._draw_lists[group] = mylist
+        mylist.update()
+        return mylist
+
+    def get_occlusion_index(self):
+        # Returns the OcclusionIndex for the current map, or None if occlusion culling is off.
+        if not self.occlusion_culling:
+            return None
+        myindex = self._occlusion_indices.get(self.isometric_map)
+        if not myindex:
+            myindex = OcclusionIndex(self.isometric_map)
+            self._occlusion_indices[self.isometric_map] = myindex
+        return myindex
+
+    def cell_changed(self, layer, x, y):
+        # The viewer watches the cached layers when it has a scroll buffer, and every layer when it uses dirty rects.
+        if self.scroll_buffer and layer in self.get_cached_layers():
+            self._terrain_buffer_offset = None
+        if self.dirty_rects and layer in self.isometric_map.layers:
+            tilesets = self.isometric_map.tileset_list
+            max_tile_width = max([self.zoomed(ts.tile_width) for ts in tilesets] + [self.tile_width])
+            max_tile_height = max([self.zoomed(ts.tile_height) for ts in tilesets] + [self.tile_height])
+            sx, sy = self.screen_coords(x, y, self.zoomed(layer.offsetx), self.zoomed(layer.offsety))
+            self.mark_dirty(pygame.Rect(sx - max_tile_width // 2, sy - max_tile_height, max_tile_width,
+                                        max_tile_height))
+
+    def layer_changed(self, layer):
+        self._terrain_buffer_offset = None
+        self.mark_dirty()
+
+    def mark_dirty(self, area=None):
+        """Make the next frame redraw area, a rect in screen coordinates. If area is None, redraw everything."""
+        if area is None:
+            self._last_frame = None
+        elif self._last_frame:
+            self._pending_rects.append(pygame.Rect(area))
+
+    def _get_dirty_rects(self, screen_area):
+        # Returns the list of screen rects that need to be redrawn, or None if the whole screen does.
+        this_frame = (self.isometric_map, self.x_off, self.y_off, self.zoom, screen_area.size)
+        full_redraw = self._last_frame != this_frame or self.postfx
+        self._last_frame = this_frame
+        myrects = self._pending_rects
+        self._pending_rects = list()
+
+        if self.cursor:
+            get_rect = getattr(self.cursor, "get_rect", None)
+            cursor_rect = get_rect(self) if get_rect else None
+            if not get_rect:
+                full_redraw = True
+            elif cursor_rect != self._cursor_rect:
+                myrects += [r for r in (cursor_rect, self._cursor_rect) if r]
+            self._cursor_rect = cursor_rect
+
+        # Work out where every object near the screen is going to be drawn, and compare that to the last frame.
+        # Objects get drawn from their midbottom, so one standing below the screen can reach up into it by as much as
+        # the tallest object. Look that far down, and further whenever a taller object turns up.
+        object_blits = dict()
+        for k, v in self.isometric_map.objectgroups.items():
+            ox, oy = self.zoomed(k.offsetx + v.offsetx), self.zoomed(k.offsety + v.offsety)
+            margin = None
+            while margin != self.get_max_object_height():
+                margin = self.get_max_object_height()
+                search_area = screen_area.inflate(self.tile_width, self.tile_height)
+                search_area.h += margin
+                for ob in self.get_objects_in_area(v, search_area, ox, oy):
+                    if ob in object_blits:
+                        continue
+                    sx, sy = self.screen_coords(ob.x, ob.y, ox, oy)
+                    obblits = self._get_object_blits(ob, sx, sy)
+                    if obblits is None:
+                        full_redraw = True
+                        continue
+                    object_blits[ob] = (obblits, self._note_object_blits(obblits))
+        old_object_blits = self._object_blits
+        self._object_blits = object_blits
+
+        if full_redraw:
+            for layer in self.isometric_map.layers:
+                layer.observers.add(self)
+            return None
+
+        for ob in set(object_blits) | set(old_object_blits):
+            new_blits, new_rect = object_blits.get(ob, (None, None))
+            old_blits, old_rect = old_object_blits.get(ob, (None, None))
+            if new_blits != old_blits:
+                myrects += [r for r in (new_rect, old_rect) if r]
+
+        # Merge the rects that overlap, so that no part of the screen gets drawn twice.
+        merged = list()
+        for myrect in myrects:
+            myrect = myrect.clip(screen_area)
+            if not myrect:
+                continue
+            i = myrect.collidelist(merged)
+            while i >= 0:
+                myrect.union_ip(merged.pop(i))
+                i = myrect.collidelist(merged)
+            merged.append(myrect)
+        return merged
+
+    def _draw_static_terrain(self, dest_surface, area):
+        # Draws the cached layers of the map on dest_surface, touching only the area rect.
+        dest_surface.set_clip(area)
+        dest_surface.fill('black', area)
+        terrain_cache = self.get_terrain_cache()
+        if terrain_cache:
+            terrain_cache.draw(self, dest_surface, area)
+        else:
+            mymap = self.isometric_map
+            layers = self.get_cached_layers()
+            # Tiles stick out of their cells, so the cells just outside the area can still draw into it.
+            max_tile_height = max([self.zoomed(ts.tile_height) for ts in mymap.tileset_list] + [self.tile_height])
+            offsets = [self.zoomed(layer.offsety) for layer in layers] + [0]
+            margin = pygame.Rect(
+                area.left - self.tile_width,
+                area.top - self.tile_height - max(offsets),
+                area.width + 2 * self.tile_width,
+                area.height + 2 * self.tile_height + max_tile_height - min(offsets)
+            )
+            x0, y0, x1, y1 = self.projection.rect_to_map_bounds(margin, self.x_off, self.y_off)
+            dest_surface.blits(get_terrain_blits(mymap, layers, x0 - 1, y0 - 1, x1 + 1, y1 + 1,
+                                                 self.x_off, self.y_off, zoom=self.zoom), doreturn=False)
+        dest_surface.set_clip(None)
+
+    def _update_terrain_buffer(self, screen_area):
+        # Brings the scroll buffer up to date with the camera and returns it.
+        mybuffer = self._terrain_buffer
+        if not mybuffer or mybuffer.get_size() != screen_area.size:
+            mybuffer = pygame.Surface(screen_area.size, 0, self.screen)
+            self._terrain_buffer = mybuffer
+            self._terrain_buffer_offset = None
+
+        cached_layers = self.get_cached_layers()
+        if cached_layers != self._terrain_buffer_layers:
+            self._terrain_buffer_layers = cached_layers
+            self._terrain_buffer_offset = None
+
+        w, h = screen_area.size
+        if self._terrain_buffer_offset:
+            dx = self.x_off - self._terrain_buffer_offset[0]
+            dy = self.y_off - self._terrain_buffer_offset[1]
+        else:
+            dx, dy = w, h
+        if abs(dx) < w and abs(dy) < h:
+            if dx or dy:
+                mybuffer.scroll(dx, dy)
+                if dx > 0:
+                    self._draw_static_terrain(mybuffer, pygame.Rect(0, 0, dx, h))
+                elif dx < 0:
+                    self._draw_static_terrain(mybuffer, pygame.Rect(w + dx, 0, -dx, h))
+                if dy > 0:
+                    self._draw_static_terrain(mybuffer, pygame.Rect(0, 0, w, dy))
+                elif dy < 0:
+                    self._draw_static_terrain(mybuffer, pygame.Rect(0, h + dy, w, -dy))
+        else:
+            for layer in cached_layers:
+                layer.observers.add(self)
+            self._draw_static_terrain(mybuffer, mybuffer.get_rect())
+        self._terrain_buffer_offset = (self.x_off, self.y_off)
+        return mybuffer
+
     @property
     def mouse_tile(self):
         if self.cursor:
@@ -672,20 +3498,45 @@ class IsometricMapViewer(object):
             self.camera_updated_this_frame = True
 
     def _get_horizontal_line(self, x0, y0, line_number, visible_area):
-        mylist = list()
         x = x0 + line_number // 2
         y = y0 + (line_number + 1) // 2
 
         if self.relative_y(x, y) + self.y_off > visible_area.bottom:
             return None
 
-        while self.relative_x(x - 1, y - 1) + self.x_off < visible_area.right:
-            if self.isometric_map.on_the_map(x, y):
-                mylist.append((x, y))
-            x += 1
-            y -= 1
+        # Each step along the line moves two half tile widths to the right, like relative_x (for odd tile widths that
+        # isn't tile_width). Rather than walking the line cell by cell, work out how many steps fit before the right
+        # edge and which of those are on the map.
+        steps = -(-(visible_area.right - self.x_off - self.relative_x(x - 1, y - 1)) // (2 * self.half_tile_width))
+        first = max(0, -x, y - self.isometric_map.height + 1)
+        last = min(int(steps), self.isometric_map.width - x, y + 1)
+        return [(x + i, y - i) for i in range(first, last)]
+
+    def get_objects_in_area(self, objectgroup, area, extra_x_offset=0, extra_y_offset=0):
+        """Return the objects from objectgroup that may be drawn inside area, a rect in screen coordinates."""
+        x0, y0, x1, y1 = self.projection.rect_to_map_bounds(area, self.x_off + extra_x_offset,
+                                                            self.y_off + extra_y_offset)
+        # Objects get drawn from their midbottom, and the group offsets may push them into a neighbouring cell, so
+        # grab a margin of cells around the edges.
+        return objectgroup.objects_in_area(x0 - 2, y0 - 2, x1 + 2, y1 + 2)
+
+    def pick_objects(self, sx, sy):
+        """Return a list of the objects drawn in the map cell under screen coordinates sx,sy."""
+        mx, my = self.map_x(sx, sy), self.map_y(sx, sy)
+        mylist = list()
+        for k, v in self.isometric_map.objectgroups.items():
+            ox, oy = self.zoomed(k.offsetx + v.offsetx), self.zoomed(k.offsety + v.offsety)
+            for ob in self.get_objects_in_area(v, pygame.Rect(sx, sy, 1, 1), ox, oy):
+                obx, oby = self.screen_coords(ob.x, ob.y, ox, oy)
+                if (self.map_x(obx, oby), self.map_y(obx, oby)) == (mx, my):
+                    mylist.append(ob)
         return mylist
 
+    def _flush_blits(self):
+        if self._blit_buffer:
+            self.screen.blits(self._blit_buffer, doreturn=False)
+            self._blit_buffer.clear()
+
     def _model_depth(self, model):
         return self.relative_y(model.x, model.y)
 
@@ -725,11 +3576,14 @@ class IsometricMapViewer(object):
             self._update_camera(dx, dy)
 
     def __call__(self):
-        """Draws this mapview to the provided screen."""
+        """Draws this mapview to the provided screen. Returns a list of the screen rects that were redrawn."""
+        stats = self.stats
+        if stats:
+            stats.start_frame()
+            t_frame = time.perf_counter()
         screen_area = self.screen.get_rect()
         mouse_x, mouse_y = kengi.core.proj_to_vscreen(pygame.mouse.get_pos())
 
-        self.screen.fill('black')
         self.camera_updated_this_frame = False
         if self._focused_object and (self._focused_object_x0 != self._focused_object.x or
                                      self._focused_object_y0 != self._focused_object.y):
@@ -738,7 +3592,66 @@ class IsometricMapViewer(object):
             self._focused_object_y0 = self._focused_object.y
         else:
             self._check_mouse_scroll(screen_area, mouse_x, mouse_y)
-        x, y = self.map_x(0, 0) - 2, self.map_y(0, 0) - 1
+        self._update_camera_velocity()
+
+        if self.scroll_buffer:
+            self._update_terrain_buffer(screen_area)
+
+        dirty_rects = self._get_dirty_rects(screen_area) if self.dirty_rects else None
+        if dirty_rects is None:
+            if not self.scroll_buffer:
+                self.screen.fill('black')
+            self._draw_area(screen_area)
+            dirty_rects = [screen_area]
+        else:
+            # Tiles stick out of their cells, so walk the map over a bigger area, but only touch the dirty rect.
+            for myrect in dirty_rects:
+                self.screen.set_clip(myrect)
+                if not self.scroll_buffer:
+                    self.screen.fill('black', myrect)
+                self._draw_area(myrect.inflate(2 * self.tile_width, 2 * self.tile_height))
+            self.screen.set_clip(None)
+
+        #mx = self.map_x(mouse_x, mouse_y)
+        #my = self.map_y(mouse_x, mouse_y)
+        #if self.isometric_map.on_the_map(mx, my):
+        #    mydest = self.debug_sprite.bitmap.get_rect(midbottom=self.screen_coords(mx, my))
+        #    self.debug_sprite.render(mydest, 0)
+
+        prefetcher = self.get_prefetcher()
+        if prefetcher:
+            if stats:
+                t0 = time.perf_counter()
+            prefetcher.update(self, screen_area, self.camera_velocity)
+            if stats:
+                stats.add_time("prefetch", t0)
+
+        self.phase = (self.phase + 1) % 600
+        self._mouse_tile = (self.map_x(mouse_x, mouse_y), self.map_y(mouse_x, mouse_y))
+
+        if self.postfx:
+            if stats:
+                t0 = time.perf_counter()
+            self.postfx()
+            if stats:
+                stats.add_time("postfx", t0)
+
+        if stats:
+            stats.add_time("frame", t_frame)
+            stats.end_frame()
+            if self.show_stats:
+                stats_rect = stats.draw(self.screen)
+                if dirty_rects != [screen_area]:
+                    dirty_rects.append(stats_rect)
+
+        return dirty_rects
+
+    def _draw_area(self, area):
+        # Draws the part of the map that shows up in area, a rect in screen coordinates.
+        stats = self.stats
+        if stats:
+            t0 = time.perf_counter()
+        x, y = self.map_x(area.left, area.top) - 2, self.map_y(area.left, area.top) - 1
         x0, y0 = x, y
         keep_going = True
         line_number = 1
@@ -746,18 +3659,56 @@ class IsometricMapViewer(object):
 
         # The visible area describes the region of the map we need to draw. It is bigger than the physical screen
         # because we probably have to draw cells that are not fully on the map.
-        visible_area = self.screen.get_rect()
-        visible_area.inflate_ip(self.tile_width, self.isometric_map.tile_height)
-        visible_area.h += self.isometric_map.tile_height + self.half_tile_height - self.isometric_map.layers[-1].offsety
-
-        # Record all of the objectgroup contents for display when their tile comes up.
-        objectgroup_contents = dict()
-        for k, v in self.isometric_map.objectgroups.items():
-            objectgroup_contents[k] = collections.defaultdict(list)
-            for ob in v.contents:
-                sx, sy = self.screen_coords(ob.x, ob.y, k.offsetx + v.offsetx, k.offsety + v.offsety)
-                obkey = (self.map_x(sx, sy, return_int=True), self.map_y(sx, sy, return_int=True))
-                objectgroup_contents[k][obkey].append(ob)
+        visible_area = pygame.Rect(area)
+        visible_area.inflate_ip(self.tile_width, self.tile_height)
+        visible_area.h += self.tile_height + self.half_tile_height - self.zoomed(self.isometric_map.layers[-1].offsety)
+        # Objects get drawn from their midbottom, so one standing below the area can still reach up into it.
+        visible_area.h += self.get_max_object_height()
+
+        # The objectgroup contents get drawn when their tile comes up; the draw lists say which objects those are.
+        draw_lists = {k: self.get_draw_list(k) for k in self.isometric_map.objectgroups}
+
+        if stats:
+            stats.add_time("bucketing", t0)
+            t_terrain = time.perf_counter()
+            object_time = cursor_time = 0.0
+        tiles_visited = tiles_drawn = cells_skipped = objects_drawn = 0
+
+        # The bottom layers may have been pre-rendered; if so, blit them all now and skip them in the loop below.
+        terrain_cache = self.get_terrain_cache()
+        if self.scroll_buffer:
+            self.screen.blit(self._terrain_buffer, area, area)
+            num_cached_layers = len(self._terrain_buffer_layers)
+        elif terrain_cache:
+            terrain_cache.draw(self, self.screen, area)
+            num_cached_layers = len(terrain_cache.layers)
+        else:
+            num_cached_layers = 0
+
+        mymap = self.isometric_map
+        tile_lookup = mymap.get_zoomed_lookup(mymap.get_tile_lookup(), self.zoom)
+        myblits = self._blit_buffer
+        myblits.clear()
+
+        # If the map has been baked, StackedLayers take the place of the layers they merge. Layer numbers from the
+        # cached layers and the occlusion index refer to the map's layers, so each layer drawn has a span of them.
+        render_layers = self.isometric_map.get_render_layers()
+        layer_spans = self._get_layer_spans(render_layers)
+        layer_lookups = [mymap.get_zoomed_lookup(layer.tile_stacks, self.zoom) if isinstance(layer, StackedLayer)
+                         else tile_lookup for layer in render_layers]
+        layer_offsets = [self.zoomed(layer.offsety) for layer in render_layers]
+        layer_blend_flags = [pygame.BLEND_PREMULTIPLIED if isinstance(layer, StackedLayer) else 0
+                             for layer in render_layers]
+
+        # The overlays and the cursor get drawn after the tiles of their layer on each line.
+        cursor = self.cursor
+        layer_overlays = self._get_layer_overlays(render_layers)
+
+        sparse_indices = self._get_sparse_indices()
+        occlusion_index = self.get_occlusion_index()
+        if occlusion_index:
+            first_visible = occlusion_index.first_visible
+            map_width = occlusion_index.width
 
         while keep_going:
             # In order to allow smooth sub-tile movement of stuff, we have
@@ -767,35 +3718,98 @@ class IsometricMapViewer(object):
             current_y_offset = self.isometric_map.layers[0].offsety
             current_line = len(line_cache) - 1
 
-            for layer_num, layer in enumerate(self.isometric_map.layers):
+            for layer_num, layer in enumerate(render_layers):
                 if current_line >= 0:
                     if line_cache[current_line]:
-                        for x, y in line_cache[current_line]:
-                            gid = layer[x, y]
-                            tile_id = gid & NOT_ALL_FLAGS
-                            if tile_id > 0:
-                                my_tile = self.isometric_map.tilesets[tile_id]
-                                sx, sy = self.screen_coords(x, y)
-                                my_tile(self.screen, sx, sy + layer.offsety, gid & FLIPPED_HORIZONTALLY_FLAG,
-                                        gid & FLIPPED_VERTICALLY_FLAG)
-                            if self.cursor and self.cursor.layer_name == layer.name and x == self.cursor.x and y == self.cursor.y:
-                                self.cursor.render(self)
-
-                    if current_line > 1 and layer in objectgroup_contents and line_cache[current_line - 1]:
-                        # After drawing the terrain, draw any objects in the previous cell.
-                        for x, y in line_cache[current_line - 1]:
-
-                            if (x, y) in objectgroup_contents[layer]:
-                                objectgroup_contents[layer][(x, y)].sort(key=self._model_depth)
-                                for ob in objectgroup_contents[layer][(x, y)]:
-                                    sx, sy = self.screen_coords(
-                                        ob.x, ob.y,
-                                        layer.offsetx + self.isometric_map.objectgroups[layer].offsetx,
-                                        layer.offsety + self.isometric_map.objectgroups[layer].offsety
-                                    )
-                                    ob(self.screen, sx, sy, self.isometric_map)
-
-                    elif line_cache[current_line] is None and layer == self.isometric_map.layers[-1]:
+                        first_layer_num, last_layer_num = layer_spans[layer_num]
+                        draw_tiles = first_layer_num >= num_cached_layers
+                        mylookup = layer_lookups[layer_num]
+                        blend_flags = layer_blend_flags[layer_num]
+                        myline = line_cache[current_line]
+                        overlay_cells = split_cells = None
+                        if layer_overlays[layer_num]:
+                            overlay_cells = self._get_line_overlays(layer_overlays[layer_num], myline)
+                            # Where an overlay goes in between the layers of a stack, the viewer draws the whole
+                            # cell along with the overlays.
+                            if isinstance(layer, StackedLayer):
+                                split_cells = {pos for pos, items in overlay_cells.items()
+                                               if items[0][0] < len(layer.layers)}
+                        if draw_tiles:
+                            if sparse_indices[layer_num] is not None:
+                                # The sparse index leaves out the empty cells without looking at them.
+                                cells_skipped += len(myline)
+                                myline = self._get_sparse_line(sparse_indices[layer_num], myline)
+                                cells_skipped -= len(myline)
+                            tiles_visited += len(myline)
+                            if split_cells:
+                                myline = [pos for pos in myline if pos not in split_cells]
+                        else:
+                            myline = ()
+                        for x, y in myline:
+                            if not (occlusion_index and last_layer_num < first_visible[y * map_width + x]):
+                                entry = mylookup[layer[x, y]]
+                                if entry:
+                                    surf, dx, dy = entry
+                                    sx, sy = self.screen_coords(x, y)
+                                    mydest = (sx + dx, sy + layer_offsets[layer_num] + dy)
+                                    myblits.append((surf, mydest, None, blend_flags) if blend_flags else (surf, mydest))
+                                    tiles_drawn += 1
+                                else:
+                                    cells_skipped += 1
+                            else:
+                                cells_skipped += 1
+                        if overlay_cells:
+                            for (x, y), items in sorted(overlay_cells.items()):
+                                if (x, y) in (split_cells or ()):
+                                    visible = draw_tiles and not (occlusion_index and
+                                                                  last_layer_num < first_visible[y * map_width + x])
+                                    members = layer.layers if visible else []
+                                else:
+                                    members = []
+                                num_drawn = 0
+                                for split, overlay, surf in items:
+                                    cellblits = self._get_cell_blits(members[num_drawn:split], x, y)
+                                    myblits.extend(cellblits)
+                                    tiles_drawn += len(cellblits)
+                                    num_drawn = max(num_drawn, split)
+                                    if overlay is cursor:
+                                        self._flush_blits()
+                                        if stats:
+                                            t0 = time.perf_counter()
+                                        cursor.render(self)
+                                        if stats:
+                                            cursor_time += time.perf_counter() - t0
+                                    else:
+                                        myblits.append(self._get_overlay_blit(overlay, x, y, surf))
+                                cellblits = self._get_cell_blits(members[num_drawn:], x, y)
+                                myblits.extend(cellblits)
+                                tiles_drawn += len(cellblits)
+
+                    if current_line > 1 and layer in draw_lists and line_cache[current_line - 1]:
+                        # After drawing the terrain, draw any objects in the previous line.
+                        draw_list = draw_lists[layer]
+                        prev_line = line_cache[current_line - 1]
+                        for ob, rx, ry in draw_list.get_line(sum(prev_line[0]), prev_line[0][0], prev_line[-1][0]):
+                            sx = rx + self.x_off + draw_list.extra_x
+                            sy = ry + self.y_off + draw_list.extra_y
+                            if stats:
+                                t0 = time.perf_counter()
+                            obblits = self._get_object_blits(ob, sx, sy)
+                            if obblits is None:
+                                if stats:
+                                    object_time += time.perf_counter() - t0
+                                self._flush_blits()
+                                if stats:
+                                    t0 = time.perf_counter()
+                                ob(self.screen, sx, sy, self.isometric_map)
+                            else:
+                                self._note_object_blits(obblits)
+                                myblits.extend(obblits)
+                            if stats:
+                                object_time += time.perf_counter() - t0
+                            objects_drawn += 1
+
+                    elif line_cache[current_line] is None and layer == render_layers[-1]:
                         keep_going = False
 
                 else:
@@ -807,17 +3821,16 @@ class IsometricMapViewer(object):
 
             line_number += 1
 
-        #mx = self.map_x(mouse_x, mouse_y)
-        #my = self.map_y(mouse_x, mouse_y)
-        #if self.isometric_map.on_the_map(mx, my):
-        #    mydest = self.debug_sprite.bitmap.get_rect(midbottom=self.screen_coords(mx, my))
-        #    self.debug_sprite.render(mydest, 0)
-
-        self.phase = (self.phase + 1) % 600
-        self._mouse_tile = (self.map_x(mouse_x, mouse_y), self.map_y(mouse_x, mouse_y))
+        self._flush_blits()
 
-        if self.postfx:
-            self.postfx()
+        if stats:
+            stats.add("terrain", (time.perf_counter() - t_terrain - object_time - cursor_time) * 1000.0)
+            stats.add("objects", object_time * 1000.0)
+            stats.add("cursor", cursor_time * 1000.0)
+            stats.add("tiles_visited", tiles_visited)
+            stats.add("tiles_drawn", tiles_drawn)
+            stats.add("cells_skipped", cells_skipped)
+            stats.add("objects_drawn", objects_drawn)
 
     def check_event(self, ev):
         # Call this function every time your game loop gets an event.
@@ -835,6 +3848,11 @@ class IsometricMapViewer(object):
             dx = -SCROLL_STEP
         if dx or dy:
             self._update_camera(dx, dy)
+        if ev.type == pygame.KEYDOWN:
+            if self.zoom_in_key and ev.key == self.zoom_in_key:
+                self.zoom_in()
+            elif self.zoom_out_key and ev.key == self.zoom_out_key:
+                self.zoom_out()
 
 
 class IsometricMapCursor(object):
@@ -893,13 +3911,28 @@ class IsometricMapQuarterCursor(object):
         self.surf = surf
         self.layer_name = layer.name
         self.visible = visible
+        # The layer gets looked up by name once per map, so the cursor can follow the view to another map.
+        self._layers = weakref.WeakKeyDictionary()
+
+    def get_layer(self, isometric_map):
+        mylayer = self._layers.get(isometric_map)
+        if mylayer is None:
+            mylayer = isometric_map.get_layer_by_name(self.layer_name)
+            self._layers[isometric_map] = mylayer
+        return mylayer
 
     def render(self, view):
+        if self.visible:
+            view.screen.blit(view.get_zoomed_surface(self.surf), self.get_rect(view))
+
+    def get_rect(self, view):
+        """Return the screen rect this cursor gets drawn in, or None if it's invisible."""
         if self.visible:
             sx, sy = view.screen_coords(*self.get_pos())
-            mylayer = view.isometric_map.get_layer_by_name(self.layer_name)
-            mydest = self.surf.get_rect(midbottom=(sx+mylayer.offsetx, sy+mylayer.offsety-2))
-            view.screen.blit(self.surf, mydest)
+            mylayer = self.get_layer(view.isometric_map)
+            return view.get_zoomed_surface(self.surf).get_rect(
+                midbottom=(sx+view.zoomed(mylayer.offsetx), sy+view.zoomed(mylayer.offsety-2))
+            )
 
     def set_position(self, view, x, y):
         self._doublex = int(x*2)
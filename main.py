@@ -21,7 +21,8 @@ maps = (tilemap, tilemap2)
 
 viewer = isometric_maps.IsometricMapViewer(tilemap, screen, up_scroll_key=pygame.K_UP,
                                                down_scroll_key=pygame.K_DOWN, left_scroll_key=pygame.K_LEFT,
-                                               right_scroll_key=pygame.K_RIGHT)
+                                               right_scroll_key=pygame.K_RIGHT, zoom_in_key=pygame.K_EQUALS,
+                                               zoom_out_key=pygame.K_MINUS)
 cursor_image = pygame.image.load("assets/half-floor-tile.png").convert_alpha()
 cursor_image.set_colorkey((255, 0, 255))
 viewer.cursor = isometric_maps.IsometricMapQuarterCursor(0, 0, cursor_image, tilemap.layers[1])
@@ -35,9 +36,8 @@ class Character(isometric_maps.IsometricMapObject):
         self.surf = pygame.image.load("assets/sys_icon.png").convert_alpha()
         # self.surf.set_colorkey((0,0,255))
 
-    def __call__(self, dest_surface, sx, sy, mymap):
-        mydest = self.surf.get_rect(midbottom=(sx, sy))
-        dest_surface.blit(self.surf, mydest)
+    def get_blits(self, sx, sy, mymap):
+        return [(self.surf, self.surf.get_rect(midbottom=(sx, sy)))]
 
 
 class NPC(isometric_maps.IsometricMapObject):
@@ -48,9 +48,8 @@ class NPC(isometric_maps.IsometricMapObject):
         self.surf = pygame.image.load("assets/npc.png").convert_alpha()
         # self.surf.set_colorkey((0,0,255))
 
-    def __call__(self, dest_surface, sx, sy, mymap):
-        mydest = self.surf.get_rect(midbottom=(sx, sy))
-        dest_surface.blit(self.surf, mydest)
+    def get_blits(self, sx, sy, mymap):
+        return [(self.surf, self.surf.get_rect(midbottom=(sx, sy)))]
 
 
 class MovementPath():
@@ -61,11 +60,12 @@ class MovementPath():
         self.goal = None
         blocked_tiles = set()
         obgroup = list(mymap.objectgroups.values())[0]
-        for ob in obgroup.contents:
+        for tile in obgroup.occupied_tiles():
+            if any(ob is not mapob for ob in obgroup.objects_at(*tile)):
+                blocked_tiles.add(tile)
+        for ob in obgroup.objects_at(*self.pos_to_index(dest)):
             if ob is not mapob:
-                blocked_tiles.add((ob.x,ob.y))
-                if self.pos_to_index((ob.x, ob.y)) == self.pos_to_index(dest):
-                    self.goal = ob
+                self.goal = ob
         self.path = demolib.pathfinding.AStarPath(mymap, self.pos_to_index((mapob.x, mapob.y)), self.pos_to_index(dest), self.tile_is_blocked, blocked_tiles)
         if self.path.results:
             self.path.results.pop(0)
@@ -1,6 +1,7 @@
 import random
 import timeit
 import array
+import numpy
 
 map_width = 5000
 map_height = 5000
@@ -28,6 +29,18 @@ class ArrayMap():
             return self.tiles[i]
             
 
+class NumpyMap():
+    def __init__(self):
+        tiles = [random.randint(1,100) for t in range(map_width * map_height)]
+        self.tiles = numpy.array(tiles, dtype=numpy.uint32)
+
+    def __getitem__(self, key):
+        x,y = key
+        i = y*map_width + x
+        if x >= 0 and y >= 0 and x < map_width and y < map_height:
+            return self.tiles[i]
+
+
 class DictMap():
     def __init__(self):
         self.tiles = dict()
@@ -51,5 +64,6 @@ class ListOfListsMap():
 if __name__ == '__main__':
     print(timeit.timeit("i = a[random.randint(0,{}),random.randint(0,{})]".format(map_width-1,map_height-1), setup="from __main__ import random, LinearMap\na = LinearMap()", number=100000))
     print(timeit.timeit("i = a[random.randint(0,{}),random.randint(0,{})]".format(map_width-1,map_height-1), setup="from __main__ import random, ArrayMap\na = ArrayMap()", number=100000))
+    print(timeit.timeit("i = a[random.randint(0,{}),random.randint(0,{})]".format(map_width-1,map_height-1), setup="from __main__ import random, NumpyMap\na = NumpyMap()", number=100000))
     print(timeit.timeit("i = a[random.randint(0,{}),random.randint(0,{})]".format(map_width-1,map_height-1), setup="from __main__ import random, DictMap\na = DictMap()", number=100000))
     print(timeit.timeit("i = a[random.randint(0,{}),random.randint(0,{})]".format(map_width-1,map_height-1), setup="from __main__ import random, ListOfListsMap\na = ListOfListsMap()", number=100000))
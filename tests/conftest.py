@@ -0,0 +1,160 @@
+import os
+import sys
+
+# The viewer tests draw on a real screen surface, but nothing needs to show up.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Tilesets name their images relative to the assets folder in the working directory.
+os.chdir(ROOT)
+
+import pytest
+
+import katagames_engine as kengi
+
+kengi.init('old_school')
+
+pygame = kengi.pygame
+
+import isometric_maps
+
+TEST_MAP = os.path.join("assets", "test_map.tmx")
+
+
+class Sprite(isometric_maps.IsometricMapObject):
+    def __init__(self, x, y, image):
+        super().__init__()
+        self.x = x
+        self.y = y
+        self.surf = pygame.image.load(image).convert_alpha()
+
+    def get_blits(self, sx, sy, mymap):
+        return [(self.surf, self.surf.get_rect(midbottom=(sx, sy)))]
+
+
+class SelfDrawingSprite(Sprite):
+    # Objects without get_blits draw themselves, which makes the viewer flush its blits in between.
+    get_blits = None
+
+    def __call__(self, dest_surface, sx, sy, mymap):
+        dest_surface.blit(self.surf, self.surf.get_rect(midbottom=(sx, sy)))
+
+
+@pytest.fixture(autouse=True)
+def still_mouse(monkeypatch):
+    # Park the mouse in the middle of the screen, so that it doesn't scroll the map.
+    screen = kengi.core.get_screen()
+    monkeypatch.setattr(kengi.core, "proj_to_vscreen", lambda pos: screen.get_rect().center)
+
+
+@pytest.fixture
+def screen():
+    return kengi.core.get_screen()
+
+
+def load_test_map(**keywords):
+    keywords.setdefault("use_cache", False)
+    return isometric_maps.IsometricMap.load(TEST_MAP, **keywords)
+
+
+def make_sheet(tile_width, tile_height, colors, draw_tile):
+    # Returns a sprite sheet with one tile per color, each drawn by draw_tile(surface, rect, color).
+    sheet = pygame.Surface((tile_width * len(colors), tile_height))
+    sheet.fill((255, 0, 255))
+    for i, color in enumerate(colors):
+        draw_tile(sheet, pygame.Rect(i * tile_width, 0, tile_width, tile_height), color)
+    return sheet
+
+
+def make_flat_map():
+    """Return a 24x24 map drawn from generated tiles: a ground layer of diamonds that fit their cells exactly, then a
+    layer of pillars twice as tall as a cell. Neither has an offset, and there are no objectgroups."""
+    mymap = isometric_maps.IsometricMap()
+    mymap.tile_width, mymap.tile_height = 64, 32
+    mymap.width = mymap.height = 24
+
+    def draw_diamond(sheet, rect, color):
+        pygame.draw.polygon(sheet, color, [rect.midtop, rect.midright, rect.midbottom, rect.midleft])
+
+    def draw_pillar(sheet, rect, color):
+        # A block standing on its cell, which doesn't reach into the cells in front of it.
+        block = rect.inflate(-4, -4)
+        pygame.draw.polygon(sheet, color, [(block.left, block.top + 15), block.midtop, (block.right, block.top + 15),
+                                           (block.right, block.bottom - 15), block.midbottom,
+                                           (block.left, block.bottom - 15)])
+
+    ground = isometric_maps.IsometricTileset("test-ground", 64, 32, 1)
+    ground._add_image("test-ground", 2, make_sheet(64, 32, [(90, 140, 60), (70, 110, 50)], draw_diamond))
+    mymap.add_tileset(ground)
+    pillars = isometric_maps.IsometricTileset("test-pillars", 64, 64, 3)
+    pillars._add_image("test-pillars", 1, make_sheet(64, 64, [(160, 150, 140)], draw_pillar))
+    mymap.add_tileset(pillars)
+
+    for name in ("ground", "pillars"):
+        layer = isometric_maps.IsometricLayer.emptylayer(name, mymap)
+        layer.visible = True
+        mymap.layers.append(layer)
+    for x in range(mymap.width):
+        for y in range(mymap.height):
+            mymap.layers[0][x, y] = 1 + (x + y) % 2
+            if x % 5 == 2 and y % 3 == 1:
+                mymap.layers[1][x, y] = 3
+    return mymap
+
+
+def add_sprites(isometric_map):
+    """Put a few sprites in the first objectgroup of isometric_map and return them."""
+    if not isometric_map.objectgroups:
+        return []
+    obs = [Sprite(10, 10, "assets/sys_icon.png"), Sprite(15, 15, "assets/npc.png"),
+           SelfDrawingSprite(12.5, 11.3, "assets/npc.png"), Sprite(3, 4, "assets/npc.png")]
+    list(isometric_map.objectgroups.values())[0].contents.extend(obs)
+    return obs
+
+
+def make_viewer(isometric_map, screen, **keywords):
+    viewer = isometric_maps.IsometricMapViewer(isometric_map, screen, **keywords)
+    cursor_image = pygame.image.load("assets/half-floor-tile.png").convert_alpha()
+    cursor_image.set_colorkey((255, 0, 255))
+    viewer.cursor = isometric_maps.IsometricMapQuarterCursor(12, 13, cursor_image, isometric_map.layers[1])
+    return viewer
+
+
+CAMERA_SPOTS = ((10, 10), (3, 3), (20, 15), (28, 2), (5, 18))
+
+
+def render_frames(screen, setup=None, moves=True, make_map=load_test_map, **keywords):
+    """Draw a tour of a fresh map from make_map with a viewer made with keywords. Returns the screen contents of every
+    frame. setup, if given, gets called with the map, the viewer and the sprites before the first frame."""
+    mymap = make_map()
+    obs = add_sprites(mymap)
+    viewer = make_viewer(mymap, screen, **keywords)
+    if setup:
+        setup(mymap, viewer, obs)
+    frames = list()
+    for x, y in CAMERA_SPOTS:
+        viewer.camera_updated_this_frame = False
+        viewer.focus(x, y)
+        for i in range(2):
+            viewer()
+            frames.append(pygame.image.tobytes(screen, "RGB"))
+        if moves:
+            # Move some sprites while the camera stands still, which only redraws part of the screen with dirty
+            # rects, then scroll.
+            if obs:
+                obs[0].x += 0.3
+                obs[2].y -= 0.2
+            viewer()
+            frames.append(pygame.image.tobytes(screen, "RGB"))
+            for i in range(4):
+                viewer._update_camera(8, 4 - i * 4)
+                viewer()
+                frames.append(pygame.image.tobytes(screen, "RGB"))
+                viewer.camera_updated_this_frame = False
+    return frames
+
+
+def different_frames(frames_a, frames_b):
+    assert len(frames_a) == len(frames_b)
+    return [i for i, (a, b) in enumerate(zip(frames_a, frames_b)) if a != b]
@@ -0,0 +1,65 @@
+import copy
+import pickle
+
+import pytest
+
+import isometric_maps
+
+from conftest import load_test_map
+
+STORAGES = (isometric_maps.LAYER_STORAGE_LIST, isometric_maps.LAYER_STORAGE_ARRAY, isometric_maps.LAYER_STORAGE_NUMPY,
+            isometric_maps.LAYER_STORAGE_MEMORYVIEW)
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_cells_are_ints(storage):
+    mymap = load_test_map(storage=storage)
+    gids = [layer[x, y] for layer in mymap.layers for x in range(mymap.width) for y in range(mymap.height)]
+    assert {type(gid) for gid in gids} == {int}
+    assert 2147483653 in gids
+
+
+def test_chunked_layer_evicts_least_recently_used():
+    mymap = isometric_maps.IsometricMap()
+    mymap.tile_width, mymap.tile_height = 64, 32
+    mymap.width = mymap.height = 48
+    layer = isometric_maps.ChunkedIsometricLayer.emptylayer("chunked", mymap)
+    layer.memory_budget = 2 * 4 * layer.chunk_width * layer.chunk_height
+    layer[0, 0] = 1
+    layer[16, 0] = 2
+    # Reading the same chunk twice in a row skips the lookup, but still counts as a use.
+    assert layer[0, 0] == 1
+    assert layer[16, 0] == 2
+    assert layer[0, 0] == 1
+    assert layer[1, 0] == 0
+    layer[32, 0] = 3
+    assert list(layer._chunks) == [(0, 0), (2, 0)]
+    assert [layer[0, 0], layer[16, 0], layer[32, 0]] == [1, 2, 3]
+
+
+class CellWatcher(object):
+    def __init__(self):
+        self.changes = list()
+
+    def cell_changed(self, layer, x, y):
+        self.changes.append((layer, x, y))
+
+    def layer_changed(self, layer):
+        pass
+
+
+@pytest.mark.parametrize("make_copy", [copy.deepcopy, lambda layer: pickle.loads(pickle.dumps(layer))])
+def test_layer_copies_start_without_observers(make_copy):
+    layer = load_test_map().layers[2]
+    watcher = CellWatcher()
+    layer.observers.add(watcher)
+    mycopy = make_copy(layer)
+    assert mycopy.tobytes() == layer.tobytes()
+    assert (mycopy.name, mycopy.offsetx, mycopy.offsety) == (layer.name, layer.offsetx, layer.offsety)
+    assert not mycopy.observers
+
+    other_watcher = CellWatcher()
+    mycopy.observers.add(other_watcher)
+    mycopy[3, 4] = 5
+    assert mycopy[3, 4] == 5 and layer[3, 4] != 5
+    assert other_watcher.changes == [(mycopy, 3, 4)] and not watcher.changes
@@ -0,0 +1,116 @@
+import pickle
+
+import pytest
+
+import isometric_maps
+
+from conftest import TEST_MAP, load_test_map
+from test_layers import STORAGES
+
+IsometricMap = isometric_maps.IsometricMap
+
+
+def describe_map(mymap):
+    # Everything a map loader is responsible for, in a form that can be compared.
+    return {
+        "size": (mymap.width, mymap.height, mymap.tile_width, mymap.tile_height),
+        "properties": mymap.properties,
+        "tilesets": [ts.get_info() for ts in mymap.tileset_list],
+        "layers": [(layer.name, bool(layer.visible), layer.offsetx, layer.offsety, layer.properties, layer.tobytes())
+                   for layer in mymap.layers],
+        "objectgroups": [(mymap.layers.index(layer), group.get_info()) for layer, group in mymap.objectgroups.items()],
+    }
+
+
+def make_busy_map():
+    # The test map, with some objects so that there's something in the objectgroup to save.
+    mymap = load_test_map()
+    group = list(mymap.objectgroups.values())[0]
+    for info in (dict(name="chest", type="prop", x=4.5, y=7.0, gid=3), dict(name="door", x=12.0, y=2.25, width=32)):
+        ob = isometric_maps.IsometricMapObject()
+        for k, v in info.items():
+            setattr(ob, k, v)
+        group.contents.append(ob)
+    return mymap
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_parallel_loading_matches_serial(workers):
+    json_map = TEST_MAP.replace(".tmx", ".json")
+    for load, filename in ((IsometricMap.load_tmx, TEST_MAP), (IsometricMap.load_json, json_map)):
+        assert describe_map(load(filename, workers=workers)) == describe_map(load(filename))
+
+
+def test_json_matches_tmx():
+    # The JSON export of the test map predates moving the object layer, so only compare the terrain.
+    from_tmx = describe_map(IsometricMap.load_tmx(TEST_MAP))
+    from_json = describe_map(IsometricMap.load_json(TEST_MAP.replace(".tmx", ".json"), workers=4))
+    for key in ("size", "properties", "tilesets", "layers"):
+        assert from_json[key] == from_tmx[key]
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_streaming_loader_matches_tmx(workers):
+    assert describe_map(IsometricMap.load_tmx_streaming(TEST_MAP, workers=workers)) ==\
+        describe_map(IsometricMap.load_tmx(TEST_MAP))
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_storage_types_agree(storage):
+    assert describe_map(load_test_map(storage=storage)) == describe_map(load_test_map())
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_binary_round_trip(tmp_path, storage):
+    mymap = make_busy_map()
+    filename = str(tmp_path / ("test_map" + isometric_maps.BINARY_MAP_EXTENSION))
+    mymap.save_binary(filename)
+    copy = IsometricMap.load(filename, storage=storage)
+    assert describe_map(copy) == describe_map(mymap)
+
+    # The file gets mapped copy-on-write, so editing the loaded map leaves the file alone.
+    copy.layers[0][3, 3] = 7
+    assert describe_map(IsometricMap.load_binary(filename)) == describe_map(mymap)
+
+
+def test_map_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(isometric_maps, "MAP_CACHE_DIR", str(tmp_path))
+    expected = describe_map(load_test_map())
+    assert describe_map(IsometricMap.load(TEST_MAP)) == expected
+    cache_files = list(tmp_path.iterdir())
+    assert len(cache_files) == 1
+
+    # Now the map comes out of the cache, without parsing the file again.
+    def no_parsing(*args, **keywords):
+        raise AssertionError("the map cache didn't get used")
+
+    with monkeypatch.context() as m:
+        m.setattr(IsometricMap, "load_tmx_streaming", no_parsing)
+        assert describe_map(IsometricMap.load(TEST_MAP)) == expected
+
+    # A broken copy gets ignored and replaced.
+    cache_files[0].write_bytes(b"not a map")
+    assert describe_map(IsometricMap.load(TEST_MAP)) == expected
+    assert describe_map(IsometricMap.load_binary(str(cache_files[0]))) == expected
+
+
+@pytest.mark.parametrize("filename", [TEST_MAP, TEST_MAP.replace(".tmx", ".json")])
+def test_map_cache_reports_progress(tmp_path, monkeypatch, filename):
+    monkeypatch.setattr(isometric_maps, "MAP_CACHE_DIR", str(tmp_path))
+    for from_cache in (False, True):
+        fractions = list()
+        IsometricMap.load(filename, progress=fractions.append)
+        assert fractions == sorted(fractions)
+        assert fractions[-1] == 1.0
+        # Parsing reports as it goes; reading the cached copy is one step.
+        assert (len(fractions) == 1) == from_cache
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_binary_layers_can_be_pickled(tmp_path, storage):
+    filename = str(tmp_path / ("test_map" + isometric_maps.BINARY_MAP_EXTENSION))
+    load_test_map().save_binary(filename)
+    layers = IsometricMap.load_binary(filename, storage=storage).layers
+    copies = pickle.loads(pickle.dumps(layers))
+    assert [layer.tobytes() for layer in copies] == [layer.tobytes() for layer in layers]
+    assert [layer.storage for layer in copies] == [storage] * len(layers)
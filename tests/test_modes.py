@@ -0,0 +1,117 @@
+import numpy
+import pytest
+
+import isometric_maps
+
+from conftest import render_frames, different_frames, make_flat_map
+
+
+def add_stackable_layers(mymap, viewer, obs):
+    # The test map has no neighbouring layers with the same offsets, so give it two runs of them to bake: a
+    # decoration layer on the floor, and a second copy of the top layer shifted over a few cells.
+    def make_layer(name, like, cells):
+        layer = isometric_maps.IsometricLayer(name, 1, mymap, like.offsetx, like.offsety)
+        layer.cells = isometric_maps.make_cells(layer.storage, numpy.asarray(cells, dtype='<u4').tobytes())
+        return layer
+
+    floor = mymap.layers[0].get_cell_array()
+    deco = numpy.where(numpy.arange(floor.size).reshape(floor.shape) % 7 == 0, mymap.layers[2].get_gids()[-1], 0)
+    mymap.layers.insert(1, make_layer("deco", mymap.layers[0], deco))
+    top = mymap.layers[-1]
+    mymap.layers.append(make_layer("top2", top, numpy.roll(mymap.layers[3].get_cell_array(), 2, axis=0)))
+
+
+def bake(mymap, viewer, obs):
+    add_stackable_layers(mymap, viewer, obs)
+    assert mymap.bake_layers() == 2
+
+
+def zoom_in(mymap, viewer, obs):
+    viewer.set_zoom(2.0)
+
+
+def zoom_out(mymap, viewer, obs):
+    viewer.set_zoom(0.5)
+
+
+MODES = [dict(dirty_rects=True), dict(occlusion_culling=True), dict(sparse_layers=True),
+         dict(occlusion_culling=True, sparse_layers=True, dirty_rects=True), dict(terrain_cache=True, dirty_rects=True),
+         dict(scroll_buffer=True, dirty_rects=True)]
+
+
+@pytest.mark.parametrize("keywords", MODES)
+def test_mode_matches_default(screen, keywords):
+    assert not different_frames(render_frames(screen), render_frames(screen, **keywords))
+
+
+@pytest.mark.parametrize("keywords", MODES)
+def test_mode_matches_default_on_flat_map(screen, keywords):
+    default = render_frames(screen, make_map=make_flat_map)
+    assert not different_frames(default, render_frames(screen, make_map=make_flat_map, **keywords))
+
+
+@pytest.mark.parametrize("keywords", [dict()] + MODES)
+def test_baked_map_matches_default(screen, keywords):
+    default = render_frames(screen, setup=add_stackable_layers)
+    assert not different_frames(default, render_frames(screen, setup=bake, **keywords))
+
+
+def test_baked_map_with_small_stack_budget(screen):
+    # With room for only a few stacks, they keep getting dropped and composited again.
+    stacks = list()
+
+    def setup(mymap, viewer, obs):
+        mymap._tile_stacks = isometric_maps.TileStacks(mymap.get_tile_lookup(), max_bytes=16 * 1024)
+        stacks.append(mymap._tile_stacks)
+        bake(mymap, viewer, obs)
+
+    default = render_frames(screen, setup=add_stackable_layers)
+    assert not different_frames(default, render_frames(screen, setup=setup))
+    assert stacks[0].num_bytes <= stacks[0].max_bytes
+    assert len(stacks[0]) < len(stacks[0].ids)
+
+
+@pytest.mark.parametrize("setup", [zoom_in, zoom_out])
+@pytest.mark.parametrize("keywords", MODES)
+def test_zoomed_mode_matches_default(screen, setup, keywords):
+    default = render_frames(screen, setup=setup)
+    assert not different_frames(default, render_frames(screen, setup=setup, **keywords))
+
+
+@pytest.mark.parametrize("zoom", [2.0, 0.5])
+def test_zoomed_baked_map_matches_default(screen, zoom):
+    def unbaked(mymap, viewer, obs):
+        add_stackable_layers(mymap, viewer, obs)
+        viewer.set_zoom(zoom)
+
+    def baked(mymap, viewer, obs):
+        bake(mymap, viewer, obs)
+        viewer.set_zoom(zoom)
+
+    assert not different_frames(render_frames(screen, setup=unbaked), render_frames(screen, setup=baked))
+
+
+def test_zooming_back_matches_default(screen):
+    def zoom_there_and_back(mymap, viewer, obs):
+        viewer()
+        viewer.set_zoom(2.0)
+        viewer()
+        viewer.set_zoom(1.0)
+
+    assert not different_frames(render_frames(screen), render_frames(screen, setup=zoom_there_and_back))
+
+
+@pytest.mark.parametrize("keywords", [dict()] + MODES)
+def test_counters_are_never_negative(screen, keywords):
+    # A baked cell draws several tiles, so the cells skipped have to be counted as they get skipped.
+    viewers = list()
+
+    def setup(mymap, viewer, obs):
+        bake(mymap, viewer, obs)
+        viewers.append(viewer)
+
+    render_frames(screen, setup=setup, stats=True, **keywords)
+    history = viewers[0].stats.history
+    for name in isometric_maps.RenderStats.COUNTERS:
+        assert min(history[name]) >= 0
+    assert max(history["cells_skipped"]) > 0
@@ -0,0 +1,72 @@
+import copy
+import pickle
+
+import pytest
+
+import isometric_maps
+
+COPIERS = [copy.deepcopy, lambda thing: pickle.loads(pickle.dumps(thing))]
+
+
+class GroupWatcher(object):
+    def __init__(self):
+        self.events = list()
+
+    def object_moved(self, group, ob):
+        self.events.append(("moved", group, ob))
+
+    def object_removed(self, group, ob):
+        self.events.append(("removed", group, ob))
+
+    def contents_changed(self, group):
+        self.events.append(("changed", group))
+
+
+@pytest.mark.parametrize("make_copy", COPIERS)
+def test_group_copies_start_without_observers(make_copy):
+    group = isometric_maps.ObjectGroup("things", True, 0, -8)
+    watcher = GroupWatcher()
+    group.observers.add(watcher)
+    mycopy = make_copy(group)
+    assert (mycopy.name, mycopy.visible, mycopy.offsetx, mycopy.offsety) == ("things", True, 0, -8)
+    assert not mycopy.observers
+    mycopy.contents.append(isometric_maps.IsometricMapObject())
+    assert not watcher.events
+
+
+def make_object(x, y, name):
+    ob = isometric_maps.IsometricMapObject()
+    ob.x, ob.y, ob.name = x, y, name
+    return ob
+
+
+@pytest.mark.parametrize("make_copy", COPIERS)
+def test_group_copies_keep_their_index(make_copy):
+    group = isometric_maps.ObjectGroup("things", True, 0, 0)
+    group.contents.extend([make_object(2.5, 3, "a"), make_object(4, 4, "b"), make_object(4, 4, "c")])
+    mycopy = make_copy(group)
+    assert type(mycopy.contents) is isometric_maps.ObjectList
+    assert [ob.get_info() for ob in mycopy.contents] == [ob.get_info() for ob in group.contents]
+    assert [ob.name for ob in mycopy.objects_at(4, 4)] == ["b", "c"]
+    assert [ob.name for ob in mycopy.objects_at(3, 3)] == ["a"]
+
+    # The copies move around their own group's index, and leave the original alone.
+    a = mycopy.objects_at(3, 3)[0]
+    a.x = 7
+    assert mycopy.objects_at(7, 3) == [a] and not mycopy.objects_at(3, 3)
+    assert [ob.name for ob in group.objects_at(3, 3)] == ["a"]
+    mycopy.contents.remove(a)
+    assert not mycopy.objects_at(7, 3)
+    assert len(group.contents) == 3
+
+
+@pytest.mark.parametrize("make_copy", COPIERS)
+def test_object_copies_leave_their_groups(make_copy):
+    group = isometric_maps.ObjectGroup("things", True, 0, 0)
+    ob = make_object(1, 1, "a")
+    group.contents.append(ob)
+    mycopy = make_copy(ob)
+    mycopy.x = 5
+    assert group.objects_at(1, 1) == [ob]
+    assert not group.objects_at(5, 1)
+    assert type(make_copy(group.contents)) is list
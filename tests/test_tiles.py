@@ -0,0 +1,28 @@
+import isometric_maps
+
+from conftest import load_test_map
+
+
+def test_flipped_tiles_go_through_variant_cache(monkeypatch):
+    monkeypatch.setattr(isometric_maps.TILE_VARIANT_CACHE, "max_bytes", 1)
+    isometric_maps.TILE_VARIANT_CACHE.clear()
+    isometric_maps.TILE_VARIANT_CACHE.reset_stats()
+    mymap = load_test_map()
+    tile_lookup = mymap.get_tile_lookup()
+    zoomed_lookup = mymap.get_zoomed_lookup(tile_lookup, 0.5)
+    flipped = [gid | isometric_maps.FLIPPED_HORIZONTALLY_FLAG for gid in range(1, 19)]
+    for gid in flipped:
+        surf, dx, dy = tile_lookup[gid]
+        assert surf.get_size() == tile_lookup[gid & isometric_maps.NOT_ALL_FLAGS][0].get_size()
+        assert zoomed_lookup[gid]
+    stats = isometric_maps.TILE_VARIANT_CACHE.get_stats()
+    assert stats["surfaces"] == 1
+    assert stats["evictions"] == len(flipped) - 1
+    assert not [gid for gid in tile_lookup if gid & isometric_maps.TILE_TRANSFORM_FLAGS]
+    assert not [gid for gid in zoomed_lookup if gid & isometric_maps.TILE_TRANSFORM_FLAGS]
+
+    # The last one is still in the cache, so looking it up again is a hit.
+    hits = stats["hits"]
+    tile_lookup[flipped[-1]]
+    assert isometric_maps.TILE_VARIANT_CACHE.get_stats()["hits"] == hits + 1
+    isometric_maps.TILE_VARIANT_CACHE.clear()
@@ -0,0 +1,286 @@
+import copy
+import pickle
+
+import pytest
+
+import isometric_maps
+
+from conftest import pygame, load_test_map, make_viewer, make_flat_map, render_frames, different_frames
+
+
+def test_stats_with_prefetch(screen):
+    mymap = load_test_map()
+    viewer = make_viewer(mymap, screen, stats=True, terrain_cache=True, prefetch=True, cached_layers=mymap.layers[:1])
+    viewer.show_stats = True
+    viewer.focus(3, 3)
+    for i in range(5):
+        viewer._update_camera(-8, -4)
+        viewer()
+    assert len(viewer.stats.history["prefetch"]) == 5
+    assert "prefetch" in viewer.stats.get_report()
+    viewer.get_prefetcher().shutdown()
+
+
+def test_no_prefetcher_without_cached_layers(screen):
+    viewer = make_viewer(load_test_map(), screen, stats=True, terrain_cache=True, prefetch=True)
+    assert viewer.get_cached_layers() == []
+    viewer.focus(3, 3)
+    for i in range(3):
+        viewer._update_camera(-8, -4)
+        viewer()
+    assert viewer.get_prefetcher() is None
+    assert not viewer._prefetchers
+
+
+def prefetch_all(prefetcher, viewer, screen):
+    # Keep asking for the chunks to the left of a corner of the screen until the worker has nothing left to do. The
+    # whole screen would already show most of the test map.
+    for i in range(50):
+        prefetcher.update(viewer, pygame.Rect(400, 200, 160, 120), (20, 0))
+        for generation, future in list(prefetcher._pending.values()):
+            future.result()
+    prefetcher.collect()
+
+
+def assert_chunks_fresh(terrain_cache):
+    for key, mychunk in terrain_cache.chunks.items():
+        fresh = terrain_cache._bake(*key)
+        assert (mychunk is None) == (fresh is None)
+        if mychunk:
+            assert mychunk[1] == fresh[1]
+            assert pygame.image.tobytes(mychunk[0], "RGBA") == pygame.image.tobytes(fresh[0], "RGBA")
+
+
+def test_prefetched_chunks_follow_changed_tiles(screen):
+    mymap = load_test_map()
+    viewer = make_viewer(mymap, screen, terrain_cache=True, chunk_size=4, prefetch=True,
+                         cached_layers=mymap.layers[:1])
+    viewer.focus(15, 5)
+    terrain_cache = viewer.get_terrain_cache()
+    prefetcher = viewer.get_prefetcher()
+    prefetch_all(prefetcher, viewer, screen)
+    assert terrain_cache.chunks
+    assert_chunks_fresh(terrain_cache)
+
+    # Repaint a tile in place; clearing the cache has to drop the worker's copy of it as well.
+    mysurf = mymap.get_tile_lookup()[mymap.layers[0][15, 5]][0]
+    mysurf.fill((0, 255, 0, 255))
+    terrain_cache.clear()
+    prefetch_all(prefetcher, viewer, screen)
+    assert terrain_cache.chunks
+    assert_chunks_fresh(terrain_cache)
+    prefetcher.shutdown()
+
+
+def test_horizontal_lines_with_odd_tile_width(screen):
+    # relative_x steps by two half tile widths, which is one less than tile_width when tile_width is odd.
+    viewer = make_viewer(load_test_map(), screen)
+    viewer.tile_width, viewer.half_tile_width = 65, 32
+    mymap = viewer.isometric_map
+    viewer.x_off, viewer.y_off = mymap.height * viewer.half_tile_width, 0
+    for right in range(0, 1500, 3):
+        visible_area = pygame.Rect(0, 0, right, 2000)
+        for line_number in range(2 * (mymap.width + mymap.height)):
+            x, y = line_number // 2, (line_number + 1) // 2
+            expected = [(x + i, y - i) for i in range(mymap.width + mymap.height)
+                        if mymap.on_the_map(x + i, y - i)
+                        and viewer.relative_x(x + i - 1, y - i - 1) + viewer.x_off < right]
+            assert viewer._get_horizontal_line(0, 0, line_number, visible_area) in (expected, None)
+
+
+def test_terrain_cache_matches_default(screen):
+    # The bottom layer of the test map has an offset and tiles taller than a cell, so nothing gets cached.
+    assert make_viewer(load_test_map(), screen, terrain_cache=True).get_cached_layers() == []
+    default = render_frames(screen)
+    assert not different_frames(default, render_frames(screen, terrain_cache=True))
+    assert not different_frames(default, render_frames(screen, scroll_buffer=True))
+
+
+def test_flat_layers_get_cached(screen):
+    mymap = make_flat_map()
+    assert mymap.get_cacheable_layers() == mymap.layers[:1]
+    default = render_frames(screen, make_map=make_flat_map)
+    for keywords in (dict(terrain_cache=True), dict(scroll_buffer=True), dict(terrain_cache=True, scroll_buffer=True)):
+        assert not different_frames(default, render_frames(screen, make_map=make_flat_map, **keywords))
+
+
+def test_tall_tile_stops_layer_from_being_cached(screen):
+    def add_pillar(mymap, viewer, obs):
+        viewer()
+        mymap.layers[0][10, 10] = 3
+
+    def check(mymap, viewer, obs):
+        add_pillar(mymap, viewer, obs)
+        assert viewer.get_cached_layers() == []
+
+    default = render_frames(screen, make_map=make_flat_map, setup=add_pillar)
+    for keywords in (dict(terrain_cache=True), dict(scroll_buffer=True)):
+        assert not different_frames(default, render_frames(screen, make_map=make_flat_map, setup=check, **keywords))
+
+
+def test_explicit_cached_layers(screen):
+    mymap = load_test_map()
+    viewer = make_viewer(mymap, screen, terrain_cache=True, cached_layers=mymap.layers[:1])
+    assert viewer.get_cached_layers() == mymap.layers[:1]
+    assert viewer.get_terrain_cache().layers == mymap.layers[:1]
+    # Only the first layers of the map can be cached.
+    viewer.cached_layers = mymap.layers[1:2]
+    assert viewer.get_cached_layers() == []
+
+
+class TallSprite(isometric_maps.IsometricMapObject):
+    def __init__(self, x, y, height):
+        super().__init__()
+        self.x = x
+        self.y = y
+        self.surf = pygame.Surface((40, height))
+        self.surf.fill((200, 40, 40))
+
+    def get_blits(self, sx, sy, mymap):
+        return [(self.surf, self.surf.get_rect(midbottom=(sx, sy)))]
+
+
+def test_dirty_rects_find_tall_objects_below_the_screen(screen):
+    def draw_tour(**keywords):
+        mymap = load_test_map()
+        viewer = make_viewer(mymap, screen, **keywords)
+        viewer.focus(5, 2)
+        # Stand a tower well below the bottom of the screen, where it still reaches up into view.
+        sx, sy = screen.get_rect().midbottom
+        tower = TallSprite(viewer.map_x(sx, sy + 150, return_int=False), viewer.map_y(sx, sy + 150, return_int=False),
+                           400)
+        list(mymap.objectgroups.values())[0].contents.append(tower)
+        frames = list()
+        for i in range(4):
+            viewer()
+            frames.append(pygame.image.tobytes(screen, "RGB"))
+            tower.x += 0.5
+        return frames
+
+    assert not different_frames(draw_tour(), draw_tour(dirty_rects=True))
+
+
+@pytest.mark.parametrize("make_copy", [copy.deepcopy, lambda thing: pickle.loads(pickle.dumps(thing))])
+def test_overlay_copies_start_without_observers(screen, make_copy):
+    mymap = load_test_map()
+    viewer = make_viewer(mymap, screen)
+    overlay = isometric_maps.TileOverlay(mymap.layers[1])
+    viewer.add_overlay(overlay)
+    assert overlay.observers
+    mycopy = make_copy(overlay)
+    assert not mycopy.observers
+    assert mycopy.layer.name == overlay.layer.name
+
+
+def test_shipped_map_floor_can_be_cached(screen):
+    # The floor tiles of the test map stick out of their cells, so it only gets cached when asked for.
+    mymap = load_test_map()
+    assert mymap.get_cacheable_layers() == []
+    tiles_drawn = dict()
+    for keywords in (dict(), dict(terrain_cache=True), dict(scroll_buffer=True)):
+        viewer = make_viewer(mymap, screen, stats=True, cached_layers=mymap.layers[:1], **keywords)
+        assert viewer.get_cached_layers() == mymap.layers[:1]
+        viewer.focus(10, 10)
+        viewer()
+        tiles_drawn[tuple(keywords)] = viewer.stats.history["tiles_drawn"][-1]
+    assert tiles_drawn[("terrain_cache",)] < tiles_drawn[()] // 2
+    assert tiles_drawn[("scroll_buffer",)] == tiles_drawn[("terrain_cache",)]
+
+
+def test_minimap_follows_cell_changes(screen):
+    mymap = load_test_map()
+    minimap = isometric_maps.Minimap(mymap)
+    top_colors = {(x, y): minimap.surface.get_at(minimap.get_cell_rect(x, y).topleft)
+                  for x, y in ((0, 0), (7, 3), (mymap.width - 1, mymap.height - 1))}
+    for (x, y), color in top_colors.items():
+        assert tuple(color)[:3] == (minimap._get_color([l[x, y] for l in mymap.layers]) or (0, 0, 0))
+
+    # Emptying every layer in a cell clears its brick, and the patched picture matches one built from scratch.
+    for layer in mymap.layers:
+        layer[7, 3] = 0
+    assert minimap.surface.get_at(minimap.get_cell_rect(7, 3).topleft).a == 0
+    fresh = isometric_maps.Minimap(mymap)
+    assert pygame.image.tobytes(minimap.surface, "RGBA") == pygame.image.tobytes(fresh.surface, "RGBA")
+
+    for x, y in ((0.0, 0.0), (3.5, 12.25), (mymap.width - 1, 2)):
+        px, py = minimap.get_map_pos(*minimap.get_minimap_pos(x, y))
+        assert px == pytest.approx(x) and py == pytest.approx(y)
+
+
+def get_screen_colors(screen):
+    return {tuple(rgb) for rgb in pygame.surfarray.array3d(screen).reshape(-1, 3)}
+
+
+def test_overlay_cells_and_lines():
+    mymap = load_test_map()
+    overlay = isometric_maps.TileOverlay(mymap.layers[1])
+    surf = pygame.Surface((8, 8))
+    overlay.set_cells([(4, 2), (1, 5), (3, 3), (9, 9)], surf)
+    assert len(overlay) == 4 and (3, 3) in overlay and overlay[3, 3] is surf
+    assert overlay.get_line(6, 0, 10) == [(1, 5, surf), (3, 3, surf), (4, 2, surf)]
+    assert overlay.get_line(6, 2, 3) == [(3, 3, surf)]
+    overlay.remove_cells([(3, 3), (5, 5)])
+    assert overlay.get_line(6, 0, 10) == [(1, 5, surf), (4, 2, surf)]
+    del overlay[9, 9]
+    assert overlay.get_line(18, 0, 20) == []
+    overlay.clear()
+    assert not overlay.cells and not overlay._lines
+
+
+@pytest.mark.parametrize("keywords", [dict(), dict(dirty_rects=True)])
+def test_overlay_gets_drawn_and_removed(screen, keywords):
+    mymap = load_test_map()
+    viewer = make_viewer(mymap, screen, **keywords)
+    viewer.focus(10, 10)
+    viewer()
+    before = pygame.image.tobytes(screen, "RGB")
+
+    surf = pygame.Surface((viewer.tile_width, viewer.tile_height))
+    surf.fill((255, 0, 0))
+    overlay = isometric_maps.TileOverlay(mymap.layers[0])
+    viewer.add_overlay(overlay)
+    overlay.set_cells([(9, 9), (10, 10)], surf)
+    viewer()
+    assert pygame.image.tobytes(screen, "RGB") != before
+    assert (255, 0, 0) in get_screen_colors(screen)
+
+    overlay.visible = False
+    viewer.mark_dirty()
+    viewer()
+    assert pygame.image.tobytes(screen, "RGB") == before
+    overlay.visible = True
+    viewer.remove_overlay(overlay)
+    viewer()
+    assert pygame.image.tobytes(screen, "RGB") == before
+
+
+class NamedLayerCursor(object):
+    # A cursor from before cursors had get_layer and get_rect: it only names its layer.
+    def __init__(self, x, y, surf, layer):
+        self.x, self.y = x, y
+        self.surf = surf
+        self.layer_name = layer.name
+        self.renders = 0
+
+    def render(self, view):
+        self.renders += 1
+        mylayer = view.isometric_map.get_layer_by_name(self.layer_name)
+        sx, sy = view.screen_coords(self.x, self.y, mylayer.offsetx, mylayer.offsety)
+        view.screen.blit(self.surf, self.surf.get_rect(midbottom=(sx, sy)))
+
+    def update(self, view, ev):
+        pass
+
+
+@pytest.mark.parametrize("keywords", [dict(), dict(dirty_rects=True)])
+def test_cursor_without_get_layer(screen, keywords):
+    mymap = load_test_map()
+    viewer = make_viewer(mymap, screen, **keywords)
+    surf = pygame.Surface((12, 12))
+    surf.fill((0, 0, 255))
+    viewer.cursor = NamedLayerCursor(10, 10, surf, mymap.layers[1])
+    viewer.focus(10, 10)
+    for i in range(3):
+        viewer()
+    assert viewer.cursor.renders == 3
+    assert (0, 0, 255) in get_screen_colors(screen)